@@ -0,0 +1,163 @@
+"""
+Several LoRA adapters served from one base model and choosing one per
+request
+"""
+import hashlib
+import logging
+from typing import Dict, Hashable, List, NoReturn, Union
+
+from peft import PeftModel
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# Name of the base model without any adapter
+BASE_ADAPTER = "base"
+
+
+class AdapterSet:
+    """
+    LoRA adapters loaded next to one base model, one of them active
+
+    Switching only flips which LoRA weights the layers use, nothing is
+    reloaded. All rows of a forward pass use the active adapter, so
+    requests of different adapters can't share a batch. Must be used
+    from the thread that runs the model.
+    """
+
+    def __init__(self, model: PeftModel, default: Union[str, None] = None):
+        """
+        Args:
+            model (PeftModel): base model with at least one adapter loaded
+            default (Union[str, None], optional): Adapter of requests that
+                                                  don't choose one.
+                                                  Defaults to the active one.
+        """
+        self.model = model
+        self.default = default or model.active_adapter
+        self.active = model.active_adapter
+        self.switches = 0
+        self.activate(self.default)
+
+    @property
+    def names(self) -> List[str]:
+        """
+        Loaded adapters and the base model
+        """
+        return list(self.model.peft_config) + [BASE_ADAPTER]
+
+    def load(self, name: str, adapter_weights_path: str) -> NoReturn:
+        """
+        Load another adapter, the active one stays active
+        """
+        self.model.load_adapter(adapter_weights_path, adapter_name=name)
+        logging.info("Loaded adapter %s from %s", name, adapter_weights_path)
+
+    def activate(self, name: Union[str, None] = None) -> str:
+        """
+        Make the adapter active for the next forward passes
+
+        Args:
+            name (Union[str, None], optional): adapter name, `BASE_ADAPTER`
+                for the base model. Defaults to the default adapter.
+
+        Raises:
+            KeyError: unknown adapter
+
+        Returns:
+            str: active adapter name
+        """
+        name = name or self.default
+        if name == self.active:
+            return name
+        if name not in self.names:
+            raise KeyError(f"Unknown adapter {name}")
+        if name == BASE_ADAPTER:
+            self.model.base_model.disable_adapter_layers()
+        else:
+            if self.active == BASE_ADAPTER:
+                self.model.base_model.enable_adapter_layers()
+            self.model.set_adapter(name)
+        self.active = name
+        self.switches += 1
+        return name
+
+
+def _bucket(user_id: Hashable, salt: str) -> float:
+    digest = hashlib.blake2b(f"{salt}:{user_id}".encode("utf-8"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
+
+
+class AdapterRouter:
+    """
+    Chooses the adapter of a request
+
+    A user pinned in `users` always gets their adapter. Otherwise an A/B
+    test assigns a stable share of users to each of its adapters, the
+    rest get the adapter of the conversation stage or the default one.
+    """
+
+    def __init__(self,
+                 default: Union[str, None] = None,
+                 users: Union[Dict[Hashable, str], None] = None,
+                 stages: Union[Dict[str, str], None] = None,
+                 ab_test: Union[Dict[str, float], None] = None,
+                 ab_test_name: str = "ab"):
+        """
+        Args:
+            default (Union[str, None], optional): Adapter of everyone else,
+                                                  None for the default one
+                                                  of the generator.
+                                                  Defaults to None.
+            users (Union[Dict[Hashable, str], None], optional): Adapters of
+                                                                pinned users.
+                                                                Defaults to
+                                                                None.
+            stages (Union[Dict[str, str], None], optional): Adapters of
+                                                            conversation
+                                                            stages. Defaults
+                                                            to None.
+            ab_test (Union[Dict[str, float], None], optional): Share of
+                                                               users of each
+                                                               tested adapter.
+                                                               Defaults to
+                                                               None.
+            ab_test_name (str, optional): Salt of the user assignment, a new
+                                          name reshuffles users.
+                                          Defaults to "ab".
+        """
+        self.default = default
+        self.users = users or {}
+        self.stages = stages or {}
+        self.ab_test = ab_test or {}
+        self.ab_test_name = ab_test_name
+        if sum(self.ab_test.values()) > 1:
+            raise ValueError("A/B test shares add up to more than 1")
+
+    def choose(self,
+               user_id: Hashable,
+               stage: Union[str, None] = None) -> Union[str, None]:
+        """
+        Adapter for the next reply to the user
+
+        Args:
+            user_id (Hashable): user id
+            stage (Union[str, None], optional): conversation stage.
+                                                Defaults to None.
+
+        Returns:
+            Union[str, None]: adapter name, None for the default one
+        """
+        adapter = self.users.get(user_id)
+        if adapter is not None:
+            return adapter
+        if self.ab_test:
+            bucket = _bucket(user_id, self.ab_test_name)
+            for adapter, share in self.ab_test.items():
+                if bucket < share:
+                    return adapter
+                bucket -= share
+        return self.stages.get(stage, self.default)
@@ -0,0 +1,213 @@
+"""
+Admission control in front of the model: per-user rate limits, global
+concurrency cap and coalescing of rapid messages
+"""
+import asyncio
+import enum
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Hashable, List, NoReturn, Union
+
+from errors import WorkerBusyError
+
+
+class TokenBucket:
+    """
+    Allows `burst` events at once and `rate` events per second on average
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def try_acquire(self, now: float) -> bool:
+        """
+        Take a token if there is one
+        """
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated_at) * self.rate >= self.burst
+
+
+class Admission(enum.Enum):
+    """
+    Decision on an incoming user message
+    """
+    # The caller runs the turn, see `AdmissionController.take`
+    ACCEPTED = "accepted"
+    # Merged into the turn that is already pending for the user
+    COALESCED = "coalesced"
+    RATE_LIMITED = "rate_limited"
+
+
+class _UserState:
+    __slots__ = ("bucket", "pending", "active")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.pending: List[str] = []
+        self.active = False
+
+
+class AdmissionController:
+    """
+    Decides which messages reach the model
+
+    Every message takes a token from the user's bucket or is rejected.
+    The first message of a user becomes the active turn: its handler
+    calls `take` in a loop and answers everything the user sent in the
+    meantime as one turn, the handlers of those messages just return.
+    `slot` caps the number of generations running at once. Must be used
+    from the event loop thread only.
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: float,
+                 max_concurrent: int,
+                 max_wait: float = 10.0,
+                 coalesce_window: float = 0.0,
+                 max_users: int = 100000,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            rate (float): messages per second allowed for a user on average
+            burst (float): messages a user can send at once
+            max_concurrent (int): generations running at once
+            max_wait (float, optional): Seconds to wait for a free slot
+                                        before rejecting. Defaults to 10.0.
+            coalesce_window (float, optional): Seconds to wait for more
+                                               messages before the first
+                                               generation. Defaults to 0.0.
+            max_users (int, optional): Users whose buckets are kept, the
+                                       least recently active ones are
+                                       dropped. Defaults to 100000.
+            clock (Callable[[], float], optional): Monotonic time source.
+                                                   Defaults to
+                                                   time.monotonic.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.coalesce_window = coalesce_window
+        self.max_users = max_users
+        self.clock = clock
+        self.admitted = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.overloaded = 0
+        self.running = 0
+        self._users = OrderedDict()
+        self._semaphore = None
+
+    def offer(self, user_id: Hashable, text: str) -> Admission:
+        """
+        Register a user message
+
+        Args:
+            user_id (Hashable): message author
+            text (str): message text
+
+        Returns:
+            Admission: what the caller should do with the message
+        """
+        now = self.clock()
+        state = self._users.get(user_id)
+        if state is None:
+            self._evict(now)
+            state = _UserState(TokenBucket(self.rate, self.burst, now))
+            self._users[user_id] = state
+        else:
+            self._users.move_to_end(user_id)
+
+        if not state.bucket.try_acquire(now):
+            self.rate_limited += 1
+            return Admission.RATE_LIMITED
+        state.pending.append(text)
+        if state.active:
+            self.coalesced += 1
+            return Admission.COALESCED
+        state.active = True
+        self.admitted += 1
+        return Admission.ACCEPTED
+
+    def take(self, user_id: Hashable) -> Union[str, None]:
+        """
+        Messages of the user to answer next joined into one turn, None
+        when there are no more and the user's turn is over
+        """
+        state = self._users.get(user_id)
+        if state is None:
+            return None
+        if not state.pending:
+            state.active = False
+            return None
+        text = "\n".join(state.pending)
+        state.pending = []
+        return text
+
+    def discard(self, user_id: Hashable) -> NoReturn:
+        """
+        End the user's turn and drop pending messages, e.g. on error
+        """
+        state = self._users.get(user_id)
+        if state is not None:
+            state.pending = []
+            state.active = False
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Hold one of `max_concurrent` generation slots
+
+        Raises:
+            WorkerBusyError: no slot got free within `max_wait` seconds
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.overloaded += 1
+            raise WorkerBusyError() from None
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        """
+        Counters of admission decisions
+        """
+        return {
+            "admitted": self.admitted,
+            "coalesced": self.coalesced,
+            "rate_limited": self.rate_limited,
+            "overloaded": self.overloaded,
+            "running": self.running
+        }
+
+    def _evict(self, now: float) -> NoReturn:
+        # Active users and users with drained buckets are kept: dropping
+        # them would lose the pending turn or reset the limit
+        while len(self._users) >= self.max_users:
+            for user_id, state in self._users.items():
+                if not state.active and state.bucket.is_full(now):
+                    del self._users[user_id]
+                    break
+            else:
+                break
@@ -0,0 +1,569 @@
+"""
+Dynamic and continuous batching of generation requests
+"""
+import logging
+import queue
+import time
+from collections import deque
+from typing import List, NoReturn, Sequence, Tuple, Union
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    PreTrainedModel,
+    PreTrainedTokenizer,
+    RepetitionPenaltyLogitsProcessor,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper
+)
+
+from adapters import AdapterSet
+from inference_worker import InferenceWorker, InferenceJob, _STOP
+from kv_cache import PastKeyValues
+from prompt_builder import Prompt, prompt_ids
+from stopping import (
+    StopSequenceChecker,
+    StopSequenceCriteria,
+    truncate_at_stop
+)
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+
+def get_pad_token_id(tokenizer: PreTrainedTokenizer) -> int:
+    """
+    LLaMa tokenizer has no pad token, fall back to EOS like HF generate does
+    """
+    if tokenizer.pad_token_id is not None:
+        return tokenizer.pad_token_id
+    return tokenizer.eos_token_id
+
+
+def left_pad(sequences: List[List[int]],
+             pad_token_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Left-pad token id sequences into a batch
+
+    Args:
+        sequences (List[List[int]]): token ids of each sequence
+        pad_token_id (int): padding token id
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: input ids and attention mask
+    """
+    max_len = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), max_len), pad_token_id,
+                           dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        if seq:
+            input_ids[i, -len(seq):] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[i, -len(seq):] = 1
+    return input_ids, attention_mask
+
+
+def pad_past_key_values(past_key_values: PastKeyValues,
+                        length: int) -> PastKeyValues:
+    """
+    Left-pad cached keys and values along the sequence dimension
+    """
+    pad = length - past_key_values[0][0].shape[2]
+    if pad == 0:
+        return past_key_values
+    return tuple(
+        tuple(torch.nn.functional.pad(t, (0, 0, pad, 0)) for t in layer)
+        for layer in past_key_values
+    )
+
+
+def select_past_key_values(past_key_values: PastKeyValues,
+                           index: torch.Tensor,
+                           start: int = 0) -> PastKeyValues:
+    """
+    Keep only the given batch rows (and sequence positions from `start`)
+    """
+    return tuple(
+        tuple(t[index, :, start:] for t in layer)
+        for layer in past_key_values
+    )
+
+
+def mask_padding(input_ids: torch.Tensor,
+                 attention_mask: torch.Tensor) -> torch.Tensor:
+    """
+    Replace the left padding with the last token of each row
+
+    Pad token is EOS for LLaMa, so the repetition penalty over padding
+    would make padded rows less likely to end. The last token is
+    penalized anyway and writing it twice leaves the scores the same.
+
+    Args:
+        input_ids (torch.Tensor): left-padded token ids
+        attention_mask (torch.Tensor): mask of the first input ids, the
+                                       columns after it are all tokens
+
+    Returns:
+        torch.Tensor: token ids without padding tokens
+    """
+    attention_mask = torch.nn.functional.pad(
+        attention_mask,
+        (0, input_ids.shape[1] - attention_mask.shape[1]),
+        value=1
+    )
+    return torch.where(attention_mask.bool(), input_ids, input_ids[:, -1:])
+
+
+class PaddedRepetitionPenaltyLogitsProcessor(
+        RepetitionPenaltyLogitsProcessor):
+    """
+    Repetition penalty of `generate` that skips the left padding of prompts
+    """
+
+    def __init__(self, penalty: float, attention_mask: torch.Tensor):
+        super().__init__(penalty)
+        self.attention_mask = attention_mask
+
+    def __call__(self,
+                 input_ids: torch.LongTensor,
+                 scores: torch.FloatTensor) -> torch.FloatTensor:
+        return super().__call__(mask_padding(input_ids, self.attention_mask),
+                                scores)
+
+
+def build_logits_processor(inference_params: dict) -> LogitsProcessorList:
+    """
+    Build logits processors and warpers matching HF generate params
+
+    Args:
+        inference_params (dict): generation params, see MODEL_INFERENCE_PARAMS
+
+    Returns:
+        LogitsProcessorList: processors to apply to next token logits
+    """
+    processors = LogitsProcessorList()
+    repetition_penalty = inference_params.get("repetition_penalty")
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    temperature = inference_params.get("temperature")
+    if temperature is not None and temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    top_k = inference_params.get("top_k")
+    if top_k is not None and top_k != 0:
+        processors.append(TopKLogitsWarper(top_k))
+    top_p = inference_params.get("top_p")
+    if top_p is not None and top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+    return processors
+
+
+def generate_batch(model: PreTrainedModel,
+                   tokenizer: PreTrainedTokenizer,
+                   prompts: List[Prompt],
+                   inference_params: dict,
+                   stop_sequences: Sequence[str] = ()) -> List[str]:
+    """
+    Generate responses for several prompts with a single `generate` call
+
+    Args:
+        model (PreTrainedModel): causal LM
+        tokenizer (PreTrainedTokenizer): model tokenizer
+        prompts (List[Prompt]): model inputs, texts or token ids
+        inference_params (dict): generation params
+        stop_sequences (Sequence[str], optional): Generation stops once
+                                                  every response has one,
+                                                  responses are cut at them.
+                                                  Defaults to ().
+
+    Returns:
+        List[str]: decoded new tokens for each prompt
+    """
+    pad_token_id = get_pad_token_id(tokenizer)
+    input_ids, attention_mask = left_pad(
+        [prompt_ids(tokenizer, prompt) for prompt in prompts],
+        pad_token_id
+    )
+    input_ids = input_ids.to(model.device)
+    attention_mask = attention_mask.to(model.device)
+    inference_params = dict(inference_params)
+    logits_processor = LogitsProcessorList()
+    repetition_penalty = inference_params.pop("repetition_penalty", None)
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        logits_processor.append(PaddedRepetitionPenaltyLogitsProcessor(
+            repetition_penalty, attention_mask
+        ))
+    stopping_criteria = StoppingCriteriaList([StopSequenceCriteria(
+        StopSequenceChecker(tokenizer, stop_sequences),
+        input_ids.shape[1],
+        tokenizer.eos_token_id
+    )])
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            pad_token_id=pad_token_id,
+            logits_processor=logits_processor,
+            stopping_criteria=stopping_criteria,
+            **inference_params
+        )
+    new_tokens = output[:, input_ids.shape[1]:]
+    return [truncate_at_stop(text, stop_sequences).strip() for text in
+            tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+
+class ContinuousBatcher:
+    """
+    Iteration-level batching: sequences join and leave the running batch
+    between decoding steps instead of waiting for the whole batch to finish
+
+    Running batch is kept left-padded: `past_key_values` and
+    `attention_mask` cover the already processed tokens, `sequences`
+    additionally holds the sampled token that is fed on the next step.
+    """
+
+    def __init__(self,
+                 model: PreTrainedModel,
+                 tokenizer: PreTrainedTokenizer,
+                 inference_params: dict,
+                 stop_sequences: Sequence[str] = ()):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = inference_params.get("max_new_tokens", 200)
+        self.do_sample = inference_params.get(
+            "do_sample", model.generation_config.do_sample
+        )
+        self.logits_processor = build_logits_processor(inference_params)
+        self.pad_token_id = get_pad_token_id(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.stop_sequences = list(stop_sequences)
+        self.stop_checker = StopSequenceChecker(tokenizer, stop_sequences)
+
+        self.jobs: List[InferenceJob] = []
+        self.num_generated: List[int] = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.sequences = None
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    @torch.no_grad()
+    def add(self, jobs: List[InferenceJob]) -> NoReturn:
+        """
+        Prefill new requests and merge them into the running batch
+        """
+        input_ids, attention_mask = left_pad(
+            [prompt_ids(self.tokenizer, job.prompt) for job in jobs],
+            self.pad_token_id
+        )
+        input_ids = input_ids.to(self.model.device)
+        attention_mask = attention_mask.to(self.model.device)
+        position_ids = attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        output = self.model(input_ids=input_ids,
+                            attention_mask=attention_mask,
+                            position_ids=position_ids,
+                            use_cache=True)
+        next_tokens = self._sample(input_ids, attention_mask,
+                                   output.logits[:, -1, :])
+        sequences = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+        past_key_values = output.past_key_values
+
+        if self.jobs:
+            length = max(attention_mask.shape[1], self.attention_mask.shape[1])
+            past_key_values = tuple(
+                tuple(torch.cat([old, new], dim=0)
+                      for old, new in zip(old_layer, new_layer))
+                for old_layer, new_layer in zip(
+                    pad_past_key_values(self.past_key_values, length),
+                    pad_past_key_values(past_key_values, length)
+                )
+            )
+            attention_mask = torch.cat([
+                self._pad(self.attention_mask, length, 0),
+                self._pad(attention_mask, length, 0)
+            ])
+            sequences = torch.cat([
+                self._pad(self.sequences, length + 1, self.pad_token_id),
+                self._pad(sequences, length + 1, self.pad_token_id)
+            ])
+
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.sequences = sequences
+        self.jobs.extend(jobs)
+        self.num_generated.extend([1] * len(jobs))
+
+    @torch.no_grad()
+    def step(self) -> List[Tuple[InferenceJob, str]]:
+        """
+        Run one decoding step for the whole running batch
+
+        Returns:
+            List[Tuple[InferenceJob, str]]: finished jobs and their responses
+        """
+        finished = self._pop_finished()
+        if not self.jobs:
+            return finished
+
+        attention_mask = torch.cat(
+            [self.attention_mask,
+             self.attention_mask.new_ones((len(self), 1))],
+            dim=-1
+        )
+        position_ids = self.attention_mask.sum(-1, keepdim=True)
+        output = self.model(input_ids=self.sequences[:, -1:],
+                            attention_mask=attention_mask,
+                            position_ids=position_ids,
+                            past_key_values=self.past_key_values,
+                            use_cache=True)
+        next_tokens = self._sample(self.sequences, attention_mask,
+                                   output.logits[:, -1, :])
+
+        self.past_key_values = output.past_key_values
+        self.attention_mask = attention_mask
+        self.sequences = torch.cat([self.sequences, next_tokens[:, None]],
+                                   dim=-1)
+        self.num_generated = [n + 1 for n in self.num_generated]
+        return finished + self._pop_finished()
+
+    def _sample(self,
+                input_ids: torch.Tensor,
+                attention_mask: torch.Tensor,
+                logits: torch.Tensor) -> torch.Tensor:
+        scores = self.logits_processor(mask_padding(input_ids, attention_mask),
+                                       logits.float())
+        if self.do_sample:
+            probs = torch.softmax(scores, dim=-1)
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        return torch.argmax(scores, dim=-1)
+
+    def _pop_finished(self) -> List[Tuple[InferenceJob, str]]:
+        last_tokens = self.sequences[:, -1].tolist() if self.jobs else []
+        done = [
+            i for i, (token, n) in
+            enumerate(zip(last_tokens, self.num_generated))
+            if token == self.eos_token_id or n >= self.max_new_tokens
+            or self.jobs[i].future.cancelled()
+            or self.stop_checker(self.sequences[i, -n:].tolist())
+        ]
+        if not done:
+            return []
+
+        finished = []
+        for i in done:
+            new_tokens = self.sequences[i, -self.num_generated[i]:]
+            response = self.tokenizer.decode(new_tokens,
+                                             skip_special_tokens=True)
+            response = truncate_at_stop(response, self.stop_sequences)
+            finished.append((self.jobs[i], response.strip()))
+
+        done = set(done)
+        keep = [i for i in range(len(self)) if i not in done]
+        self.jobs = [self.jobs[i] for i in keep]
+        self.num_generated = [self.num_generated[i] for i in keep]
+        if not keep:
+            self.past_key_values = None
+            self.attention_mask = None
+            self.sequences = None
+            return finished
+
+        index = torch.tensor(keep, device=self.sequences.device)
+        attention_mask = self.attention_mask[index]
+        # Drop left columns that became pure padding after removing rows
+        start = int((attention_mask.sum(0) > 0).int().argmax())
+        self.past_key_values = select_past_key_values(self.past_key_values,
+                                                      index, start)
+        self.attention_mask = attention_mask[:, start:]
+        self.sequences = self.sequences[index, start:]
+        return finished
+
+    @staticmethod
+    def _pad(tensor: torch.Tensor, length: int, value: int) -> torch.Tensor:
+        return torch.nn.functional.pad(tensor,
+                                       (length - tensor.shape[1], 0),
+                                       value=value)
+
+
+class BatchingInferenceWorker(InferenceWorker):
+    """
+    Inference worker that batches concurrent requests
+
+    Requests are collected for up to `batch_window` seconds or until
+    `max_batch_size` requests are pending. With `continuous=True`
+    requests join the running batch between decoding steps, otherwise
+    every collected batch is run as one `generate` call. Per-request
+    generation kwargs (e.g. streamer) are not supported and ignored,
+    except `adapter` with `adapters`: a batch runs with one adapter,
+    requests of other adapters wait until it is finished. Waiting
+    requests count towards `max_queue_size`: while they fill it, no more
+    requests are taken from the queue, which then rejects new ones.
+    """
+
+    def __init__(self,
+                 model: PreTrainedModel,
+                 tokenizer: PreTrainedTokenizer,
+                 inference_params: dict,
+                 max_queue_size: int = 16,
+                 max_batch_size: int = 8,
+                 batch_window: float = 0.02,
+                 continuous: bool = True,
+                 stop_sequences: Sequence[str] = (),
+                 adapters: Union[AdapterSet, None] = None):
+        """
+        Args:
+            model (PreTrainedModel): causal LM
+            tokenizer (PreTrainedTokenizer): model tokenizer
+            inference_params (dict): generation params
+            max_queue_size (int, optional): Maximum number of pending requests.
+                                            Defaults to 16.
+            max_batch_size (int, optional): Maximum number of sequences
+                                            generated together. Defaults to 8.
+            batch_window (float, optional): Seconds to wait for more requests
+                                            before starting a batch.
+                                            Defaults to 0.02.
+            continuous (bool, optional): Use iteration-level batching.
+                                         Defaults to True.
+            stop_sequences (Sequence[str], optional): texts ending the
+                                                      response besides EOS.
+                                                      Defaults to ().
+            adapters (Union[AdapterSet, None], optional): LoRA adapters
+                                                          requests choose
+                                                          from. Defaults to
+                                                          None.
+        """
+        super().__init__(
+            lambda user_id, prompt, **kwargs: generate_batch(
+                model, tokenizer, [prompt], inference_params, stop_sequences
+            )[0],
+            max_queue_size=max_queue_size
+        )
+        self.model = model
+        self.tokenizer = tokenizer
+        self.inference_params = inference_params
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.continuous = continuous
+        self.stop_sequences = stop_sequences
+        self.adapters = adapters
+        # Requests of another adapter than the running batch
+        self._deferred = deque()
+
+    def _run(self) -> NoReturn:
+        batcher = ContinuousBatcher(self.model, self.tokenizer,
+                                    self.inference_params,
+                                    self.stop_sequences)
+        stopping = False
+        while not stopping or len(batcher) or self._deferred:
+            jobs = []
+            if not stopping:
+                jobs, stopping = self._collect(
+                    min(self.max_batch_size - len(batcher),
+                        self.max_queue_size - len(self._deferred)),
+                    wait=not len(batcher) and not self._deferred
+                )
+            jobs = [job for job in jobs if not job.future.cancelled()]
+            if self.adapters is not None:
+                jobs = self._same_adapter(
+                    jobs,
+                    running=self.continuous and len(batcher) > 0,
+                    max_jobs=self.max_batch_size - len(batcher)
+                )
+
+            if not self.continuous:
+                if jobs:
+                    self._run_static(jobs)
+                continue
+
+            try:
+                if jobs:
+                    batcher.add(jobs)
+                finished = batcher.step()
+            except Exception as exc:
+                logging.exception("Batched generation failed")
+                for job in set(batcher.jobs) | set(jobs):
+                    job.set_exception(exc)
+                batcher = ContinuousBatcher(self.model, self.tokenizer,
+                                            self.inference_params,
+                                            self.stop_sequences)
+                continue
+            for job, response in finished:
+                job.set_result(response)
+
+    def _collect(self,
+                 max_jobs: int,
+                 wait: bool) -> Tuple[List[InferenceJob], bool]:
+        """
+        Take up to `max_jobs` requests from the queue
+
+        When `wait` is set, block for the first request and then wait
+        up to `batch_window` seconds for more of them.
+        """
+        jobs = []
+        deadline = None
+        while len(jobs) < max_jobs:
+            try:
+                if wait and not jobs:
+                    job = self._queue.get()
+                    deadline = time.monotonic() + self.batch_window
+                elif deadline is not None:
+                    job = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                else:
+                    job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is _STOP:
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    def _same_adapter(self,
+                      jobs: List[InferenceJob],
+                      running: bool,
+                      max_jobs: int) -> List[InferenceJob]:
+        """
+        Requests that can run with the active adapter, others are
+        deferred. A new batch takes the adapter of the oldest deferred
+        request, and while any are deferred nothing joins the running
+        batch, so every adapter gets its turn.
+        """
+        if running and self._deferred:
+            self._deferred.extend(jobs)
+            return []
+        jobs = [job for job in list(self._deferred) + jobs
+                if not job.future.cancelled()]
+        self._deferred.clear()
+        selected = []
+        for job in jobs:
+            adapter = job.generate_kwargs.get("adapter") or \
+                self.adapters.default
+            if adapter not in self.adapters.names:
+                job.set_exception(KeyError(f"Unknown adapter {adapter}"))
+                continue
+            if not running and not selected:
+                self.adapters.activate(adapter)
+            if adapter == self.adapters.active and len(selected) < max_jobs:
+                selected.append(job)
+            else:
+                self._deferred.append(job)
+        return selected
+
+    def _run_static(self, jobs: List[InferenceJob]) -> NoReturn:
+        try:
+            responses = generate_batch(self.model, self.tokenizer,
+                                       [job.prompt for job in jobs],
+                                       self.inference_params,
+                                       self.stop_sequences)
+        except Exception as exc:
+            logging.exception("Batched generation failed")
+            for job in jobs:
+                job.set_exception(exc)
+            return
+        for job, response in zip(jobs, responses):
+            job.set_result(response)
@@ -0,0 +1,173 @@
+"""
+Several persona adapters: one process with every LoRA adapter on one base
+model vs one process per adapter
+
+Reports resident memory of both setups and the reply latency of the
+shared model when requests of different adapters come grouped or
+interleaved (every switch is paid once per group).
+
+Run from the repo root:
+    python -m benchmarks.bench_adapters --num-adapters 4
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, NoReturn
+
+import torch
+from peft import LoraConfig, get_peft_model
+
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+# utils reads the token at import time, local models don't need it
+os.environ.setdefault("HF_AUTH_TOKEN", "")
+from utils import get_model  # noqa: E402
+from adapters import AdapterSet  # noqa: E402
+from metrics import resident_memory_bytes  # noqa: E402
+
+LOAD_PARAMS = {"torch_dtype": torch.float32}
+
+
+def build_adapters(work_dir: str,
+                   num_adapters: int,
+                   args: argparse.Namespace) -> Dict[str, str]:
+    """
+    Save random LoRA adapters of the tiny model, paths by adapter name
+    """
+    paths = {}
+    for i in range(num_adapters):
+        model, _ = build_tiny_llama(hidden_size=args.hidden_size,
+                                    num_hidden_layers=args.num_layers)
+        torch.manual_seed(i)
+        # Random instead of zero lora_B, so adapters change the outputs
+        peft_model = get_peft_model(model, LoraConfig(
+            r=args.rank,
+            lora_alpha=32,
+            target_modules=["q_proj", "v_proj"],
+            init_lora_weights=False,
+            task_type="CAUSAL_LM"
+        ))
+        paths[f"persona{i}"] = str(Path(work_dir).joinpath(f"persona{i}"))
+        peft_model.save_pretrained(paths[f"persona{i}"])
+    return paths
+
+
+def generate(model_pipeline, prompt: str, max_new_tokens: int) -> NoReturn:
+    tokenizer = model_pipeline.tokenizer
+    inputs = tokenizer(prompt, return_tensors="pt")
+    with torch.inference_mode():
+        model_pipeline.model.generate(**inputs,
+                                      max_new_tokens=max_new_tokens,
+                                      do_sample=False,
+                                      pad_token_id=tokenizer.eos_token_id)
+
+
+def single_adapter_process(base_path: str,
+                           adapter_path: str,
+                           ready: multiprocessing.Queue,
+                           done: multiprocessing.Event) -> NoReturn:
+    get_model(base_path, LOAD_PARAMS, adapter_path, use_fast_tokenizer=True)
+    ready.put(resident_memory_bytes())
+    # Stay alive so the memory of every replica is held at once
+    done.wait()
+
+
+def run_replicas(base_path: str, adapter_paths: List[str]) -> int:
+    """
+    Resident memory of one process per adapter, summed
+    """
+    context = multiprocessing.get_context("spawn")
+    ready, done = context.Queue(), context.Event()
+    processes = [context.Process(target=single_adapter_process,
+                                 args=(base_path, path, ready, done))
+                 for path in adapter_paths]
+    for process in processes:
+        process.start()
+    memory = sum(ready.get() for _ in processes)
+    done.set()
+    for process in processes:
+        process.join()
+    return memory
+
+
+def run_shared(model_pipeline,
+               adapter_set: AdapterSet,
+               requests: List[tuple],
+               max_new_tokens: int) -> List[float]:
+    latencies = []
+    for adapter, prompt in requests:
+        start = time.perf_counter()
+        adapter_set.activate(adapter)
+        generate(model_pipeline, prompt, max_new_tokens)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name: str, latencies: List[float], switches: int) -> NoReturn:
+    print(f"{name:12s} mean {statistics.fmean(latencies) * 1000:7.1f}ms, "
+          f"max {max(latencies) * 1000:7.1f}ms, {switches} switches")
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-adapters", type=int, default=4)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--num-layers", type=int, default=8)
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--num-requests", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        base_path = str(Path(work_dir).joinpath("base"))
+        build_tiny_llama(save_dir=base_path,
+                         hidden_size=args.hidden_size,
+                         num_hidden_layers=args.num_layers)
+        adapter_paths = build_adapters(work_dir, args.num_adapters,
+                                       args)
+        names = list(adapter_paths)
+
+        replicas_memory = run_replicas(base_path, list(adapter_paths.values()))
+
+        memory_before = resident_memory_bytes()
+        model_pipeline = get_model(base_path, LOAD_PARAMS,
+                                   adapter_paths[names[0]],
+                                   use_fast_tokenizer=True,
+                                   extra_adapters={
+                                       name: adapter_paths[name]
+                                       for name in names[1:]
+                                   })
+        shared_memory = resident_memory_bytes()
+        adapter_set = AdapterSet(model_pipeline.model)
+
+        prompts = sample_prompts(args.num_requests)
+        interleaved = [(names[i % len(names)], prompt)
+                       for i, prompt in enumerate(prompts)]
+        grouped = sorted(interleaved, key=lambda request: request[0])
+        # Warm up every adapter
+        run_shared(model_pipeline, adapter_set,
+                   [(name, prompts[0]) for name in names], 1)
+
+        results = {}
+        for order, requests in (("interleaved", interleaved),
+                                ("grouped", grouped)):
+            switches = adapter_set.switches
+            latencies = run_shared(model_pipeline, adapter_set, requests,
+                                   args.max_new_tokens)
+            results[order] = (latencies, adapter_set.switches - switches)
+
+    print(f"{args.num_adapters} adapters, hidden size {args.hidden_size}, "
+          f"{args.num_layers} layers")
+    print(f"one process per adapter: {replicas_memory / 2 ** 20:8.1f} MiB")
+    print(f"one shared base model:   {shared_memory / 2 ** 20:8.1f} MiB "
+          f"(+{(shared_memory - memory_before) / 2 ** 20:.1f} MiB loaded)")
+    for order, (latencies, switches) in results.items():
+        report(order, latencies, switches)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Admission control under a flood: how many generations are run for the
+messages of normal users and a flooding user, simulated with a fake clock
+
+Run from the repo root:
+    python -m benchmarks.bench_admission
+"""
+import argparse
+import heapq
+import random
+from collections import Counter
+from typing import NoReturn
+
+from admission import Admission, AdmissionController
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-users", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=600.0)
+    parser.add_argument("--user-interval", type=float, default=30.0,
+                        help="mean seconds between messages of a user")
+    parser.add_argument("--flood-interval", type=float, default=0.2,
+                        help="seconds between messages of the flooder")
+    parser.add_argument("--generation-time", type=float, default=3.0)
+    parser.add_argument("--rate", type=float, default=0.2)
+    parser.add_argument("--burst", type=float, default=5)
+    args = parser.parse_args()
+
+    random.seed(42)
+    now = 0.0
+    controller = AdmissionController(rate=args.rate,
+                                     burst=args.burst,
+                                     max_concurrent=1 << 30,
+                                     clock=lambda: now)
+
+    # (time, kind, user id): "message" arrivals and "done" generations
+    events = []
+    for user_id in range(args.num_users):
+        t = random.expovariate(1 / args.user_interval)
+        while t < args.duration:
+            heapq.heappush(events, (t, "message", user_id))
+            t += random.expovariate(1 / args.user_interval)
+    flooder = args.num_users
+    t = 0.0
+    while t < args.duration:
+        heapq.heappush(events, (t, "message", flooder))
+        t += args.flood_interval
+
+    messages = Counter()
+    generations = Counter()
+    while events:
+        now, kind, user_id = heapq.heappop(events)
+        group = "flooder" if user_id == flooder else "users"
+        if kind == "message":
+            messages[group] += 1
+            if controller.offer(user_id, "hi") is not Admission.ACCEPTED:
+                continue
+        # Accepted message or finished generation: answer what is pending
+        if controller.take(user_id) is not None:
+            generations[group] += 1
+            heapq.heappush(events,
+                           (now + args.generation_time, "done", user_id))
+
+    for group in ("users", "flooder"):
+        print(f"{group:8s} {messages[group]:6d} messages -> "
+              f"{generations[group]:6d} generations")
+    print(controller.stats())
+
+
+if __name__ == "__main__":
+    main()
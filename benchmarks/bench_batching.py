@@ -0,0 +1,104 @@
+"""
+Throughput benchmark: one-at-a-time pipeline vs batched generation
+
+Run from the repo root:
+    python -m benchmarks.bench_batching --num-requests 32
+"""
+import argparse
+import asyncio
+import time
+from typing import Callable, List, NoReturn
+
+from transformers import pipeline
+
+from batching import BatchingInferenceWorker
+from inference_worker import InferenceWorker
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+
+async def _submit_all(worker: InferenceWorker,
+                      prompts: List[str]) -> List[str]:
+    return await asyncio.gather(*[
+        worker.submit(user_id, prompt)
+        for user_id, prompt in enumerate(prompts)
+    ])
+
+
+def run_worker(worker: InferenceWorker, prompts: List[str]) -> List[str]:
+    """
+    Submit all prompts concurrently as different users and wait for replies
+    """
+    worker.start()
+    try:
+        return asyncio.run(_submit_all(worker, prompts))
+    finally:
+        worker.stop()
+
+
+def report(name: str,
+           run: Callable[[], List[str]],
+           tokenizer,
+           num_requests: int) -> NoReturn:
+    start = time.perf_counter()
+    responses = run()
+    elapsed = time.perf_counter() - start
+    num_tokens = sum(
+        len(tokenizer(response, add_special_tokens=False).input_ids)
+        for response in responses
+    )
+    print(f"{name:<22} {elapsed:8.2f}s "
+          f"{num_requests / elapsed:8.2f} req/s "
+          f"{num_tokens / elapsed:10.1f} tok/s")
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-requests", type=int, default=32)
+    parser.add_argument("--num-turns", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-window-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    model, tokenizer = build_tiny_llama()
+    prompts = sample_prompts(args.num_requests, args.num_turns)
+    inference_params = {
+        "do_sample": False,
+        "max_new_tokens": args.max_new_tokens,
+        "repetition_penalty": 1.15,
+        "use_cache": True
+    }
+    worker_params = {
+        "max_queue_size": args.num_requests,
+        "max_batch_size": args.max_batch_size,
+        "batch_window": args.batch_window_ms / 1000
+    }
+
+    # Current path: every message is its own pipeline call
+    model_pipeline = pipeline("text-generation", model=model,
+                              tokenizer=tokenizer)
+
+    def one_at_a_time() -> List[str]:
+        return [
+            model_pipeline(prompt, return_full_text=False,
+                           **inference_params)[0]["generated_text"]
+            for prompt in prompts
+        ]
+
+    print(f"{args.num_requests} requests, {args.max_new_tokens} new tokens, "
+          f"max batch size {args.max_batch_size}")
+    report("one-at-a-time", one_at_a_time, tokenizer, args.num_requests)
+    report("static batching", lambda: run_worker(
+        BatchingInferenceWorker(model, tokenizer, inference_params,
+                                continuous=False, **worker_params),
+        prompts
+    ), tokenizer, args.num_requests)
+    report("continuous batching", lambda: run_worker(
+        BatchingInferenceWorker(model, tokenizer, inference_params,
+                                continuous=True, **worker_params),
+        prompts
+    ), tokenizer, args.num_requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+End-to-end latency of update delivery: long polling vs webhook
+
+A local fake Telegram Bot API server replays recorded (or synthetic)
+updates at a fixed rate to an echo bot built with bot_server, measures
+time from delivering an update to receiving the reply, redelivers some
+updates to check deduplication, and stops the bot right after the last
+update to check that accepted updates are drained.
+
+Run from the repo root:
+    python -m benchmarks.bench_bot_transport --rate 50 --handler-delay 0.2
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, NoReturn
+
+from telegram import Update
+from telegram.ext import CallbackContext, MessageHandler, filters
+
+from bot_server import build_application, serve
+from benchmarks.tiny_llama import SAMPLE_MESSAGES
+
+BOT_TOKEN = "123456:fake-token"
+SECRET_TOKEN = "fake-secret"
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    Minimal Bot API: getUpdates long polling, sendMessage and no-op
+    answers for everything else
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), FakeTelegramHandler)
+        self.updates = queue.Queue()
+        self.latencies = []
+        self.replies = 0
+        self._sent_at = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._message_ids = iter(range(1, 1 << 62))
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def delivered(self, chat_id: int) -> NoReturn:
+        with self._lock:
+            self._sent_at[chat_id].append(time.perf_counter())
+
+    def api_getMe(self, params: dict) -> dict:
+        return {"id": 123456, "is_bot": True, "first_name": "AI-Friend",
+                "username": "fake_bot"}
+
+    def api_getUpdates(self, params: dict) -> List[dict]:
+        try:
+            updates = [self.updates.get(timeout=float(params.get("timeout", 0))
+                                        or 0.01)]
+        except queue.Empty:
+            return []
+        limit = int(params.get("limit", 100))
+        while len(updates) < limit:
+            try:
+                updates.append(self.updates.get_nowait())
+            except queue.Empty:
+                break
+        return updates
+
+    def api_sendMessage(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        with self._lock:
+            self.replies += 1
+            if self._sent_at[chat_id]:
+                self.latencies.append(
+                    time.perf_counter() - self._sent_at[chat_id].popleft()
+                )
+        return {"message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", "")}
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        # Values are form-encoded, non-string ones as JSON
+        params = {}
+        for key, value in urllib.parse.parse_qsl(body.decode("utf-8")):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        api_method = getattr(self.server, f"api_{method}", None)
+        result = api_method(params) if api_method is not None else True
+        data = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> NoReturn:
+        pass
+
+
+def run_echo_bot(mode: str,
+                 api_port: int,
+                 webhook_port: int,
+                 concurrent_updates: int,
+                 handler_delay: float) -> NoReturn:
+    """
+    Bot process: replies with the same text after `handler_delay`
+    seconds, standing in for generation
+    """
+    serving_params = {
+        "mode": mode,
+        "concurrent_updates": concurrent_updates,
+        "dedup_size": 10000,
+        "listen": "127.0.0.1",
+        "port": webhook_port,
+        "url_path": "telegram",
+        "webhook_url": f"http://127.0.0.1:{webhook_port}/telegram",
+        "secret_token": SECRET_TOKEN
+    }
+    application = build_application(
+        BOT_TOKEN,
+        serving_params,
+        base_url=f"http://127.0.0.1:{api_port}/bot"
+    )
+
+    async def echo(update: Update, context: CallbackContext):
+        await asyncio.sleep(handler_delay)
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text=update.message.text)
+
+    application.add_handler(MessageHandler(filters.TEXT, echo))
+    serve(application, serving_params)
+
+
+def load_updates(path: str, num_updates: int, num_users: int) -> List[dict]:
+    """
+    Recorded updates (JSON lines) or synthetic text messages
+    """
+    if path:
+        with open(path) as fp:
+            return [json.loads(line) for line in fp][:num_updates]
+    updates = []
+    for update_id in range(1, num_updates + 1):
+        user_id = random.randrange(num_users) + 1
+        updates.append({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+                "text": random.choice(SAMPLE_MESSAGES)
+            }
+        })
+    return updates
+
+
+def post_update(port: int, update: dict) -> NoReturn:
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/telegram",
+        data=json.dumps(update).encode("utf-8"),
+        headers={"Content-Type": "application/json",
+                 "X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN}
+    )
+    urllib.request.urlopen(request).close()
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> NoReturn:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1)
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.1)
+            continue
+        return
+    raise TimeoutError(f"Webhook server on port {port} did not start")
+
+
+def run_mode(mode: str,
+             updates: List[dict],
+             args: argparse.Namespace) -> NoReturn:
+    server = FakeTelegram()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    bot = multiprocessing.get_context("spawn").Process(
+        target=run_echo_bot,
+        args=(mode, server.port, args.webhook_port,
+              args.concurrent_updates, args.handler_delay)
+    )
+    bot.start()
+    if mode == "webhook":
+        wait_for_port(args.webhook_port)
+    else:
+        # Let the poller start
+        time.sleep(2)
+
+    deliveries = 0
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        start = time.perf_counter()
+        for i, update in enumerate(updates):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            server.delivered(update["message"]["chat"]["id"])
+            copies = 2 if random.random() < args.duplicate_ratio else 1
+            for _ in range(copies):
+                deliveries += 1
+                if mode == "webhook":
+                    executor.submit(post_update, args.webhook_port, update)
+                else:
+                    server.updates.put(update)
+
+    # Stop as soon as everything is accepted, replies must still come
+    while mode == "polling" and not server.updates.empty():
+        time.sleep(0.01)
+    os.kill(bot.pid, signal.SIGTERM)
+    bot.join(timeout=60)
+    server.shutdown()
+
+    latencies = sorted(server.latencies)
+    quantiles = statistics.quantiles(latencies, n=100) \
+        if len(latencies) > 1 else latencies * 99
+    print(f"{mode:8s} {len(updates)} updates, {deliveries} deliveries, "
+          f"{server.replies} replies, "
+          f"p50 {quantiles[49] * 1000:.0f}ms, "
+          f"p95 {quantiles[94] * 1000:.0f}ms, "
+          f"p99 {quantiles[98] * 1000:.0f}ms")
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=["polling", "webhook", "both"],
+                        default="both")
+    parser.add_argument("--updates", default=None,
+                        help="recorded updates, one JSON object per line")
+    parser.add_argument("--num-updates", type=int, default=500)
+    parser.add_argument("--num-users", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=50,
+                        help="updates per second")
+    parser.add_argument("--handler-delay", type=float, default=0.2)
+    parser.add_argument("--concurrent-updates", type=int, default=64)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05)
+    parser.add_argument("--webhook-port", type=int, default=8089)
+    args = parser.parse_args()
+
+    random.seed(42)
+    updates = load_updates(args.updates, args.num_updates, args.num_users)
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        run_mode(mode, updates, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Load test of the chat pipeline: thousands of synthetic users talking to
+the bot_app handlers at once
+
+Every user replays the user side of a dialogue from data/test.hf through
+the /start, message and /clear handlers with a fake Update and
+CallbackContext. The model is either a tiny random LLaMa run by the real
+reply generator or a mock answering after a fixed delay. Reports latency
+percentiles, throughput, memory growth per user and prompt growth over
+turns, and saves them as JSON to compare commits.
+
+Run from the repo root:
+    python -m benchmarks.bench_chat_pipeline --num-users 1000 \
+        --output bench_results/chat_pipeline.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict, Hashable, List, NoReturn, Union
+
+os.environ.setdefault("HF_AUTH_TOKEN", "")
+os.environ.setdefault("BOT_TOKEN", "123456:fake-token")
+
+from datasets import load_from_disk
+from transformers import pipeline
+
+import serving
+import inference_config
+from metrics import resident_memory_bytes
+from benchmarks.tiny_llama import (
+    build_tiny_llama,
+    build_tiny_tokenizer,
+    SAMPLE_MESSAGES
+)
+
+
+class FakeBot:
+    """
+    Records sent messages instead of calling the Bot API
+    """
+
+    def __init__(self, send_delay: float = 0.0):
+        self.send_delay = send_delay
+        self.sent = 0
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await asyncio.sleep(self.send_delay)
+        self.sent += 1
+        return SimpleNamespace(chat_id=chat_id, text=text,
+                               message_id=self.sent)
+
+    async def edit_message_text(self, text: str, **kwargs):
+        await asyncio.sleep(self.send_delay)
+
+
+class MockReplyGenerator:
+    """
+    Stands in for the model: answers after a fixed delay
+    """
+
+    def __init__(self, generation_time: float):
+        self.tokenizer = build_tiny_tokenizer()
+        self.generation_time = generation_time
+
+    def __call__(self, user_id: Hashable, prompt: str, streamer=None) -> str:
+        time.sleep(self.generation_time)
+        return random.choice(SAMPLE_MESSAGES)
+
+    def invalidate(self, user_id: Hashable) -> NoReturn:
+        pass
+
+
+def fake_update(user_id: int, text: str = "") -> SimpleNamespace:
+    user = SimpleNamespace(id=user_id)
+    return SimpleNamespace(effective_user=user,
+                           effective_chat=user,
+                           message=SimpleNamespace(text=text))
+
+
+def load_dialogues(path: str, num_dialogues: int) -> List[List[str]]:
+    """
+    User messages of dialogues in the fine-tuning data format, synthetic
+    ones if the dataset is not available
+    """
+    samples = load_from_disk(path)["sample"] if os.path.exists(path) else []
+
+    dialogues = []
+    for sample in samples:
+        # "<system prompt> user [/INST] model </s><s>[INST] user [/INST] ..."
+        turns = sample.split("<</SYS>>")[-1].split("</s><s>[INST]")
+        messages = [turn.split("[/INST]")[0].strip() for turn in turns]
+        messages = [message for message in messages if message]
+        if messages:
+            dialogues.append(messages)
+    if not dialogues:
+        dialogues = [[SAMPLE_MESSAGES[(i + turn) % len(SAMPLE_MESSAGES)]
+                      for turn in range(4 + i % 5)]
+                     for i in range(len(SAMPLE_MESSAGES))]
+    random.shuffle(dialogues)
+    return [dialogues[i % len(dialogues)] for i in range(num_dialogues)]
+
+
+def configure(args: argparse.Namespace, work_dir: str) -> NoReturn:
+    """
+    Adjust the config and the model loading before bot_app is imported
+    """
+    inference_config.HISTORY_STORE_PARAMS.update(
+        backend=args.history_backend,
+        path=os.path.join(work_dir, "history.sqlite3")
+    )
+    inference_config.TRANSCRIPT_LOG_PARAMS["log_dir"] = \
+        os.path.join(work_dir, "transcripts")
+    inference_config.WORKER_POOL_PARAMS["num_workers"] = 0
+    inference_config.STREAMING_PARAMS["enabled"] = False
+    inference_config.BATCHING_PARAMS["enabled"] = \
+        args.batching and args.model == "tiny"
+    inference_config.MODEL_INFERENCE_PARAMS["max_new_tokens"] = \
+        args.max_new_tokens
+    if args.no_rate_limit:
+        inference_config.ADMISSION_PARAMS.update(rate=1e9, burst=1e9)
+
+    if args.model == "mock":
+        serving.build_reply_generator = \
+            lambda metrics=None: MockReplyGenerator(args.generation_time)
+    else:
+        model, tokenizer = build_tiny_llama(hidden_size=args.hidden_size,
+                                            num_hidden_layers=args.num_layers)
+        model_pipeline = pipeline("text-generation",
+                                  model=model,
+                                  tokenizer=tokenizer)
+        serving.get_model = lambda *_, **__: model_pipeline
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    quantiles = statistics.quantiles(values, n=100) \
+        if len(values) > 1 else values * 99
+    return {"mean": statistics.fmean(values),
+            "p50": quantiles[49],
+            "p95": quantiles[94],
+            "p99": quantiles[98],
+            "max": max(values)}
+
+
+async def run_user(bot_app,
+                   user_id: int,
+                   messages: List[str],
+                   args: argparse.Namespace,
+                   results: dict) -> NoReturn:
+    context = SimpleNamespace(bot=results["bot"])
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+    await bot_app.start(fake_update(user_id), context)
+    for turn, text in enumerate(messages[:args.max_turns]):
+        await asyncio.sleep(random.expovariate(1 / args.think_time))
+        start = time.perf_counter()
+        await bot_app.respond(fake_update(user_id, text), context)
+        results["latencies"].append(time.perf_counter() - start)
+        conversation = bot_app.user_history.get(user_id)
+        results["prompt_tokens"][turn].append(conversation.num_tokens)
+    if args.clear:
+        await bot_app.clear(fake_update(user_id), context)
+
+
+async def run_load(bot_app,
+                   dialogues: List[List[str]],
+                   args: argparse.Namespace) -> dict:
+    results = {"bot": FakeBot(args.send_delay),
+               "latencies": [],
+               "prompt_tokens": defaultdict(list)}
+    await bot_app.post_init(None)
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_user(bot_app, user_id, messages, args, results)
+        for user_id, messages in enumerate(dialogues, start=1)
+    ])
+    results["elapsed"] = time.perf_counter() - start
+    await bot_app.post_shutdown(None)
+    return results
+
+
+def git_commit() -> Union[str, None]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline_path: str) -> NoReturn:
+    """
+    Print relative change of the latency and throughput to a saved run
+    """
+    with open(baseline_path) as fp:
+        baseline = json.load(fp)
+    print(f"Compared to {baseline.get('commit')}:")
+    for key in ("p50", "p95", "p99"):
+        old, new = baseline["latency_seconds"][key], \
+            report["latency_seconds"][key]
+        print(f"  latency {key}: {old * 1000:.1f}ms -> {new * 1000:.1f}ms "
+              f"({(new / old - 1) * 100:+.1f}%)")
+    old, new = baseline["turns_per_second"], report["turns_per_second"]
+    print(f"  throughput: {old:.1f} -> {new:.1f} turns/s "
+          f"({(new / old - 1) * 100:+.1f}%)")
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", choices=["mock", "tiny"], default="mock")
+    parser.add_argument("--data", default="data/test.hf")
+    parser.add_argument("--num-users", type=int, default=1000)
+    parser.add_argument("--max-turns", type=int, default=8)
+    parser.add_argument("--think-time", type=float, default=2.0,
+                        help="mean seconds between messages of a user")
+    parser.add_argument("--ramp-up", type=float, default=10.0,
+                        help="seconds over which users arrive")
+    parser.add_argument("--generation-time", type=float, default=0.01,
+                        help="seconds per reply of the mock model")
+    parser.add_argument("--send-delay", type=float, default=0.0,
+                        help="seconds per fake Bot API call")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--batching", action="store_true")
+    parser.add_argument("--history-backend", choices=["memory", "sqlite"],
+                        default="memory")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="disable per-user rate limits")
+    parser.add_argument("--clear", action="store_true",
+                        help="send /clear after the last turn")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="JSON report path")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON report of a previous run to compare to")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    dialogues = load_dialogues(args.data, args.num_users)
+    with tempfile.TemporaryDirectory() as work_dir:
+        configure(args, work_dir)
+        import bot_app
+
+        bot_app.inference_worker.start()
+        gc.collect()
+        memory_before = resident_memory_bytes()
+        try:
+            results = asyncio.run(run_load(bot_app, dialogues, args))
+        finally:
+            bot_app.inference_worker.stop()
+            bot_app.user_history.store.close()
+        gc.collect()
+        memory_after = resident_memory_bytes()
+
+    latencies = results["latencies"]
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "args": vars(args),
+        "turns": len(latencies),
+        "elapsed_seconds": results["elapsed"],
+        "turns_per_second": len(latencies) / results["elapsed"],
+        "messages_sent": results["bot"].sent,
+        "latency_seconds": percentiles(latencies),
+        "memory_growth_bytes": memory_after - memory_before,
+        "memory_growth_bytes_per_user":
+            (memory_after - memory_before) / max(len(dialogues), 1),
+        "prompt_tokens_by_turn": {
+            turn + 1: percentiles(results["prompt_tokens"][turn])
+            for turn in sorted(results["prompt_tokens"])
+        },
+        "admission": bot_app.admission.stats()
+    }
+
+    latency = report["latency_seconds"]
+    print(f"{report['turns']} turns of {len(dialogues)} users in "
+          f"{report['elapsed_seconds']:.1f}s, "
+          f"{report['turns_per_second']:.1f} turns/s")
+    print(f"latency p50 {latency['p50'] * 1000:.1f}ms, "
+          f"p95 {latency['p95'] * 1000:.1f}ms, "
+          f"p99 {latency['p99'] * 1000:.1f}ms")
+    print(f"memory growth {report['memory_growth_bytes_per_user'] / 1024:.1f}"
+          f" KiB per user")
+    for turn, stats in report["prompt_tokens_by_turn"].items():
+        print(f"turn {turn:3d}: prompt {stats['mean']:.0f} tokens on average,"
+              f" p95 {stats['p95']:.0f}")
+    print(f"admission: {report['admission']}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    if args.baseline:
+        compare(report, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Cold start time: base model + adapter vs merged serving artifact
+
+Run from the repo root:
+    python -m benchmarks.bench_cold_start
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import NoReturn
+
+import torch
+from peft import LoraConfig, get_peft_model
+
+from benchmarks.tiny_llama import build_tiny_llama
+
+# utils reads the token at import time, local models don't need it
+os.environ.setdefault("HF_AUTH_TOKEN", "")
+from utils import get_model  # noqa: E402
+from prepare_model import prepare_model  # noqa: E402
+
+
+def time_get_model(repeats: int, *args, **kwargs) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        get_model(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--num-layers", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_path = str(Path(tmp_dir).joinpath("base"))
+        adapter_path = str(Path(tmp_dir).joinpath("adapter"))
+        artifact_path = str(Path(tmp_dir).joinpath("serving"))
+
+        model, _ = build_tiny_llama(save_dir=base_path,
+                                    hidden_size=args.hidden_size,
+                                    num_hidden_layers=args.num_layers)
+        get_peft_model(model, LoraConfig(
+            r=8,
+            lora_alpha=32,
+            target_modules=["q_proj", "v_proj"],
+            task_type="CAUSAL_LM"
+        )).save_pretrained(adapter_path)
+
+        load_params = {"torch_dtype": torch.float32}
+        base = time_get_model(args.repeats, base_path, load_params,
+                              adapter_path, use_fast_tokenizer=True)
+
+        start = time.perf_counter()
+        prepare_model(base_path, artifact_path, adapter_path,
+                      torch_dtype=torch.float32)
+        prepare = time.perf_counter() - start
+
+        served = time_get_model(args.repeats, base_path, load_params,
+                                adapter_path, artifact_path=artifact_path,
+                                use_fast_tokenizer=True)
+
+    print(f"base + adapter:   {base:.2f}s")
+    print(f"prepare (once):   {prepare:.2f}s")
+    print(f"serving artifact: {served:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Per-turn prompt build cost: string concatenation vs token-budgeted conversation
+
+Run from the repo root:
+    python -m benchmarks.bench_conversation
+"""
+import argparse
+import time
+from typing import NoReturn
+
+from conversation import Conversation
+from benchmarks.tiny_llama import build_tiny_tokenizer, SAMPLE_MESSAGES
+from src.prompt_templates import (
+    INIT_SYSTEM_PROMPT,
+    USER_PROMPT,
+    MODEL_OUTPUT
+)
+
+
+def string_concatenation(tokenizer, num_turns: int, max_tokens: int) -> float:
+    """
+    Previous approach: append to one string and tokenize it to measure it
+    """
+    start = time.perf_counter()
+    prompt = INIT_SYSTEM_PROMPT
+    for turn in range(num_turns):
+        message = SAMPLE_MESSAGES[turn % len(SAMPLE_MESSAGES)]
+        user_prompt = prompt + " " + USER_PROMPT.format(user_message=message)
+        len(tokenizer(user_prompt).input_ids) <= max_tokens
+        prompt = user_prompt + " " + MODEL_OUTPUT.format(model_output=message)
+    return time.perf_counter() - start
+
+
+def token_budgeted(tokenizer, num_turns: int, max_tokens: int) -> float:
+    """
+    Conversation with pre-tokenized segments and cached token counts
+    """
+    start = time.perf_counter()
+    conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT,
+                                max_tokens=max_tokens)
+    for turn in range(num_turns):
+        message = SAMPLE_MESSAGES[turn % len(SAMPLE_MESSAGES)]
+        user_segment = conversation.user_segment(message)
+        conversation.build_prompt(pending=user_segment)
+        conversation.append(user_segment, conversation.model_segment(message))
+    return time.perf_counter() - start
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-tokens", type=int, default=3896)
+    args = parser.parse_args()
+
+    tokenizer = build_tiny_tokenizer()
+    print(f"{'turns':>6} {'string, ms/turn':>16} {'segments, ms/turn':>18}")
+    for num_turns in (10, 100, 1000):
+        old = string_concatenation(tokenizer, num_turns, args.max_tokens)
+        new = token_budgeted(tokenizer, num_turns, args.max_tokens)
+        print(f"{num_turns:>6} {old / num_turns * 1000:16.3f} "
+              f"{new / num_turns * 1000:18.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+CPU backend options: tokens/sec and time-to-first-token
+
+Run from the repo root:
+    python -m benchmarks.bench_cpu_backend --num-threads 4
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import NoReturn, Tuple
+
+import torch
+from transformers import Pipeline
+
+from benchmarks.tiny_llama import build_tiny_llama, SAMPLE_MESSAGES
+
+# utils reads the token at import time, local models don't need it
+os.environ.setdefault("HF_AUTH_TOKEN", "")
+from utils import bf16_supported, get_model  # noqa: E402
+
+BACKEND_OPTIONS = {
+    "float32": {},
+    "dynamic int8": {"dynamic_int8": True},
+    "bfloat16": {"bfloat16": True},
+    "float32 + compile": {"compile": True},
+    "dynamic int8 + compile": {"dynamic_int8": True, "compile": True},
+}
+
+
+@torch.inference_mode()
+def measure(model_pipeline: Pipeline,
+            max_new_tokens: int,
+            repeats: int) -> Tuple[float, float]:
+    """
+    Returns:
+        Tuple[float, float]: median TTFT in seconds and decoding tokens/sec
+    """
+    model, tokenizer = model_pipeline.model, model_pipeline.tokenizer
+    prompt = " ".join(SAMPLE_MESSAGES)
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+
+    def generate(num_tokens: int) -> float:
+        start = time.perf_counter()
+        model.generate(input_ids,
+                       attention_mask=torch.ones_like(input_ids),
+                       do_sample=False,
+                       max_new_tokens=num_tokens,
+                       min_new_tokens=num_tokens,
+                       pad_token_id=tokenizer.eos_token_id)
+        return time.perf_counter() - start
+
+    # Warm-up, also triggers torch.compile
+    generate(max_new_tokens)
+    ttft = sorted(generate(1) for _ in range(repeats))[repeats // 2]
+    total = sorted(generate(max_new_tokens)
+                   for _ in range(repeats))[repeats // 2]
+    return ttft, (max_new_tokens - 1) / max(total - ttft, 1e-9)
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--num-layers", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--num-interop-threads", type=int, default=None)
+    parser.add_argument("--no-compile", action="store_true",
+                        help="skip torch.compile options")
+    args = parser.parse_args()
+
+    print(f"bfloat16 supported: {bf16_supported()}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = str(Path(tmp_dir).joinpath("model"))
+        build_tiny_llama(save_dir=model_path,
+                         hidden_size=args.hidden_size,
+                         num_hidden_layers=args.num_layers)
+
+        for name, options in BACKEND_OPTIONS.items():
+            if args.no_compile and options.get("compile"):
+                continue
+            backend_params = {
+                "num_threads": args.num_threads,
+                "num_interop_threads": args.num_interop_threads,
+                **options
+            }
+            model_pipeline = get_model(model_path,
+                                       {"torch_dtype": torch.float32},
+                                       use_fast_tokenizer=True,
+                                       cpu_backend_params=backend_params)
+            ttft, tokens_per_sec = measure(model_pipeline,
+                                           args.max_new_tokens,
+                                           args.repeats)
+            print(f"{name:24s} TTFT {ttft * 1000:7.1f}ms, "
+                  f"{tokens_per_sec:7.1f} tok/s")
+
+
+if __name__ == "__main__":
+    main()
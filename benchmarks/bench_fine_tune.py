@@ -0,0 +1,126 @@
+"""
+Smoke benchmark of the fine-tuning options on CPU with a tiny LLaMa:
+gradient checkpointing, dataloader workers, batch size search, packing
+
+Every option runs `fine_tune.train` for a few steps in a fresh process,
+so peak memory is not carried over between runs, and reports tokens per
+second and peak memory from the throughput callback.
+
+Run from the repo root:
+    python -m benchmarks.bench_fine_tune --max-steps 10
+"""
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import NoReturn
+
+import torch
+from datasets import Dataset
+
+# src/ scripts import their siblings as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from fine_tune import train
+from fine_tuning_config import FineTuningConfig
+from packing import ThroughputCallback
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+OPTIONS = {
+    "baseline": {},
+    "gradient checkpointing": {"gradient_checkpointing": True},
+    "2 dataloader workers": {"dataloader_num_workers": 2},
+    "batch size search": {"auto_find_batch_size": True},
+    "packing": {"packing": True},
+    "fused adamw (cuda)": {"optimizer": "adamw_torch_fused"}
+}
+
+
+def save_samples(path: str, num_samples: int) -> NoReturn:
+    # Dialogues of different lengths, as in the prepared data
+    samples = [prompt + " Sounds great! </s>"
+               for num_turns in (1, 2, 4, 8)
+               for prompt in sample_prompts(num_samples // 4, num_turns)]
+    Dataset.from_dict({"sample": samples}).save_to_disk(path)
+
+
+def run_option(config: FineTuningConfig,
+               results: multiprocessing.Queue) -> NoReturn:
+    start = time.perf_counter()
+    trainer = train(config)
+    elapsed = time.perf_counter() - start
+    callback = next(callback
+                    for callback in trainer.callback_handler.callbacks
+                    if isinstance(callback, ThroughputCallback))
+    results.put({"seconds": elapsed,
+                 "batch_size": trainer._train_batch_size,
+                 **callback.stats()})
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--num-samples", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-seq-length", type=int, default=256)
+    parser.add_argument("--max-steps", type=int, default=10)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_path = str(Path(work_dir).joinpath("base"))
+        build_tiny_llama(save_dir=model_path,
+                         hidden_size=args.hidden_size,
+                         num_hidden_layers=args.num_layers)
+        data_path = str(Path(work_dir).joinpath("samples.hf"))
+        save_samples(data_path, args.num_samples)
+
+        config = FineTuningConfig(
+            model_name=model_path,
+            device_map=None,
+            load_in_8bit=False,
+            torch_dtype=torch.float32,
+            train_data_path=data_path,
+            eval_data_path=data_path,
+            per_device_train_batch_size=args.batch_size,
+            max_seq_length=args.max_seq_length,
+            gradient_accumulation_steps=1,
+            warmup_steps=0,
+            max_steps=args.max_steps,
+            optimizer="adamw_torch",
+            fp16=False,
+            logging_steps=max(args.max_steps // 2, 1),
+            output_dir=str(Path(work_dir).joinpath("out")) + "/",
+            use_wandb=False
+        )
+
+        print(f"{'option':>24} {'seconds':>8} {'batch':>6} {'tokens/s':>9} "
+              f"{'padding eff.':>13} {'peak MiB':>9}")
+        for name, options in OPTIONS.items():
+            if options.get("optimizer") == "adamw_torch_fused" and \
+                    not torch.cuda.is_available():
+                print(f"{name:>24} skipped, needs CUDA")
+                continue
+            results = context.Queue()
+            process = context.Process(target=run_option,
+                                      args=(replace(config, **options),
+                                            results))
+            process.start()
+            process.join()
+            if process.exitcode:
+                print(f"{name:>24} failed with exit code {process.exitcode}")
+                continue
+            stats = results.get()
+            print(f"{name:>24} {stats['seconds']:8.1f} "
+                  f"{stats['batch_size']:6d} "
+                  f"{stats['tokens_per_second']:9.0f} "
+                  f"{stats['padding_efficiency']:13.1%} "
+                  f"{stats['peak_memory_bytes'] / 2 ** 20:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Load test of history stores with synthetic users
+
+Run from the repo root:
+    python -m benchmarks.bench_history_store --num-users 100000
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import List, NoReturn
+
+from conversation import Conversation
+from history_store import (
+    HistoryStore,
+    InMemoryHistoryStore,
+    SQLiteHistoryStore,
+    UserHistory
+)
+from benchmarks.tiny_llama import build_tiny_tokenizer, SAMPLE_MESSAGES
+from src.prompt_templates import INIT_SYSTEM_PROMPT
+
+
+def percentiles(timings: List[float]) -> str:
+    quantiles = statistics.quantiles(timings, n=100)
+    return f"p50 {quantiles[49] * 1e6:.1f}us, p99 {quantiles[98] * 1e6:.1f}us"
+
+
+def fill(store: HistoryStore, num_users: int, turns_per_user: int) -> NoReturn:
+    """
+    Write synthetic conversations, timing every per-message write
+    """
+    timings = []
+    start = time.perf_counter()
+    for user_id in range(num_users):
+        store.reset(user_id)
+        for turn in range(turns_per_user):
+            message = SAMPLE_MESSAGES[(user_id + turn) % len(SAMPLE_MESSAGES)]
+            t = time.perf_counter()
+            store.append_turn(user_id, message, message, 2 * (turn + 1))
+            timings.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    print(f"  wrote {num_users} users in {elapsed:.1f}s, "
+          f"append_turn {percentiles(timings)}")
+
+
+def read_back(store: HistoryStore, num_users: int, num_reads: int) -> NoReturn:
+    timings = []
+    for user_id in random.sample(range(num_users), num_reads):
+        t = time.perf_counter()
+        store.load(user_id, max_turns=200)
+        timings.append(time.perf_counter() - t)
+    print(f"  load {percentiles(timings)}")
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-users", type=int, default=100000)
+    parser.add_argument("--turns-per-user", type=int, default=3)
+    parser.add_argument("--num-reads", type=int, default=1000)
+    parser.add_argument("--max-hot-users", type=int, default=1000)
+    args = parser.parse_args()
+
+    print("memory store")
+    store = InMemoryHistoryStore()
+    fill(store, args.num_users, args.turns_per_user)
+    read_back(store, args.num_users, args.num_reads)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir).joinpath("history.sqlite3")
+        print("sqlite store")
+        store = SQLiteHistoryStore(path)
+        fill(store, args.num_users, args.turns_per_user)
+        store.close()
+        print(f"  database size {path.stat().st_size / 1024 ** 2:.1f} MiB")
+
+        # Restart: a new process opens the same file
+        store = SQLiteHistoryStore(path)
+        assert len(store) == args.num_users
+        read_back(store, args.num_users, args.num_reads)
+
+        print(f"hot LRU of {args.max_hot_users} users over sqlite")
+        tokenizer = build_tiny_tokenizer()
+        user_history = UserHistory(
+            store,
+            lambda msg_count: Conversation(tokenizer, INIT_SYSTEM_PROMPT),
+            max_hot_users=args.max_hot_users
+        )
+        tracemalloc.start()
+        timings = []
+        for user_id in random.sample(range(args.num_users),
+                                     args.num_reads * 10):
+            t = time.perf_counter()
+            conversation = user_history.get(user_id)
+            user_segment = conversation.user_segment("hello")
+            user_history.append(user_id, user_history.epoch(user_id),
+                                "hello", user_segment, "hi")
+            timings.append(time.perf_counter() - t)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  page-in + message {percentiles(timings)}, "
+              f"{len(user_history)} hot users, "
+              f"peak traced memory {peak / 1024 ** 2:.1f} MiB")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
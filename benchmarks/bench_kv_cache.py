@@ -0,0 +1,75 @@
+"""
+Time-to-first-token against turn number with and without per-user KV-cache
+
+Run from the repo root:
+    python -m benchmarks.bench_kv_cache --num-turns 30
+"""
+import argparse
+import time
+from typing import List, NoReturn
+
+from transformers import pipeline
+
+from generation import ReplyGenerator
+from kv_cache import UserKVCache
+from benchmarks.tiny_llama import build_tiny_llama, SAMPLE_MESSAGES
+from src.prompt_templates import (
+    INIT_SYSTEM_PROMPT,
+    USER_PROMPT,
+    MODEL_OUTPUT
+)
+
+
+def time_to_first_token(generator: ReplyGenerator,
+                        num_turns: int) -> List[float]:
+    """
+    Simulate one conversation and time a single-token generation per turn
+    """
+    timings = []
+    prompt = INIT_SYSTEM_PROMPT
+    for turn in range(num_turns):
+        message = SAMPLE_MESSAGES[turn % len(SAMPLE_MESSAGES)]
+        prompt = prompt + " " + USER_PROMPT.format(user_message=message)
+        start = time.perf_counter()
+        generator(0, prompt)
+        timings.append(time.perf_counter() - start)
+        # Fixed reply keeps both runs on identical transcripts
+        reply = SAMPLE_MESSAGES[(turn + 3) % len(SAMPLE_MESSAGES)]
+        prompt = prompt + " " + MODEL_OUTPUT.format(model_output=reply)
+    return timings
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-turns", type=int, default=30)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=4)
+    args = parser.parse_args()
+
+    model, tokenizer = build_tiny_llama(hidden_size=args.hidden_size,
+                                        num_hidden_layers=args.num_layers)
+    model_pipeline = pipeline("text-generation", model=model,
+                              tokenizer=tokenizer)
+    inference_params = {"do_sample": False, "max_new_tokens": 1,
+                        "use_cache": True}
+
+    no_cache = time_to_first_token(
+        ReplyGenerator(model_pipeline, inference_params),
+        args.num_turns
+    )
+    user_cache = UserKVCache(max_bytes=1024 ** 3)
+    with_cache = time_to_first_token(
+        ReplyGenerator(model_pipeline, inference_params, user_cache),
+        args.num_turns
+    )
+
+    print(f"{'turn':>4} {'no cache, ms':>14} {'kv-cache, ms':>14}")
+    for turn, (a, b) in enumerate(zip(no_cache, with_cache), start=1):
+        print(f"{turn:>4} {a * 1000:14.2f} {b * 1000:14.2f}")
+    print(f"cache: {len(user_cache)} users, "
+          f"{user_cache.nbytes / 1024:.1f} KiB, "
+          f"hits {user_cache.hits}, misses {user_cache.misses}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Overhead of recording metrics on the reply path and of a scrape
+
+Run from the repo root:
+    python -m benchmarks.bench_metrics
+"""
+import argparse
+import time
+import urllib.request
+from typing import NoReturn
+
+from metrics import (
+    MetricsRegistry,
+    register_process_metrics,
+    start_http_server
+)
+
+
+def time_calls(registry: MetricsRegistry, num_calls: int) -> float:
+    """
+    Seconds per reply worth of metric calls: four phase timings, one
+    plain observation and one counter increment
+    """
+    phases = registry.histogram("phase_seconds", "Phase duration",
+                                labelnames=("phase",))
+    children = [phases.labels(phase)
+                for phase in ("prompt_build", "tokenize", "generate", "send")]
+    prompt_tokens = registry.histogram("prompt_tokens", "Prompt length",
+                                       buckets=(128, 256, 512, 1024, 2048))
+    replies = registry.counter("replies_total", "Replies sent")
+    start = time.perf_counter()
+    for i in range(num_calls):
+        for child in children:
+            with child.time():
+                pass
+        prompt_tokens.observe(i % 4096)
+        replies.inc()
+    return (time.perf_counter() - start) / num_calls
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-calls", type=int, default=100000)
+    parser.add_argument("--num-scrapes", type=int, default=100)
+    args = parser.parse_args()
+
+    disabled = time_calls(MetricsRegistry(enabled=False), args.num_calls)
+    registry = MetricsRegistry()
+    enabled = time_calls(registry, args.num_calls)
+    print(f"disabled {disabled * 1e6:.2f}us per reply, "
+          f"enabled {enabled * 1e6:.2f}us per reply")
+
+    register_process_metrics(registry)
+    server = start_http_server(registry, port=0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+    start = time.perf_counter()
+    for _ in range(args.num_scrapes):
+        with urllib.request.urlopen(url) as response:
+            body = response.read()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print(f"scrape {elapsed / args.num_scrapes * 1000:.2f}ms, "
+          f"{len(body)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Padding efficiency of fine-tuning batches: random order, length-grouped
+sampler and packed blocks
+
+Run from the repo root:
+    python -m benchmarks.bench_packing --batch-size 2 --max-seq-length 1024
+"""
+import argparse
+import random
+import sys
+from pathlib import Path
+from typing import List, NoReturn
+
+from datasets import load_from_disk
+from transformers.trainer_pt_utils import LengthGroupedSampler
+
+# src/ scripts import their siblings as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from packing import pack_sequences
+from benchmarks.tiny_llama import build_tiny_tokenizer
+
+
+def padding_efficiency(lengths: List[int],
+                       order: List[int],
+                       batch_size: int) -> float:
+    """
+    Real tokens over tokens of batches padded to their longest sample
+    """
+    total = 0
+    for start in range(0, len(order), batch_size):
+        batch = [lengths[i] for i in order[start:start + batch_size]]
+        total += max(batch) * len(batch)
+    return sum(lengths) / total
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", default="data/validation.hf")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--max-seq-length", type=int, default=1024)
+    args = parser.parse_args()
+
+    random.seed(42)
+    tokenizer = build_tiny_tokenizer()
+    samples = load_from_disk(args.data)["sample"]
+    input_ids = tokenizer(samples, truncation=True,
+                          max_length=args.max_seq_length).input_ids
+    lengths = [len(ids) for ids in input_ids]
+
+    order = list(range(len(lengths)))
+    random.shuffle(order)
+    print(f"random order:   "
+          f"{padding_efficiency(lengths, order, args.batch_size):.1%}")
+
+    sampler = LengthGroupedSampler(args.batch_size, lengths=lengths)
+    print(f"length-grouped: "
+          f"{padding_efficiency(lengths, list(sampler), args.batch_size):.1%}")
+
+    # Packing runs over map batches of 1000 samples as in fine_tune.py
+    blocks = []
+    for start in range(0, len(input_ids), 1000):
+        blocks.extend(pack_sequences(
+            {"input_ids": input_ids[start:start + 1000]},
+            args.max_seq_length
+        )["input_ids"])
+    block_lengths = [len(block) for block in blocks]
+    order = list(range(len(blocks)))
+    random.shuffle(order)
+    print(f"packed:         "
+          f"{padding_efficiency(block_lengths, order, args.batch_size):.1%}"
+          f" ({len(blocks)} blocks for {len(lengths)} samples)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Per-turn response post-processing cost against conversation length:
+decoding the whole transcript and splitting on "[/INST]" vs decoding
+only the new tokens
+
+Run from the repo root:
+    python -m benchmarks.bench_postprocessing
+"""
+import argparse
+import time
+from typing import Callable, List, NoReturn
+
+from stopping import StopSequenceChecker, truncate_at_stop
+from benchmarks.tiny_llama import build_tiny_tokenizer, sample_prompts
+
+STOP_SEQUENCES = ["</s>", "[INST]"]
+
+
+def best_time(fn: Callable[[], object], repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-turns", type=int, default=64)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    tokenizer = build_tiny_tokenizer()
+    checker = StopSequenceChecker(tokenizer, STOP_SEQUENCES)
+    reply_ids = tokenizer(
+        "I am so glad you wrote to me today, tell me more about it!" * 4,
+        add_special_tokens=False
+    ).input_ids[:args.reply_tokens]
+
+    print(f"{'turns':>6s} {'prompt tokens':>14s} {'full text + split':>18s} "
+          f"{'new tokens':>11s} {'stop checks':>12s}")
+    num_turns = 1
+    while num_turns <= args.max_turns:
+        prompt_ids = tokenizer(sample_prompts(1, num_turns)[0]).input_ids
+        output_ids = prompt_ids + reply_ids
+
+        def full_text() -> str:
+            text = tokenizer.decode(output_ids, skip_special_tokens=True)
+            return text.split("[/INST]")[-1].strip()
+
+        def new_tokens() -> str:
+            text = tokenizer.decode(output_ids[len(prompt_ids):],
+                                    skip_special_tokens=True)
+            return truncate_at_stop(text, STOP_SEQUENCES).strip()
+
+        def stop_checks() -> List[bool]:
+            # What the stopping criteria costs over the whole reply
+            return [checker(reply_ids[:n])
+                    for n in range(1, len(reply_ids) + 1)]
+
+        print(f"{num_turns:6d} {len(prompt_ids):14d} "
+              f"{best_time(full_text, args.repeats) * 1e6:16.1f}us "
+              f"{best_time(new_tokens, args.repeats) * 1e6:9.1f}us "
+              f"{best_time(stop_checks, args.repeats) * 1e6:10.1f}us")
+        num_turns *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Time-to-first-token of first turns with and without system prompt prefix cache
+
+Run from the repo root:
+    python -m benchmarks.bench_prefix_cache --num-users 50
+"""
+import argparse
+import time
+from typing import NoReturn
+
+from transformers import pipeline
+
+from generation import ReplyGenerator
+from kv_cache import PrefixCache
+from benchmarks.tiny_llama import build_tiny_llama, SAMPLE_MESSAGES
+from src.prompt_templates import (
+    INIT_SYSTEM_PROMPT,
+    CLOSE_SYSTEM_PROMPT,
+    FLIRTY_SYSTEM_PROMPT,
+    USER_PROMPT
+)
+
+SYSTEM_PROMPTS = {
+    "init": INIT_SYSTEM_PROMPT,
+    "close": CLOSE_SYSTEM_PROMPT,
+    "flirty": FLIRTY_SYSTEM_PROMPT
+}
+
+
+def run(generator: ReplyGenerator, num_users: int) -> float:
+    """
+    Send one first message per user, return mean time-to-first-token
+    """
+    system_prompts = list(SYSTEM_PROMPTS.values())
+    start = time.perf_counter()
+    for user_id in range(num_users):
+        message = SAMPLE_MESSAGES[user_id % len(SAMPLE_MESSAGES)]
+        prompt = system_prompts[user_id % len(system_prompts)] + \
+            " " + \
+            USER_PROMPT.format(user_message=message)
+        generator(user_id, prompt)
+    return (time.perf_counter() - start) / num_users
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-users", type=int, default=50)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=4)
+    args = parser.parse_args()
+
+    model, tokenizer = build_tiny_llama(hidden_size=args.hidden_size,
+                                        num_hidden_layers=args.num_layers)
+    model_pipeline = pipeline("text-generation", model=model,
+                              tokenizer=tokenizer)
+    inference_params = {"do_sample": False, "max_new_tokens": 1,
+                        "use_cache": True}
+
+    baseline = run(ReplyGenerator(model_pipeline, inference_params),
+                   args.num_users)
+
+    prefix_cache = PrefixCache()
+    generator = ReplyGenerator(model_pipeline, inference_params,
+                               prefix_cache=prefix_cache)
+    for name, system_prompt in SYSTEM_PROMPTS.items():
+        generator.register_prefix(name, system_prompt)
+    cached = run(generator, args.num_users)
+
+    print(f"no prefix cache: {baseline * 1000:.2f} ms/request")
+    print(f"prefix cache:    {cached * 1000:.2f} ms/request")
+    print(f"stats: {prefix_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Data preparation time: previous serial pandas script vs vectorized and
+parallel preparation, and a re-run with unchanged inputs
+
+Synthetic datasets in the empathetic_dialogues and daily_dialog schemas
+are saved locally, so no network access is needed.
+
+Run from the repo root:
+    python -m benchmarks.bench_prepare_data --num-convs 20000 --num-proc 4
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import NoReturn
+
+from datasets import (
+    Dataset,
+    DatasetDict,
+    concatenate_datasets,
+    load_from_disk
+)
+
+# src/ scripts import their siblings as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from prepare_data import (
+    NEGATIVE_CONTEXTS,
+    concat_dialogue,
+    load_source,
+    prepare_data
+)
+from prompt_templates import EMPATHETIC_SYSTEM_PROMPT, DAILY_SYSTEM_PROMPT
+from benchmarks.tiny_llama import SAMPLE_MESSAGES
+
+SPLITS = ("train", "validation", "test")
+CONTEXTS = NEGATIVE_CONTEXTS + ["joyful", "grateful", "hopeful", "proud",
+                                "lonely", "nostalgic", "surprised", "content"]
+
+
+def synthetic_empathetic(num_convs: int) -> Dataset:
+    rows = {"conv_id": [], "utterance_idx": [], "context": [],
+            "utterance": []}
+    for conv in range(num_convs):
+        context = random.choice(CONTEXTS)
+        for idx in range(random.randint(1, 8)):
+            rows["conv_id"].append(f"hit:{conv}_conv:{conv * 2}")
+            rows["utterance_idx"].append(idx + 1)
+            rows["context"].append(context)
+            rows["utterance"].append(
+                random.choice(SAMPLE_MESSAGES).replace(",", "_comma_")
+            )
+    return Dataset.from_dict(rows)
+
+
+def synthetic_daily(num_dialogs: int) -> Dataset:
+    dialogs = [[random.choice(SAMPLE_MESSAGES) + " "
+                for _ in range(random.randint(2, 12))]
+               for _ in range(num_dialogs)]
+    return Dataset.from_dict({"dialog": dialogs})
+
+
+def legacy_prepare_empathetic_dataset(dataset: Dataset) -> Dataset:
+    """
+    Previous implementation: pandas groupby().apply with Python loops
+    """
+    dataset.set_format("pandas")
+    df = dataset[:]
+    df = df[~df.context.isin(NEGATIVE_CONTEXTS)]
+    conv_sizes = df.groupby(["conv_id"]).size()
+    convs2keep = conv_sizes[conv_sizes > 1].index
+    df = df[df.conv_id.isin(convs2keep)]
+    df_grouped = df.groupby(["conv_id"]).utterance \
+                   .apply(
+        lambda x: concat_dialogue(x, EMPATHETIC_SYSTEM_PROMPT)
+        ).reset_index()
+    df_grouped = df_grouped.rename(columns={"utterance": "sample"})
+    df_grouped["sample"] = df_grouped["sample"].str.replace("_comma_", ", ")
+    df_grouped = df_grouped[["sample"]]
+    return Dataset.from_pandas(df_grouped)
+
+
+def legacy_prepare_daily_dataset(dataset: Dataset) -> Dataset:
+    """
+    Previous implementation: Series.apply over pandas rows
+    """
+    dataset.set_format("pandas")
+    df = dataset[:]
+    df_grouped = df.dialog.apply(
+        lambda x: concat_dialogue(x, DAILY_SYSTEM_PROMPT)
+        )
+    df_grouped = df_grouped.reset_index() \
+                           .drop(["index"], axis=1) \
+                           .rename(columns={"dialog": "sample"})
+    return Dataset.from_pandas(df_grouped)
+
+
+def legacy_prepare_data(sources: Path, output_dir: Path) -> NoReturn:
+    for split in SPLITS:
+        emp_dataset = load_source(str(sources / "empathetic"), split)
+        daily_dataset = load_source(str(sources / "daily"), split)
+        split_concat = concatenate_datasets([
+            legacy_prepare_empathetic_dataset(emp_dataset),
+            legacy_prepare_daily_dataset(daily_dataset)
+        ])
+        split_concat.save_to_disk(str(output_dir / f"{split}.hf"))
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-convs", type=int, default=20000,
+                        help="conversations of each dataset in train")
+    parser.add_argument("--num-proc", type=int, default=4)
+    args = parser.parse_args()
+
+    random.seed(42)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        # Validation and test are a tenth of train as in the real data
+        sizes = {"train": args.num_convs,
+                 "validation": args.num_convs // 10,
+                 "test": args.num_convs // 10}
+        DatasetDict({split: synthetic_empathetic(size)
+                     for split, size in sizes.items()}) \
+            .save_to_disk(str(tmp_dir / "sources" / "empathetic"))
+        DatasetDict({split: synthetic_daily(size)
+                     for split, size in sizes.items()}) \
+            .save_to_disk(str(tmp_dir / "sources" / "daily"))
+
+        start = time.perf_counter()
+        legacy_prepare_data(tmp_dir / "sources", tmp_dir / "legacy")
+        legacy = time.perf_counter() - start
+
+        timings = {}
+        for run in ("first run", "unchanged re-run"):
+            start = time.perf_counter()
+            prepare_data(output_dir=tmp_dir / "new",
+                         empathetic_source=str(tmp_dir / "sources" /
+                                               "empathetic"),
+                         daily_source=str(tmp_dir / "sources" / "daily"),
+                         num_proc=args.num_proc)
+            timings[run] = time.perf_counter() - start
+
+        for split in SPLITS:
+            old = load_from_disk(str(tmp_dir / "legacy" / f"{split}.hf"))
+            new = load_from_disk(str(tmp_dir / "new" / f"{split}.hf"))
+            assert old["sample"] == new["sample"], f"'{split}' differs"
+
+    print(f"legacy serial pandas: {legacy:.2f}s")
+    for run, seconds in timings.items():
+        print(f"parallel, {run}: {seconds:.2f}s "
+              f"({legacy / seconds:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
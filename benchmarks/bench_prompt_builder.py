@@ -0,0 +1,107 @@
+"""
+Per-turn prompt build + tokenize cost: prompt text tokenized by the
+generator vs token ids concatenated from pre-tokenized segments
+
+Uses the tiny fast tokenizer, or a real model tokenizer with `--model`
+to compare the slow SentencePiece and the fast Rust ones.
+
+Run from the repo root:
+    python -m benchmarks.bench_prompt_builder
+    python -m benchmarks.bench_prompt_builder \
+        --model meta-llama/Llama-2-7b-chat-hf
+"""
+import argparse
+import os
+import time
+from typing import Dict, NoReturn
+
+from benchmarks.tiny_llama import build_tiny_tokenizer, SAMPLE_MESSAGES
+from src.prompt_templates import (
+    INIT_SYSTEM_PROMPT,
+    CLOSE_SYSTEM_PROMPT,
+    FLIRTY_SYSTEM_PROMPT
+)
+
+# utils reads the token at import time, local models don't need it
+os.environ.setdefault("HF_AUTH_TOKEN", "")
+from utils import get_tokenizer  # noqa: E402
+from conversation import Conversation  # noqa: E402
+from prompt_builder import PromptBuilder, prompt_ids  # noqa: E402
+
+SYSTEM_PROMPTS = {
+    "init": INIT_SYSTEM_PROMPT,
+    "close": CLOSE_SYSTEM_PROMPT,
+    "flirty": FLIRTY_SYSTEM_PROMPT
+}
+
+
+def run_turns(tokenizer,
+              num_turns: int,
+              max_tokens: int,
+              builder: PromptBuilder = None) -> Dict[str, float]:
+    """
+    Seconds per turn to build and tokenize prompts of one conversation,
+    and the share of turns whose ids match tokenizing the prompt text
+    """
+    start = time.perf_counter()
+    if builder is None:
+        conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT,
+                                    max_tokens=max_tokens)
+    else:
+        conversation = Conversation(tokenizer, builder.system_prompt("init"),
+                                    max_tokens=max_tokens,
+                                    prompt_builder=builder)
+    created = time.perf_counter()
+
+    elapsed = 0.0
+    matches = 0
+    for turn in range(num_turns):
+        message = SAMPLE_MESSAGES[turn % len(SAMPLE_MESSAGES)]
+        turn_start = time.perf_counter()
+        user_segment = conversation.user_segment(message)
+        if builder is None:
+            input_ids = prompt_ids(
+                tokenizer, conversation.build_prompt(pending=user_segment)
+            )
+        else:
+            input_ids = conversation.build_input_ids(pending=user_segment)
+        elapsed += time.perf_counter() - turn_start
+
+        text = conversation.build_prompt(pending=user_segment)
+        matches += input_ids == tokenizer(text).input_ids
+        conversation.append(user_segment, conversation.model_segment(message))
+    return {"create": created - start,
+            "turn": elapsed / num_turns,
+            "matches": matches / num_turns}
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=None,
+                        help="load this model's tokenizers")
+    parser.add_argument("--num-turns", type=int, default=200)
+    parser.add_argument("--max-tokens", type=int, default=3896)
+    args = parser.parse_args()
+
+    if args.model is None:
+        tokenizers = {"fast (tiny)": build_tiny_tokenizer()}
+    else:
+        tokenizers = {
+            "slow": get_tokenizer(args.model, use_fast_tokenizer=False),
+            "fast": get_tokenizer(args.model, use_fast_tokenizer=True)
+        }
+
+    print(f"{'tokenizer':>12} {'prompt':>6} {'new conv, ms':>13} "
+          f"{'ms/turn':>8} {'ids match text':>15}")
+    for name, tokenizer in tokenizers.items():
+        builder = PromptBuilder(tokenizer, SYSTEM_PROMPTS)
+        for prompt, turn_builder in (("text", None), ("ids", builder)):
+            stats = run_turns(tokenizer, args.num_turns, args.max_tokens,
+                              turn_builder)
+            print(f"{name:>12} {prompt:>6} {stats['create'] * 1000:13.3f} "
+                  f"{stats['turn'] * 1000:8.3f} "
+                  f"{stats['matches'] * 100:14.1f}%")
+
+
+if __name__ == "__main__":
+    main()
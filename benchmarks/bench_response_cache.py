@@ -0,0 +1,47 @@
+"""
+Response cache hit rate on the first messages of test dialogues
+
+Run from the repo root:
+    python -m benchmarks.bench_response_cache --generation-time 4.0
+"""
+import argparse
+import random
+from typing import NoReturn
+
+from datasets import load_from_disk
+
+from conversation import Conversation
+from response_cache import ResponseCache
+from benchmarks.tiny_llama import build_tiny_tokenizer
+from src.prompt_templates import INIT_SYSTEM_PROMPT
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", default="data/test.hf")
+    parser.add_argument("--num-variants", type=int, default=3)
+    parser.add_argument("--generation-time", type=float, default=4.0,
+                        help="seconds per generated response")
+    args = parser.parse_args()
+
+    random.seed(42)
+    tokenizer = build_tiny_tokenizer()
+    cache = ResponseCache(num_variants=args.num_variants)
+    samples = load_from_disk(args.data)["sample"]
+    for sample in samples:
+        # First user message of "<system prompt> user [/INST] model ..."
+        message = sample.split("<</SYS>>")[-1].split("[/INST]")[0].strip()
+        conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT)
+        key = cache.key(conversation, message)
+        if cache.get(key) is None:
+            cache.put(key, f"response {random.random()}",
+                      args.generation_time)
+
+    stats = cache.stats()
+    print(f"{len(samples)} first messages, {stats['entries']} keys, "
+          f"hit rate {stats['hit_rate']:.1%}, "
+          f"{stats['seconds_saved'] / 3600:.2f} GPU hours saved")
+
+
+if __name__ == "__main__":
+    main()
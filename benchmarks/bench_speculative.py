@@ -0,0 +1,92 @@
+"""
+Speculative decoding vs plain greedy generate: acceptance rate and tok/s
+
+The draft model keeps only the first layer of the main model, so its
+proposals are related to the main model like a distilled draft would be.
+
+Run from the repo root:
+    python -m benchmarks.bench_speculative
+"""
+import argparse
+import time
+from typing import NoReturn
+
+import torch
+
+from batching import build_logits_processor
+from speculative import (
+    ModelDrafter,
+    NgramDrafter,
+    SpeculativeStats,
+    speculative_generate
+)
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--num-layers", type=int, default=8)
+    parser.add_argument("--num-prompts", type=int, default=8)
+    parser.add_argument("--num-turns", type=int, default=6)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--num-draft-tokens", type=int, default=5)
+    parser.add_argument("--repetition-penalty", type=float, default=1.15)
+    args = parser.parse_args()
+
+    model, tokenizer = build_tiny_llama(hidden_size=args.hidden_size,
+                                        num_hidden_layers=args.num_layers)
+    draft_model, _ = build_tiny_llama(hidden_size=args.hidden_size,
+                                      num_hidden_layers=1)
+    draft_model.load_state_dict(model.state_dict(), strict=False)
+
+    prompts = [tokenizer(prompt).input_ids
+               for prompt in sample_prompts(args.num_prompts, args.num_turns)]
+    logits_processor = build_logits_processor(
+        {"repetition_penalty": args.repetition_penalty}
+    )
+
+    start = time.perf_counter()
+    references = []
+    with torch.no_grad():
+        for input_ids in prompts:
+            output = model.generate(
+                torch.tensor([input_ids]),
+                attention_mask=torch.ones((1, len(input_ids)),
+                                          dtype=torch.long),
+                do_sample=False,
+                max_new_tokens=args.max_new_tokens,
+                repetition_penalty=args.repetition_penalty,
+                pad_token_id=tokenizer.eos_token_id
+            )
+            references.append(output[0, len(input_ids):].tolist())
+    elapsed = time.perf_counter() - start
+    num_tokens = sum(len(reference) for reference in references)
+    print(f"greedy generate:  {num_tokens / elapsed:7.1f} tok/s")
+
+    drafters = {
+        "ngram lookup": NgramDrafter(args.num_draft_tokens),
+        "draft model": ModelDrafter(draft_model, args.num_draft_tokens),
+    }
+    for name, drafter in drafters.items():
+        stats = SpeculativeStats()
+        start = time.perf_counter()
+        outputs = [
+            speculative_generate(model,
+                                 input_ids,
+                                 drafter,
+                                 max_new_tokens=args.max_new_tokens,
+                                 eos_token_id=tokenizer.eos_token_id,
+                                 logits_processor=logits_processor,
+                                 stats=stats)
+            for input_ids in prompts
+        ]
+        elapsed = time.perf_counter() - start
+        print(f"{name + ':':17s} {stats.generated / elapsed:7.1f} tok/s, "
+              f"acceptance rate {stats.acceptance_rate:.2f}, "
+              f"{stats.tokens_per_pass:.2f} tokens per pass, "
+              f"same output: {outputs == references}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Perceived latency with and without streaming, measured on a fake Telegram bot
+
+Run from the repo root:
+    python -m benchmarks.bench_streaming --max-new-tokens 200
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import NoReturn
+
+from transformers import pipeline
+
+from generation import ReplyGenerator
+from inference_worker import InferenceWorker
+from streaming import AsyncTextStreamer, ProgressiveMessage
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+
+class FakeBot:
+    """
+    Records sent and edited messages instead of calling Telegram
+    """
+
+    def __init__(self):
+        self.events = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.events.append(("send", time.perf_counter(), text))
+        return SimpleNamespace(message_id=len(self.events), chat_id=chat_id)
+
+    async def edit_message_text(self, text: str, chat_id: int,
+                                message_id: int, **kwargs):
+        self.events.append(("edit", time.perf_counter(), text))
+
+
+async def respond(worker: InferenceWorker,
+                  tokenizer,
+                  prompt: str,
+                  stream: bool,
+                  edit_interval: float) -> dict:
+    bot = FakeBot()
+    start = time.perf_counter()
+    if stream:
+        message = ProgressiveMessage(bot, chat_id=0,
+                                     edit_interval=edit_interval)
+        streamer = AsyncTextStreamer(tokenizer)
+        consumer = asyncio.create_task(message.consume(streamer))
+        try:
+            response = await worker.submit(0, prompt, streamer=streamer)
+        finally:
+            streamer.close()
+            await consumer
+        await message.finish(response)
+    else:
+        response = await worker.submit(0, prompt)
+        await bot.send_message(chat_id=0, text=response)
+
+    return {
+        "first_message_ms": (bot.events[0][1] - start) * 1000,
+        "final_text_ms": (bot.events[-1][1] - start) * 1000,
+        "edits": sum(event[0] == "edit" for event in bot.events),
+        "matches_response": bot.events[-1][2] == response.strip()
+    }
+
+
+async def run(args: argparse.Namespace) -> NoReturn:
+    model, tokenizer = build_tiny_llama(hidden_size=args.hidden_size,
+                                        num_hidden_layers=args.num_layers)
+    model_pipeline = pipeline("text-generation", model=model,
+                              tokenizer=tokenizer)
+    inference_params = {"do_sample": False,
+                        "max_new_tokens": args.max_new_tokens,
+                        "use_cache": True}
+    worker = InferenceWorker(ReplyGenerator(model_pipeline, inference_params))
+    worker.start()
+    prompt = sample_prompts(1, num_turns=3)[0]
+    try:
+        for stream in (False, True):
+            result = await respond(worker, tokenizer, prompt, stream,
+                                   args.edit_interval)
+            name = "streaming" if stream else "single message"
+            print(f"{name:<15} {result}")
+    finally:
+        worker.stop()
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    parser.add_argument("--edit-interval", type=float, default=0.2)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=4)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Fine-tuning data startup: tokenizing the splits on every run vs building
+a memory-mapped token cache once and opening it
+
+Every mode runs in a fresh process and reports the time until the
+datasets are ready, the resident memory they added and the time to read
+every training sample once.
+
+Run from the repo root:
+    python -m benchmarks.bench_token_cache --data data/train.hf
+"""
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import NoReturn, Union
+
+from datasets import disable_caching
+from transformers import AutoTokenizer
+
+# src/ scripts import their siblings as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from fine_tune import load_and_tokenize_data
+from benchmarks.tiny_llama import build_tiny_tokenizer
+from metrics import resident_memory_bytes
+
+
+def run_mode(tokenizer_path: str,
+             data_path: str,
+             max_seq_length: Union[int, None],
+             token_cache_dir: Union[str, None],
+             results: multiprocessing.Queue) -> NoReturn:
+    # Tokenize every run as training does, not from map cache files
+    disable_caching()
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    memory_before = resident_memory_bytes()
+    start = time.perf_counter()
+    train_data, _ = load_and_tokenize_data(tokenizer,
+                                           train_data_path=data_path,
+                                           eval_data_path=data_path,
+                                           max_seq_length=max_seq_length,
+                                           token_cache_dir=token_cache_dir)
+    ready = time.perf_counter()
+    memory_ready = resident_memory_bytes()
+    num_tokens = sum(len(train_data[i]["input_ids"])
+                     for i in range(len(train_data)))
+    results.put({"startup": ready - start,
+                 "memory": memory_ready - memory_before,
+                 "epoch_read": time.perf_counter() - ready,
+                 "num_tokens": num_tokens})
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", default="data/train.hf")
+    parser.add_argument("--max-seq-length", type=int, default=None)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as work_dir:
+        tokenizer_path = str(Path(work_dir).joinpath("tokenizer"))
+        build_tiny_tokenizer().save_pretrained(tokenizer_path)
+        token_cache_dir = str(Path(work_dir).joinpath("token_cache"))
+
+        print(f"{'mode':>14} {'startup, s':>11} {'memory, MiB':>12} "
+              f"{'epoch read, s':>14} {'tokens':>10}")
+        for mode, cache_dir in (("tokenize", None),
+                                ("cache build", token_cache_dir),
+                                ("cache open", token_cache_dir)):
+            results = context.Queue()
+            process = context.Process(target=run_mode,
+                                      args=(tokenizer_path, args.data,
+                                            args.max_seq_length, cache_dir,
+                                            results))
+            process.start()
+            process.join()
+            if process.exitcode:
+                print(f"{mode:>14} failed with exit code {process.exitcode}")
+                continue
+            stats = results.get()
+            print(f"{mode:>14} {stats['startup']:11.2f} "
+                  f"{stats['memory'] / 2 ** 20:12.1f} "
+                  f"{stats['epoch_read']:14.2f} {stats['num_tokens']:10d}")
+
+
+if __name__ == "__main__":
+    main()
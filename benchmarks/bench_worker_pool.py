@@ -0,0 +1,107 @@
+"""
+Model worker processes on one box: throughput by number of workers and
+recovery when a worker is killed
+
+Run from the repo root:
+    python -m benchmarks.bench_worker_pool --num-workers 2
+"""
+import argparse
+import asyncio
+import functools
+import time
+from typing import List, NoReturn
+
+import torch
+from transformers import pipeline
+
+from generation import ReplyGenerator
+from worker_pool import ProcessWorkerPool
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+
+def tiny_reply_generator(max_new_tokens: int,
+                         num_threads: int) -> ReplyGenerator:
+    """
+    Runs inside every worker process
+    """
+    torch.set_num_threads(num_threads)
+    model, tokenizer = build_tiny_llama()
+    model_pipeline = pipeline("text-generation", model=model,
+                              tokenizer=tokenizer)
+    return ReplyGenerator(model_pipeline, {
+        "do_sample": False,
+        "max_new_tokens": max_new_tokens,
+        "repetition_penalty": 1.15,
+        "use_cache": True
+    })
+
+
+async def _submit_all(pool: ProcessWorkerPool,
+                      prompts: List[str]) -> List[str]:
+    return await asyncio.gather(*[
+        pool.submit(user_id, prompt) for user_id, prompt in enumerate(prompts)
+    ])
+
+
+async def _kill_during(pool: ProcessWorkerPool,
+                       prompts: List[str],
+                       victim: int) -> List[str]:
+    requests = asyncio.ensure_future(_submit_all(pool, prompts))
+    await asyncio.sleep(0.05)
+    pool._processes[victim].kill()
+    return await requests
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--num-requests", type=int, default=64)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    args = parser.parse_args()
+
+    prompts = sample_prompts(args.num_requests, num_turns=2)
+    factory = functools.partial(tiny_reply_generator,
+                                args.max_new_tokens,
+                                args.threads_per_worker)
+
+    for num_workers in sorted({1, args.num_workers}):
+        pool = ProcessWorkerPool(factory,
+                                 num_workers=num_workers,
+                                 max_queue_size=args.num_requests,
+                                 monitor_interval=0.2)
+        pool.start()
+        try:
+            start = time.perf_counter()
+            asyncio.run(_submit_all(pool, prompts))
+            elapsed = time.perf_counter() - start
+        finally:
+            pool.stop()
+        print(f"{num_workers} workers: "
+              f"{args.num_requests / elapsed:8.2f} req/s")
+
+    if args.num_workers < 2:
+        return
+    # Without restart the users of the killed worker stay rerouted
+    pool = ProcessWorkerPool(factory,
+                             num_workers=args.num_workers,
+                             max_queue_size=args.num_requests,
+                             restart_dead=False,
+                             monitor_interval=0.2)
+    pool.start()
+    try:
+        owners = [pool.worker_of(user_id) for user_id in range(len(prompts))]
+        start = time.perf_counter()
+        responses = asyncio.run(_kill_during(pool, prompts, victim=0))
+        elapsed = time.perf_counter() - start
+        moved = sum(pool.worker_of(user_id) != owner
+                    for user_id, owner in enumerate(owners))
+    finally:
+        pool.stop()
+    print(f"worker 0 killed: {len(responses)}/{len(prompts)} requests "
+          f"answered in {elapsed:.2f}s, {moved} users rerouted "
+          f"({owners.count(0)} were on worker 0)")
+
+
+if __name__ == "__main__":
+    main()
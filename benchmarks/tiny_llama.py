@@ -0,0 +1,136 @@
+"""
+Tiny randomly initialised LLaMa model and tokenizer for CPU benchmarks
+"""
+from pathlib import Path
+from typing import Iterable, List, Tuple, Union
+
+import torch
+from tokenizers import (
+    Tokenizer,
+    decoders,
+    models,
+    pre_tokenizers,
+    processors,
+    trainers
+)
+from transformers import (
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedTokenizerFast
+)
+
+from src.prompt_templates import (
+    INIT_SYSTEM_PROMPT,
+    CLOSE_SYSTEM_PROMPT,
+    FLIRTY_SYSTEM_PROMPT,
+    USER_PROMPT,
+    MODEL_OUTPUT
+)
+
+SAMPLE_MESSAGES = [
+    "Hi! How are you doing today?",
+    "I am so sleepy and tired after work :(",
+    "Chilling out sounds so good!",
+    "What do you usually do on weekends?",
+    "I have just watched a great movie, do you like sci-fi?",
+    "My cat keeps waking me up at 5 am every single day.",
+    "Tell me something nice, please",
+    "I think I am falling in love with cooking pasta"
+]
+
+
+def sample_corpus() -> Iterable[str]:
+    """
+    Text used to train the tiny tokenizer
+    """
+    yield from (INIT_SYSTEM_PROMPT, CLOSE_SYSTEM_PROMPT, FLIRTY_SYSTEM_PROMPT)
+    for message in SAMPLE_MESSAGES:
+        yield USER_PROMPT.format(user_message=message)
+        yield MODEL_OUTPUT.format(model_output=message)
+
+
+def build_tiny_tokenizer(vocab_size: int = 512) -> PreTrainedTokenizerFast:
+    """
+    Train a small byte-level BPE tokenizer offline
+
+    Args:
+        vocab_size (int, optional): Vocabulary size. Defaults to 512.
+
+    Returns:
+        PreTrainedTokenizerFast: tokenizer with LLaMa special tokens
+    """
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<unk>", "<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(sample_corpus(), trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A",
+        special_tokens=[("<s>", tokenizer.token_to_id("<s>"))]
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer,
+                                   bos_token="<s>",
+                                   eos_token="</s>",
+                                   unk_token="<unk>")
+
+
+def build_tiny_llama(
+        save_dir: Union[str, Path, None] = None,
+        hidden_size: int = 64,
+        num_hidden_layers: int = 2,
+        seed: int = 42
+        ) -> Tuple[LlamaForCausalLM, PreTrainedTokenizerFast]:
+    """
+    Build a tiny random LLaMa model for CPU tests and benchmarks
+
+    Args:
+        save_dir (Union[str, Path, None], optional): If given, save model and
+                                                     tokenizer there.
+                                                     Defaults to None.
+        hidden_size (int, optional): Hidden size. Defaults to 64.
+        num_hidden_layers (int, optional): Number of layers. Defaults to 2.
+        seed (int, optional): Random seed for weights. Defaults to 42.
+
+    Returns:
+        Tuple[LlamaForCausalLM, PreTrainedTokenizerFast]: model and tokenizer
+    """
+    torch.manual_seed(seed)
+    tokenizer = build_tiny_tokenizer()
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.unk_token_id
+    )
+    model = LlamaForCausalLM(config).eval()
+
+    if save_dir is not None:
+        model.save_pretrained(save_dir)
+        tokenizer.save_pretrained(save_dir)
+
+    return model, tokenizer
+
+
+def sample_prompts(num_prompts: int, num_turns: int = 1) -> List[str]:
+    """
+    Synthetic chat prompts in the bot format
+    """
+    prompts = []
+    for i in range(num_prompts):
+        prompt = INIT_SYSTEM_PROMPT
+        for turn in range(num_turns):
+            message = SAMPLE_MESSAGES[(i + turn) % len(SAMPLE_MESSAGES)]
+            if turn:
+                prompt += " " + MODEL_OUTPUT.format(model_output=message)
+            prompt += " " + USER_PROMPT.format(user_message=message)
+        prompts.append(prompt)
+    return prompts
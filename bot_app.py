@@ -0,0 +1,479 @@
+"""
+Telegram chat-bot handlers and their state, started by tg_bot.py
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import NoReturn
+
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram.ext import (
+    filters,
+    Application,
+    MessageHandler,
+    CommandHandler,
+    CallbackContext
+)
+
+from utils import get_tokenizer
+from bot_server import build_application, serve
+from admission import Admission, AdmissionController
+from adapters import AdapterRouter
+from response_cache import ResponseCache
+from metrics import (
+    MetricsRegistry,
+    register_process_metrics,
+    start_http_server
+)
+from inference_worker import (
+    InferenceWorker,
+    WorkerBusyError,
+    UserBusyError
+)
+from batching import BatchingInferenceWorker
+from worker_pool import ProcessWorkerPool
+from serving import build_reply_generator, log_generator_stats
+from generation import PHASE_SECONDS
+from conversation import Conversation
+from prompt_builder import PromptBuilder, Segment
+from history_store import UserHistory, get_history_store
+from transcript_logger import TranscriptLogger
+from streaming import AsyncTextStreamer, ProgressiveMessage
+from inference_config import (
+    MODEL_PATH,
+    ADAPTER_WEIGHTS_PATH,
+    ADAPTERS,
+    ADAPTER_ROUTING_PARAMS,
+    SERVING_ARTIFACT_PATH,
+    MODEL_INFERENCE_PARAMS,
+    STOP_SEQUENCES,
+    WORKER_POOL_PARAMS,
+    WORKER_MAX_QUEUE_SIZE,
+    BATCHING_PARAMS,
+    MAX_PROMPT_TOKENS,
+    STREAMING_PARAMS,
+    HISTORY_STORE_PARAMS,
+    TRANSCRIPT_LOG_PARAMS,
+    BOT_SERVING_PARAMS,
+    ADMISSION_PARAMS,
+    RESPONSE_CACHE_PARAMS,
+    METRICS_PARAMS
+)
+from src.prompt_templates import (
+    INIT_SYSTEM_PROMPT,
+    CLOSE_SYSTEM_PROMPT,
+    FLIRTY_SYSTEM_PROMPT
+)
+
+# Get bot token
+BOT_TOKEN = os.environ["BOT_TOKEN"]
+
+# Create logging structure
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# Metrics are cheap to record and scraped from a local endpoint
+metrics = MetricsRegistry(enabled=METRICS_PARAMS["enabled"])
+register_process_metrics(metrics)
+phase_seconds = metrics.histogram(PHASE_SECONDS,
+                                  "Duration of reply phases",
+                                  labelnames=("phase",))
+prompt_build_seconds = phase_seconds.labels("prompt_build")
+inference_seconds = phase_seconds.labels("inference")
+telegram_send_seconds = phase_seconds.labels("telegram_send")
+reply_seconds = metrics.histogram("bot_reply_seconds",
+                                  "Time from an admitted turn to the reply")
+
+# Generation runs off the event loop: in model worker processes or in a
+# thread of this process, so the bot stays responsive
+if WORKER_POOL_PARAMS["num_workers"]:
+    reply_generator = None
+    tokenizer = get_tokenizer(MODEL_PATH, ADAPTER_WEIGHTS_PATH,
+                              artifact_path=SERVING_ARTIFACT_PATH)
+    inference_worker = ProcessWorkerPool(
+        build_reply_generator,
+        num_workers=WORKER_POOL_PARAMS["num_workers"],
+        max_queue_size=WORKER_MAX_QUEUE_SIZE,
+        virtual_nodes=WORKER_POOL_PARAMS["virtual_nodes"],
+        restart_dead=WORKER_POOL_PARAMS["restart_dead"],
+        max_restarts=WORKER_POOL_PARAMS["max_restarts"],
+        restart_backoff=WORKER_POOL_PARAMS["restart_backoff"],
+        start_timeout=WORKER_POOL_PARAMS["start_timeout"]
+    )
+else:
+    reply_generator = build_reply_generator(metrics)
+    tokenizer = reply_generator.tokenizer
+    if BATCHING_PARAMS["enabled"]:
+        inference_worker = BatchingInferenceWorker(
+            reply_generator.model,
+            tokenizer,
+            MODEL_INFERENCE_PARAMS,
+            max_queue_size=WORKER_MAX_QUEUE_SIZE,
+            max_batch_size=BATCHING_PARAMS["max_batch_size"],
+            batch_window=BATCHING_PARAMS["batch_window_ms"] / 1000,
+            continuous=BATCHING_PARAMS["continuous"],
+            stop_sequences=STOP_SEQUENCES,
+            adapters=reply_generator.adapters
+        )
+    else:
+        inference_worker = InferenceWorker(
+            reply_generator,
+            max_queue_size=WORKER_MAX_QUEUE_SIZE
+        )
+
+# System prompts and template fragments are tokenized once for all users
+prompt_builder = PromptBuilder(tokenizer, {
+    "init": INIT_SYSTEM_PROMPT,
+    "close": CLOSE_SYSTEM_PROMPT,
+    "flirty": FLIRTY_SYSTEM_PROMPT
+})
+
+# Streaming needs the generation running in this process, without batching
+streaming_enabled = STREAMING_PARAMS["enabled"] and \
+    not BATCHING_PARAMS["enabled"] and not WORKER_POOL_PARAMS["num_workers"]
+
+
+def get_stage(msg_count: int) -> str:
+    """
+    Stage of the conversation: "init", "close" or "flirty"
+    """
+    if 10 < msg_count <= 30:
+        return "close"
+    elif msg_count > 30:
+        return "flirty"
+    return "init"
+
+
+def get_system_prompt(msg_count: int) -> Segment:
+    """
+    Tokenized system prompt for the current stage of the conversation
+    """
+    return prompt_builder.system_prompt(get_stage(msg_count))
+
+
+def new_conversation(msg_count: int = 0) -> Conversation:
+    """
+    Create an empty conversation with the system prompt of its stage
+    """
+    return Conversation(tokenizer,
+                        get_system_prompt(msg_count),
+                        max_tokens=MAX_PROMPT_TOKENS,
+                        prompt_builder=prompt_builder)
+
+
+# Conversations survive restarts, only recently active ones stay in memory
+user_history = UserHistory(
+    get_history_store(HISTORY_STORE_PARAMS),
+    new_conversation,
+    max_hot_users=HISTORY_STORE_PARAMS["max_hot_users"],
+    max_loaded_turns=HISTORY_STORE_PARAMS["max_loaded_turns"]
+)
+
+# Transcripts are appended to logs by a background task
+transcript_logger = TranscriptLogger(**TRANSCRIPT_LOG_PARAMS)
+
+# LoRA adapter answering each user if several are served
+adapter_router = AdapterRouter(**ADAPTER_ROUTING_PARAMS) if ADAPTERS else None
+
+# Rate limits, concurrency cap and merging of rapid messages
+admission = AdmissionController(**ADMISSION_PARAMS)
+
+# Responses to common openers are reused instead of generated
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_PARAMS["max_entries"],
+    ttl=RESPONSE_CACHE_PARAMS["ttl"],
+    num_variants=RESPONSE_CACHE_PARAMS["num_variants"],
+    max_turns=RESPONSE_CACHE_PARAMS["max_turns"]
+) if RESPONSE_CACHE_PARAMS["enabled"] else None
+
+metrics.gauge("bot_queue_depth",
+              "Requests waiting for the model",
+              fn=lambda: inference_worker.queue_depth)
+metrics.gauge("bot_running_generations",
+              "Generations holding an admission slot",
+              fn=lambda: admission.running)
+metrics.gauge("bot_active_conversations",
+              "Conversations kept in memory",
+              fn=lambda: len(user_history))
+metrics.gauge("bot_history_store_users",
+              "Users in the conversation history store",
+              fn=lambda: len(user_history.store))
+for decision in ("admitted", "coalesced", "rate_limited", "overloaded"):
+    metrics.counter(f"bot_messages_{decision}_total",
+                    f"User messages {decision.replace('_', ' ')}",
+                    fn=lambda decision=decision: getattr(admission, decision))
+if response_cache is not None:
+    metrics.counter("bot_response_cache_hits_total",
+                    "Responses served from the response cache",
+                    fn=lambda: response_cache.hits)
+    metrics.counter("bot_response_cache_misses_total",
+                    "Cacheable turns that were generated",
+                    fn=lambda: response_cache.misses)
+    metrics.counter("bot_response_cache_saved_seconds_total",
+                    "Generation time saved by the response cache",
+                    fn=lambda: response_cache.seconds_saved)
+metrics.counter("bot_transcripts_dropped_total",
+                "Transcript records dropped on a full buffer",
+                fn=lambda: transcript_logger.dropped)
+
+
+def invalidate_cache(user_id: int) -> NoReturn:
+    """
+    Drop cached keys/values of the user wherever the model runs
+    """
+    if reply_generator is not None:
+        reply_generator.invalidate(user_id)
+    elif isinstance(inference_worker, ProcessWorkerPool):
+        inference_worker.invalidate(user_id)
+
+
+async def start(update: Update, context: CallbackContext):
+    """
+    Implements /start command (button)
+    """
+    # Get user ID and set user history to initial state if no user_id found
+    user_id = update.effective_user.id
+    if user_history.get(user_id) is None:
+        user_history.reset(user_id)
+
+    # Button
+    reply_markup = ReplyKeyboardMarkup([[KeyboardButton("/start")]],
+                                       resize_keyboard=True)
+
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="I'm your AI-Friend. Let's have a chat!",
+        reply_markup=reply_markup
+        )
+
+
+async def respond(update: Update, context: CallbackContext):
+    """
+    Implements a response of the LLM to user message
+    """
+    user_id = update.effective_user.id
+
+    # Buttons
+    reply_markup = ReplyKeyboardMarkup([[KeyboardButton("/start"),
+                                         KeyboardButton("/clear")]],
+                                       resize_keyboard=True)
+
+    # Conversation might need a restart if the user never started it
+    conversation = user_history.get(user_id)
+    if conversation is None:
+        # If no user found, send message
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Please, restart the conversation using /start command",
+            reply_markup=reply_markup
+            )
+        return
+
+    admitted = admission.offer(user_id, update.message.text)
+    if admitted is Admission.RATE_LIMITED:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You're writing too fast, give me a moment to catch up",
+            reply_markup=reply_markup
+            )
+        return
+    if admitted is Admission.COALESCED:
+        # Answered together with the message that is already pending
+        return
+
+    # Answer everything the user sent meanwhile as a single turn
+    try:
+        if admission.coalesce_window > 0:
+            await asyncio.sleep(admission.coalesce_window)
+        while (text := admission.take(user_id)) is not None:
+            # Re-read, /clear might have replaced it since the last turn
+            conversation = user_history.get(user_id)
+            await reply(update, context, conversation, text, reply_markup)
+    except BaseException:
+        admission.discard(user_id)
+        raise
+
+
+async def reply(update: Update,
+                context: CallbackContext,
+                conversation: Conversation,
+                text: str,
+                reply_markup: ReplyKeyboardMarkup) -> NoReturn:
+    """
+    Generates and sends the response to the user message
+    """
+    user_id = update.effective_user.id
+    # /clear during the generation starts a new epoch
+    epoch = user_history.epoch(user_id)
+    start = time.perf_counter()
+
+    # Add user message to the history that fits into the token budget
+    with prompt_build_seconds.time():
+        user_segment = conversation.user_segment(text)
+        user_prompt = conversation.build_input_ids(pending=user_segment)
+
+    # Persona adapter for this turn, None for the default one
+    adapter = adapter_router.choose(user_id,
+                                    get_stage(conversation.msg_count)) \
+        if adapter_router is not None else None
+
+    # Common openers might be answered from the response cache
+    cache_key = response_cache.key(conversation, text, adapter) \
+        if response_cache is not None else None
+    response = response_cache.get(cache_key) \
+        if cache_key is not None else None
+
+    message = None
+    if response is None:
+        # Stream the response with message edits
+        generate_kwargs = {}
+        if adapter is not None:
+            generate_kwargs["adapter"] = adapter
+        if streaming_enabled:
+            message = ProgressiveMessage(
+                context.bot,
+                update.effective_chat.id,
+                reply_markup=reply_markup,
+                min_first_chars=STREAMING_PARAMS["min_first_chars"],
+                edit_interval=STREAMING_PARAMS["edit_interval"],
+                stop_sequences=STOP_SEQUENCES
+            )
+            streamer = AsyncTextStreamer(tokenizer)
+            consumer = asyncio.create_task(message.consume(streamer))
+            generate_kwargs["streamer"] = streamer
+
+        # Generate the response without blocking other updates
+        try:
+            async with admission.slot():
+                generation_start = time.perf_counter()
+                with inference_seconds.time():
+                    response = await inference_worker.submit(
+                        user_id,
+                        user_prompt,
+                        **generate_kwargs
+                    )
+        except UserBusyError:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="Wait a second, I'm still answering your previous "
+                     "message",
+                reply_markup=reply_markup
+                )
+            return
+        except WorkerBusyError:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="I'm a bit busy right now, try again in a moment",
+                reply_markup=reply_markup
+                )
+            return
+        finally:
+            if message is not None:
+                streamer.close()
+                await consumer
+
+        if cache_key is not None:
+            response_cache.put(cache_key, response,
+                               time.perf_counter() - generation_start)
+
+    # Add the turn to the conversation history, a turn of a conversation
+    # cleared meanwhile is answered but not written back
+    conversation = user_history.append(user_id, epoch, text, user_segment,
+                                       response)
+    if conversation is not None:
+        transcript_logger.log(user_id,
+                              user_message=text,
+                              model_output=response,
+                              msg_count=conversation.msg_count)
+
+        # Replace the system prompt with the next one, stages share
+        # segments
+        system_prompt = get_system_prompt(conversation.msg_count)
+        if system_prompt is not conversation.system_prompt:
+            conversation.set_system_prompt(system_prompt)
+            # Cached keys/values are useless once the system prompt is
+            # swapped
+            invalidate_cache(user_id)
+    else:
+        logging.info("Dropped a turn of user %s cleared during generation",
+                     user_id)
+
+    with telegram_send_seconds.time():
+        if message is not None:
+            await message.finish(response)
+        else:
+            await context.bot.send_message(chat_id=update.effective_chat.id,
+                                           text=response,
+                                           reply_markup=reply_markup)
+    reply_seconds.observe(time.perf_counter() - start)
+
+
+async def clear(update: Update, context: CallbackContext):
+    """
+    Clears the conversation history between the bot and the user
+    Implements /clear command (button)
+    """
+    user_id = update.effective_user.id
+
+    # Turns are already in the transcript log, just mark the end of chat
+    transcript_logger.log(user_id, event="clear")
+
+    # Reset user history
+    user_history.reset(user_id)
+    invalidate_cache(user_id)
+
+    await context.bot.send_message(chat_id=update.effective_chat.id,
+                                   text="Conversation history is clear now. \
+                                         Feel free to start a new one!")
+
+
+async def post_init(application: Application) -> NoReturn:
+    """
+    Starts background tasks once the event loop is running
+    """
+    await transcript_logger.start()
+
+
+async def post_shutdown(application: Application) -> NoReturn:
+    """
+    Flushes buffered transcripts on shutdown
+    """
+    await transcript_logger.stop()
+
+
+def run_bot() -> NoReturn:
+    application = build_application(BOT_TOKEN,
+                                    BOT_SERVING_PARAMS,
+                                    post_init=post_init,
+                                    post_shutdown=post_shutdown)
+
+    start_handler = CommandHandler("start", start)
+    clear_handler = CommandHandler("clear", clear)
+    respond_handler = MessageHandler(filters.TEXT & (~filters.COMMAND),
+                                     respond)
+
+    application.add_handler(start_handler)
+    application.add_handler(clear_handler)
+    application.add_handler(respond_handler)
+
+    inference_worker.start()
+    metrics_server = start_http_server(metrics,
+                                       METRICS_PARAMS["host"],
+                                       METRICS_PARAMS["port"]) \
+        if METRICS_PARAMS["enabled"] else None
+    try:
+        serve(application, BOT_SERVING_PARAMS)
+    finally:
+        # Handlers are drained by now, pending generations are done
+        inference_worker.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        user_history.store.close()
+        logging.info("Admission stats: %s", admission.stats())
+        if response_cache is not None:
+            logging.info("Response cache stats: %s", response_cache.stats())
+        if reply_generator is not None:
+            log_generator_stats(reply_generator)
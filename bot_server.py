@@ -0,0 +1,140 @@
+"""
+Telegram update delivery: long polling or webhook
+"""
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, NoReturn, Union
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    ApplicationHandlerStop,
+    CallbackContext,
+    TypeHandler
+)
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+
+class RecentUpdateIds:
+    """
+    Bounded set of the latest update ids. Telegram redelivers a webhook
+    update when the response is slow or lost, and a restarted poller
+    can fetch already handled updates.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        """
+        Args:
+            max_size (int, optional): Number of ids to remember.
+                                      Defaults to 10000.
+        """
+        self.max_size = max_size
+        self.duplicates = 0
+        self._ids = OrderedDict()
+
+    def seen(self, update_id: int) -> bool:
+        """
+        Remember the id, True if it was already there
+        """
+        if update_id in self._ids:
+            self._ids.move_to_end(update_id)
+            self.duplicates += 1
+            return True
+        self._ids[update_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return False
+
+
+def add_update_dedup(application: Application,
+                     max_size: int = 10000) -> RecentUpdateIds:
+    """
+    Drop repeated updates before any other handler sees them
+
+    Args:
+        application (Application): bot application
+        max_size (int, optional): Number of ids to remember.
+                                  Defaults to 10000.
+
+    Returns:
+        RecentUpdateIds: remembered ids and the duplicates counter
+    """
+    recent_ids = RecentUpdateIds(max_size)
+
+    async def drop_duplicates(update: Update, context: CallbackContext):
+        if recent_ids.seen(update.update_id):
+            logging.info("Dropping duplicate update %d", update.update_id)
+            raise ApplicationHandlerStop
+
+    application.add_handler(TypeHandler(Update, drop_duplicates), group=-1)
+    return recent_ids
+
+
+def build_application(
+        token: str,
+        serving_params: dict,
+        post_init: Union[Callable[[Application], Awaitable], None] = None,
+        post_shutdown: Union[Callable[[Application], Awaitable], None] = None,
+        base_url: Union[str, None] = None
+        ) -> Application:
+    """
+    Create the bot application handling updates concurrently
+
+    Args:
+        token (str): bot token
+        serving_params (dict): see BOT_SERVING_PARAMS
+        post_init (Callable, optional): Called once the event loop is
+                                        running. Defaults to None.
+        post_shutdown (Callable, optional): Called on shutdown.
+                                            Defaults to None.
+        base_url (Union[str, None], optional): Bot API url, e.g. of a
+                                               local fake server.
+                                               Defaults to None.
+
+    Returns:
+        Application: bot application
+    """
+    builder = ApplicationBuilder() \
+        .token(token) \
+        .concurrent_updates(serving_params["concurrent_updates"])
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    if post_init is not None:
+        builder = builder.post_init(post_init)
+    if post_shutdown is not None:
+        builder = builder.post_shutdown(post_shutdown)
+    application = builder.build()
+    add_update_dedup(application, serving_params["dedup_size"])
+    return application
+
+
+def serve(application: Application, serving_params: dict) -> NoReturn:
+    """
+    Receive updates until SIGINT/SIGTERM
+
+    In webhook mode the HTTP server is plain HTTP, TLS is terminated by
+    the reverse proxy in front of it. On shutdown the server or poller
+    is stopped first, then the application waits for the handlers
+    already running, so accepted messages still get their replies.
+
+    Args:
+        application (Application): bot application
+        serving_params (dict): see BOT_SERVING_PARAMS
+    """
+    if serving_params["mode"] == "webhook":
+        application.run_webhook(
+            listen=serving_params["listen"],
+            port=serving_params["port"],
+            url_path=serving_params["url_path"],
+            webhook_url=serving_params["webhook_url"],
+            secret_token=serving_params["secret_token"]
+        )
+    elif serving_params["mode"] == "polling":
+        application.run_polling()
+    else:
+        raise ValueError(f"Unknown serving mode: {serving_params['mode']}")
@@ -0,0 +1,150 @@
+"""
+Token-budgeted conversation memory
+"""
+from typing import List, NoReturn, Union
+
+from transformers import PreTrainedTokenizer
+
+from prompt_builder import PromptBuilder, Segment
+
+
+class Conversation:
+    """
+    Chat history stored as pre-tokenized segments
+
+    Model input is the system prompt followed by the most recent turns
+    that fit into the token budget. Token ids are computed once per
+    segment, so building a prompt never re-tokenizes the history.
+    Start of the window only moves forward when the budget is exceeded
+    and then drops turns down to `trim_ratio` of the budget, so the
+    prompt prefix stays stable for several turns (and KV-caches match).
+    """
+
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizer,
+                 system_prompt: Union[str, Segment],
+                 max_tokens: Union[int, None] = None,
+                 trim_ratio: float = 0.75,
+                 prompt_builder: Union[PromptBuilder, None] = None):
+        """
+        Args:
+            tokenizer (PreTrainedTokenizer): model tokenizer
+            system_prompt (Union[str, Segment]): system prompt always kept
+                in the input, a segment of `prompt_builder` is not
+                tokenized again
+            max_tokens (Union[int, None], optional): token budget of the model
+                input. Defaults to None (no limit).
+            trim_ratio (float, optional): share of the budget to fill after
+                dropping old turns. Defaults to 0.75.
+            prompt_builder (Union[PromptBuilder, None], optional): shared
+                builder with pre-tokenized templates. Defaults to a new one.
+        """
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.trim_ratio = trim_ratio
+        self.prompt_builder = prompt_builder or PromptBuilder(tokenizer)
+        self.system_prompt = self._system_segment(system_prompt)
+        # Alternating user message and model output segments
+        self.turns: List[Segment] = []
+        self.window_start = 0
+        self.window_tokens = 0
+        # Messages of both sides including those not kept in `turns`
+        self.msg_count = 0
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    @property
+    def num_tokens(self) -> int:
+        """
+        Number of tokens in the current model input window
+        """
+        return self.system_prompt.num_tokens + self.window_tokens
+
+    def set_system_prompt(self,
+                          system_prompt: Union[str, Segment]) -> NoReturn:
+        """
+        Swap the system prompt keeping the turns
+        """
+        if system_prompt is self.system_prompt:
+            return
+        if isinstance(system_prompt, Segment) or \
+                system_prompt != self.system_prompt.text:
+            self.system_prompt = self._system_segment(system_prompt)
+
+    def user_segment(self, user_message: str) -> Segment:
+        """
+        Tokenize a user message in the prompt format
+        """
+        return self.prompt_builder.user_segment(user_message)
+
+    def model_segment(self, model_output: str) -> Segment:
+        """
+        Tokenize a model output in the prompt format
+        """
+        return self.prompt_builder.model_segment(model_output)
+
+    def append(self, user: Segment, model: Segment) -> NoReturn:
+        """
+        Add a finished turn to the history
+        """
+        self.turns.append(user)
+        self.turns.append(model)
+        self.window_tokens += user.num_tokens + model.num_tokens
+        self.msg_count += 2
+
+    def build_prompt(self, pending: Union[Segment, None] = None) -> str:
+        """
+        Build the model input under the token budget
+
+        Args:
+            pending (Union[Segment, None], optional): user message waiting
+                for the response. Defaults to None.
+
+        Returns:
+            str: model input
+        """
+        return " ".join(segment.text for segment in self._window(pending))
+
+    def build_input_ids(self, pending: Union[Segment, None] = None
+                        ) -> List[int]:
+        """
+        Build the model input token ids under the token budget, the ids
+        of the segments are concatenated without tokenizing anything
+
+        Args:
+            pending (Union[Segment, None], optional): user message waiting
+                for the response. Defaults to None.
+
+        Returns:
+            List[int]: model input ids
+        """
+        return self.prompt_builder.build(self._window(pending))
+
+    def _window(self, pending: Union[Segment, None]) -> List[Segment]:
+        pending_tokens = pending.num_tokens if pending is not None else 0
+        if self.max_tokens is not None and \
+                self.num_tokens + pending_tokens > self.max_tokens:
+            self._trim(pending_tokens)
+
+        segments = [self.system_prompt]
+        segments.extend(self.turns[self.window_start:])
+        if pending is not None:
+            segments.append(pending)
+        return segments
+
+    def _trim(self, pending_tokens: int) -> NoReturn:
+        target = self.max_tokens * self.trim_ratio - \
+            self.system_prompt.num_tokens - pending_tokens
+        # Drop whole turns (user message + model output) from the start
+        while self.window_start < len(self.turns) and \
+                self.window_tokens > target:
+            self.window_tokens -= self.turns[self.window_start].num_tokens + \
+                self.turns[self.window_start + 1].num_tokens
+            self.window_start += 2
+
+    def _system_segment(self, system_prompt: Union[str, Segment]) -> Segment:
+        if isinstance(system_prompt, Segment):
+            return system_prompt
+        return self.prompt_builder.segment(system_prompt,
+                                           add_special_tokens=True)
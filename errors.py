@@ -0,0 +1,15 @@
+"""
+Errors of overloaded serving shared by workers and admission control
+"""
+
+
+class WorkerBusyError(Exception):
+    """
+    Raised when the request queue of the worker is full
+    """
+
+
+class UserBusyError(Exception):
+    """
+    Raised when the user already has a generation in flight
+    """
@@ -0,0 +1,365 @@
+"""
+Single reply generation for the chat-bot
+"""
+import time
+from typing import Dict, Hashable, List, NoReturn, Sequence, Union
+
+import torch
+from transformers import Pipeline, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+from adapters import AdapterSet
+from batching import build_logits_processor
+from kv_cache import (
+    PastKeyValues,
+    PrefixCache,
+    UserKVCache,
+    common_prefix_length,
+    past_length,
+    truncate_past
+)
+from speculative import (
+    ModelDrafter,
+    NgramDrafter,
+    SpeculativeStats,
+    speculative_generate
+)
+from metrics import MetricsRegistry
+from prompt_builder import Prompt, prompt_ids
+from stopping import (
+    StopSequenceChecker,
+    StopSequenceCriteria,
+    truncate_at_stop
+)
+
+# Phase timings shared with the bot handlers
+PHASE_SECONDS = "bot_phase_seconds"
+
+
+class _FirstTokenTimer(StoppingCriteria):
+    """
+    Never stops, remembers when the first new token was generated
+    """
+
+    def __init__(self):
+        self.first_token_at = None
+
+    def __call__(self,
+                 input_ids: torch.LongTensor,
+                 scores: torch.FloatTensor,
+                 **kwargs) -> bool:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return False
+
+
+class _PastRecorder:
+    """
+    Keeps keys/values of the last forward pass of the model, after
+    generation they cover the prompt and the response but its last token
+    """
+
+    def __init__(self, model: torch.nn.Module):
+        # generate of a PEFT model runs the wrapped transformers model
+        if hasattr(model, "get_base_model"):
+            model = model.get_base_model()
+        self.past_key_values = None
+        self._handle = model.register_forward_hook(self._record)
+
+    def _record(self, module: torch.nn.Module, args, output) -> NoReturn:
+        self.past_key_values = getattr(output, "past_key_values", None)
+
+    def remove(self) -> NoReturn:
+        self._handle.remove()
+
+
+class ReplyGenerator:
+    """
+    Generates model responses for the inference worker
+
+    Only the newly generated tokens are decoded, generation stops early
+    on any of `stop_sequences`. With `user_cache` keys/values of the
+    previous prompt and response are reused, so only the new user turn
+    (and response tokens retokenized differently) are prefilled. With
+    `prefix_cache` a conversation without cached turns starts from the
+    precomputed system prompt. With `drafter` replies are decoded
+    greedily with speculative decoding, sampling params are ignored.
+    With `adapters` every request can choose the LoRA adapter answering.
+    """
+
+    def __init__(self,
+                 model_pipeline: Pipeline,
+                 inference_params: dict,
+                 user_cache: Union[UserKVCache, None] = None,
+                 prefix_cache: Union[PrefixCache, None] = None,
+                 drafter: Union[NgramDrafter, ModelDrafter, None] = None,
+                 stop_sequences: Sequence[str] = (),
+                 metrics: Union[MetricsRegistry, None] = None,
+                 adapters: Union[AdapterSet, None] = None):
+        """
+        Args:
+            model_pipeline (Pipeline): text-generation pipeline
+            inference_params (dict): generation params
+            user_cache (Union[UserKVCache, None], optional): per-user
+                KV-cache. Defaults to None.
+            prefix_cache (Union[PrefixCache, None], optional): shared
+                prompt prefix KV-cache. Defaults to None.
+            drafter (Union[NgramDrafter, ModelDrafter, None], optional):
+                proposes tokens for speculative decoding. Defaults to None.
+            stop_sequences (Sequence[str], optional): texts ending the
+                response besides EOS. Defaults to ().
+            metrics (Union[MetricsRegistry, None], optional): registry
+                for generation metrics. Defaults to None.
+            adapters (Union[AdapterSet, None], optional): LoRA adapters a
+                request can choose from. Defaults to None.
+        """
+        self.model_pipeline = model_pipeline
+        self.model = model_pipeline.model
+        self.tokenizer = model_pipeline.tokenizer
+        self.inference_params = inference_params
+        self.user_cache = user_cache
+        self.prefix_cache = prefix_cache
+        self.drafter = drafter
+        self.adapters = adapters
+        # Keys/values depend on the adapter: prefixes are computed per
+        # adapter on first use, user caches are dropped on a switch
+        self._prefix_prompts: Dict[str, str] = {}
+        self._adapter_prefix_caches: Dict[str, PrefixCache] = {}
+        self._user_adapters: Dict[Hashable, str] = {}
+        self.stop_sequences = list(stop_sequences)
+        self.stop_checker = StopSequenceChecker(self.tokenizer,
+                                                self.stop_sequences)
+        self.speculative_stats = SpeculativeStats()
+        # Greedy choice is only affected by the repetition penalty
+        self._speculative_processor = build_logits_processor({
+            "repetition_penalty": inference_params.get("repetition_penalty")
+        })
+
+        if metrics is None:
+            metrics = MetricsRegistry(enabled=False)
+        phase_seconds = metrics.histogram(PHASE_SECONDS,
+                                          "Duration of reply phases",
+                                          labelnames=("phase",))
+        self._tokenize_seconds = phase_seconds.labels("tokenize")
+        self._generate_seconds = phase_seconds.labels("generate")
+        self._decode_seconds = phase_seconds.labels("decode")
+        self._time_to_first_token = metrics.histogram(
+            "generation_time_to_first_token_seconds",
+            "Time from the tokenized prompt to the first new token"
+        )
+        self._tokens_per_second = metrics.histogram(
+            "generation_tokens_per_second",
+            "New tokens per second of generation",
+            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+        )
+        self._prompt_tokens = metrics.histogram(
+            "generation_prompt_tokens",
+            "Prompt length in tokens",
+            buckets=(128, 256, 512, 1024, 2048, 3072, 4096)
+        )
+
+    def register_prefix(self, name: str, prompt: str) -> NoReturn:
+        """
+        Precompute keys/values of a fixed prompt prefix, e.g. system prompt
+
+        Args:
+            name (str): prefix name
+            prompt (str): prefix text
+        """
+        self._prefix_prompts[name] = prompt
+        self._adapter_prefix_caches.clear()
+        if self.adapters is not None:
+            self.adapters.activate()
+        self._register_prefix(self.prefix_cache, name, prompt)
+
+    def __call__(self,
+                 user_id: Hashable,
+                 prompt: Prompt,
+                 streamer: Union[BaseStreamer, None] = None,
+                 adapter: Union[str, None] = None) -> str:
+        """
+        Generate model response for the given prompt (blocking)
+
+        Args:
+            user_id (Hashable): user the prompt belongs to
+            prompt (Prompt): model input, text or token ids
+            streamer (Union[BaseStreamer, None], optional): receives new
+                tokens while they are generated. Defaults to None.
+            adapter (Union[str, None], optional): LoRA adapter answering,
+                see `adapters`. Defaults to the default adapter.
+
+        Returns:
+            str: model response
+        """
+        prefix_cache = self.prefix_cache
+        if self.adapters is not None:
+            adapter = self.adapters.activate(adapter)
+            prefix_cache = self._prefix_cache_of(adapter)
+            if self._user_adapters.get(user_id, adapter) != adapter:
+                self.invalidate(user_id)
+            self._user_adapters[user_id] = adapter
+
+        start = time.perf_counter()
+        input_ids = prompt_ids(self.tokenizer, prompt)
+        tokenized = time.perf_counter()
+        self._tokenize_seconds.observe(tokenized - start)
+        self._prompt_tokens.observe(len(input_ids))
+
+        past_key_values = None
+        if self.user_cache is not None or prefix_cache is not None:
+            past_key_values = self._prefill_cached(user_id, input_ids,
+                                                   prefix_cache)
+
+        first_token_timer = _FirstTokenTimer()
+        recorder = _PastRecorder(self.model) \
+            if self.user_cache is not None else None
+        try:
+            new_tokens = self._generate(input_ids, past_key_values,
+                                        first_token_timer, streamer)
+        finally:
+            if recorder is not None:
+                recorder.remove()
+        generated = time.perf_counter()
+        self._generate_seconds.observe(generated - tokenized)
+        if first_token_timer.first_token_at is not None:
+            self._time_to_first_token.observe(
+                first_token_timer.first_token_at - tokenized
+            )
+        self._tokens_per_second.observe(
+            len(new_tokens) / max(generated - tokenized, 1e-9)
+        )
+        if recorder is not None and recorder.past_key_values is not None:
+            self._cache_turn(user_id, input_ids + new_tokens,
+                             recorder.past_key_values)
+
+        response = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+        response = truncate_at_stop(response, self.stop_sequences).strip()
+        self._decode_seconds.observe(time.perf_counter() - generated)
+        return response
+
+    def invalidate(self, user_id: Hashable) -> NoReturn:
+        """
+        Drop cached keys/values of the user
+        """
+        if self.user_cache is not None:
+            self.user_cache.invalidate(user_id)
+        self._user_adapters.pop(user_id, None)
+
+    def _generate(self,
+                  input_ids: List[int],
+                  past_key_values: Union[PastKeyValues, None],
+                  first_token_timer: _FirstTokenTimer,
+                  streamer: Union[BaseStreamer, None]) -> List[int]:
+        """
+        New token ids of the response
+        """
+        if self.drafter is not None:
+            return speculative_generate(
+                self.model,
+                input_ids,
+                self.drafter,
+                max_new_tokens=self.inference_params["max_new_tokens"],
+                eos_token_id=self.tokenizer.eos_token_id,
+                logits_processor=self._speculative_processor,
+                past_key_values=past_key_values,
+                streamer=streamer,
+                stats=self.speculative_stats,
+                stop_checker=self.stop_checker
+            )
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=torch.tensor([input_ids], device=self.model.device),
+                attention_mask=torch.ones((1, len(input_ids)),
+                                          dtype=torch.long,
+                                          device=self.model.device),
+                past_key_values=past_key_values,
+                stopping_criteria=StoppingCriteriaList([
+                    first_token_timer,
+                    StopSequenceCriteria(self.stop_checker, len(input_ids))
+                ]),
+                streamer=streamer,
+                **self.inference_params
+            )
+        return output[0, len(input_ids):].tolist()
+
+    def _cache_turn(self,
+                    user_id: Hashable,
+                    token_ids: List[int],
+                    past_key_values: PastKeyValues) -> NoReturn:
+        """
+        Keep keys/values of the prompt and the response for the next turn
+
+        The next prompt holds the response as retokenized text, the cached
+        tokens are reused up to the first difference.
+        """
+        length = min(past_length(past_key_values), len(token_ids) - 1)
+        self.user_cache.put(user_id, token_ids[:length],
+                            truncate_past(past_key_values, length))
+
+    @torch.no_grad()
+    def _register_prefix(self,
+                         prefix_cache: PrefixCache,
+                         name: str,
+                         prompt: str) -> NoReturn:
+        token_ids = self.tokenizer(prompt).input_ids
+        output = self.model(
+            input_ids=torch.tensor([token_ids], device=self.model.device),
+            use_cache=True
+        )
+        prefix_cache.register(name, token_ids, output.past_key_values)
+
+    def _prefix_cache_of(self, adapter: str) -> Union[PrefixCache, None]:
+        """
+        Prefix cache of the active adapter, registered prefixes are
+        computed for other adapters than the default one on first use
+        """
+        if self.prefix_cache is None or adapter == self.adapters.default:
+            return self.prefix_cache
+        prefix_cache = self._adapter_prefix_caches.get(adapter)
+        if prefix_cache is None:
+            prefix_cache = PrefixCache()
+            for name, prompt in self._prefix_prompts.items():
+                self._register_prefix(prefix_cache, name, prompt)
+            self._adapter_prefix_caches[adapter] = prefix_cache
+        return prefix_cache
+
+    @torch.no_grad()
+    def _prefill_cached(self,
+                        user_id: Hashable,
+                        input_ids: List[int],
+                        prefix_cache: Union[PrefixCache, None]
+                        ) -> Union[PastKeyValues, None]:
+        """
+        Compute keys/values for all prompt tokens but the last one,
+        starting from the longest cached prefix. The last token is fed
+        by `generate` itself. The user cache is updated after generation,
+        see `_cache_turn`.
+        """
+        past_key_values = None
+        prefix_length = 0
+        entry = self.user_cache.get(user_id) \
+            if self.user_cache is not None else None
+        if entry is not None:
+            prefix_length = min(
+                common_prefix_length(entry.token_ids, input_ids),
+                len(input_ids) - 1
+            )
+            if prefix_length:
+                past_key_values = truncate_past(entry.past_key_values,
+                                                prefix_length)
+        if not prefix_length and prefix_cache is not None:
+            past_key_values, prefix_length = \
+                prefix_cache.lookup(input_ids[:-1])
+
+        new_ids = input_ids[prefix_length:-1]
+        if new_ids:
+            output = self.model(
+                input_ids=torch.tensor([new_ids], device=self.model.device),
+                attention_mask=torch.ones((1, len(input_ids) - 1),
+                                          dtype=torch.long,
+                                          device=self.model.device),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+            past_key_values = output.past_key_values
+        return past_key_values
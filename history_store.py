@@ -0,0 +1,340 @@
+"""
+Conversation history storage: pluggable backends with an LRU of hot users
+"""
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Hashable, List, NoReturn, Tuple, Union
+
+from conversation import Conversation, Segment
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# (user message, model output)
+Turn = Tuple[str, str]
+
+
+class HistoryStore(ABC):
+    """
+    Persistent part of user conversations: message count and turns
+    """
+
+    @abstractmethod
+    def load(self,
+             user_id: Hashable,
+             max_turns: Union[int, None] = None
+             ) -> Union[Tuple[int, List[Turn]], None]:
+        """
+        Load message count and the most recent turns of the user
+
+        Args:
+            user_id (Hashable): user ID
+            max_turns (Union[int, None], optional): Load at most that many
+                                                    recent turns.
+                                                    Defaults to None (all).
+
+        Returns:
+            Union[Tuple[int, List[Turn]], None]: message count and turns
+                in chronological order, None for unknown users
+        """
+
+    @abstractmethod
+    def reset(self, user_id: Hashable) -> NoReturn:
+        """
+        Start a new empty conversation for the user
+        """
+
+    @abstractmethod
+    def append_turn(self,
+                    user_id: Hashable,
+                    user_message: str,
+                    model_output: str,
+                    msg_count: int) -> NoReturn:
+        """
+        Append one finished turn and update the message count
+        """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """
+        Number of stored users
+        """
+
+    def close(self) -> NoReturn:
+        """
+        Release backend resources
+        """
+
+
+class InMemoryHistoryStore(HistoryStore):
+    """
+    Process-local store, history is lost on restart
+    """
+
+    def __init__(self):
+        self._msg_counts = {}
+        self._turns = defaultdict(list)
+
+    def load(self,
+             user_id: Hashable,
+             max_turns: Union[int, None] = None
+             ) -> Union[Tuple[int, List[Turn]], None]:
+        if user_id not in self._msg_counts:
+            return None
+        turns = self._turns[user_id]
+        if max_turns is not None:
+            turns = turns[-max_turns:] if max_turns else []
+        return self._msg_counts[user_id], list(turns)
+
+    def reset(self, user_id: Hashable) -> NoReturn:
+        self._msg_counts[user_id] = 0
+        self._turns.pop(user_id, None)
+
+    def append_turn(self,
+                    user_id: Hashable,
+                    user_message: str,
+                    model_output: str,
+                    msg_count: int) -> NoReturn:
+        self._msg_counts[user_id] = msg_count
+        self._turns[user_id].append((user_message, model_output))
+
+    def __len__(self) -> int:
+        return len(self._msg_counts)
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    SQLite store in WAL mode: one row per user plus one row per turn
+
+    Every message costs a single indexed insert and update, history
+    survives restarts and crashes. The number of users is counted once
+    on open and then kept up to date by the writes, so metrics don't
+    query the shared connection.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        Args:
+            path (Union[str, Path]): database file path
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(path),
+                                           check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                msg_count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                user_message TEXT NOT NULL,
+                model_output TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_user_id ON turns (user_id, id);
+            """
+        )
+        self._num_users = self._connection.execute(
+            "SELECT COUNT(*) FROM users"
+        ).fetchone()[0]
+
+    def load(self,
+             user_id: Hashable,
+             max_turns: Union[int, None] = None
+             ) -> Union[Tuple[int, List[Turn]], None]:
+        row = self._connection.execute(
+            "SELECT msg_count FROM users WHERE user_id = ?",
+            (str(user_id),)
+        ).fetchone()
+        if row is None:
+            return None
+        turns = self._connection.execute(
+            "SELECT user_message, model_output FROM turns "
+            "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (str(user_id), -1 if max_turns is None else max_turns)
+        ).fetchall()
+        return row[0], turns[::-1]
+
+    def reset(self, user_id: Hashable) -> NoReturn:
+        with self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute("DELETE FROM turns WHERE user_id = ?",
+                                     (str(user_id),))
+            new_user = self._set_msg_count(user_id, 0)
+        self._num_users += new_user
+
+    def append_turn(self,
+                    user_id: Hashable,
+                    user_message: str,
+                    model_output: str,
+                    msg_count: int) -> NoReturn:
+        with self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute(
+                "INSERT INTO turns (user_id, user_message, model_output) "
+                "VALUES (?, ?, ?)",
+                (str(user_id), user_message, model_output)
+            )
+            new_user = self._set_msg_count(user_id, msg_count)
+        self._num_users += new_user
+
+    def __len__(self) -> int:
+        return self._num_users
+
+    def _set_msg_count(self, user_id: Hashable, msg_count: int) -> bool:
+        """
+        Update the user row or insert it, True if the user is new
+        """
+        updated = self._connection.execute(
+            "UPDATE users SET msg_count = ? WHERE user_id = ?",
+            (msg_count, str(user_id))
+        ).rowcount
+        if updated:
+            return False
+        self._connection.execute(
+            "INSERT INTO users (user_id, msg_count) VALUES (?, ?)",
+            (str(user_id), msg_count)
+        )
+        return True
+
+    def close(self) -> NoReturn:
+        self._connection.close()
+
+
+class UserHistory:
+    """
+    Bounded LRU of hot user conversations backed by a history store
+
+    Cold users are paged out from memory and rebuilt from the store
+    (re-tokenizing only their most recent turns) on the next message,
+    so a conversation object can be replaced at any time. Turns finished
+    after a long generation are checked against the reset epoch of the
+    user instead (see `epoch` and `append`).
+    """
+
+    def __init__(self,
+                 store: HistoryStore,
+                 new_conversation: Callable[[int], Conversation],
+                 max_hot_users: int = 10000,
+                 max_loaded_turns: Union[int, None] = None):
+        """
+        Args:
+            store (HistoryStore): persistent storage backend
+            new_conversation (Callable[[int], Conversation]): creates an empty
+                conversation for the given message count
+            max_hot_users (int, optional): Conversations kept in memory.
+                                           Defaults to 10000.
+            max_loaded_turns (Union[int, None], optional): Recent turns
+                restored for a cold user. Defaults to None (all).
+        """
+        self.store = store
+        self.new_conversation = new_conversation
+        self.max_hot_users = max_hot_users
+        self.max_loaded_turns = max_loaded_turns
+        self._hot = OrderedDict()
+        # Resets of every user in this process, paging out keeps them
+        self._epochs: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._hot)
+
+    def items(self):
+        """
+        Hot user conversations
+        """
+        return self._hot.items()
+
+    def get(self, user_id: Hashable) -> Union[Conversation, None]:
+        """
+        Get user conversation, None if the user has never started one
+        """
+        conversation = self._hot.get(user_id)
+        if conversation is not None:
+            self._hot.move_to_end(user_id)
+            return conversation
+
+        stored = self.store.load(user_id, self.max_loaded_turns)
+        if stored is None:
+            return None
+        msg_count, turns = stored
+        conversation = self.new_conversation(msg_count)
+        for user_message, model_output in turns:
+            conversation.append(conversation.user_segment(user_message),
+                                conversation.model_segment(model_output))
+        conversation.msg_count = msg_count
+        self._put(user_id, conversation)
+        return conversation
+
+    def epoch(self, user_id: Hashable) -> int:
+        """
+        Number of resets of the user's conversation, e.g. by /clear
+        """
+        return self._epochs.get(user_id, 0)
+
+    def reset(self, user_id: Hashable) -> Conversation:
+        """
+        Start a new conversation for the user
+        """
+        self._epochs[user_id] = self.epoch(user_id) + 1
+        self.store.reset(user_id)
+        conversation = self.new_conversation(0)
+        self._put(user_id, conversation)
+        return conversation
+
+    def append(self,
+               user_id: Hashable,
+               epoch: int,
+               user_message: str,
+               user_segment: Segment,
+               model_output: str) -> Union[Conversation, None]:
+        """
+        Add a finished turn to the current conversation and persist it,
+        unless the conversation was reset since the turn started
+
+        Args:
+            user_id (Hashable): user ID
+            epoch (int): `epoch` of the user when the turn started
+            user_message (str): raw user message
+            user_segment (Segment): user message tokenized for the prompt
+            model_output (str): model response
+
+        Returns:
+            Union[Conversation, None]: conversation with the turn, None if
+                the turn belongs to a conversation reset meanwhile
+        """
+        if self.epoch(user_id) != epoch:
+            return None
+        # Might have been paged out and is rebuilt from the store then
+        conversation = self.get(user_id)
+        conversation.append(user_segment,
+                            conversation.model_segment(model_output))
+        self.store.append_turn(user_id, user_message, model_output,
+                               conversation.msg_count)
+        return conversation
+
+    def _put(self, user_id: Hashable, conversation: Conversation) -> NoReturn:
+        self._hot[user_id] = conversation
+        self._hot.move_to_end(user_id)
+        while len(self._hot) > self.max_hot_users:
+            self._hot.popitem(last=False)
+
+
+def get_history_store(params: dict) -> HistoryStore:
+    """
+    Create history store from HISTORY_STORE_PARAMS
+    """
+    if params["backend"] == "sqlite":
+        logging.info("Using SQLite history store at %s", params["path"])
+        return SQLiteHistoryStore(params["path"])
+    elif params["backend"] == "memory":
+        return InMemoryHistoryStore()
+    raise ValueError(f"Unknown history store backend: {params['backend']}")
@@ -1,14 +1,59 @@
 """
 Model inference params
 """
+import os
+
 import torch
 
 MODEL_PATH = "meta-llama/Llama-2-7b-chat-hf"
 ADAPTER_WEIGHTS_PATH = None
-MODEL_LOAD_PARAMS = {
-    "device_map": "auto",
-    "load_in_8bit": True,
-    "torch_dtype": torch.float16
+# More LoRA adapters served from the same base model by name, e.g.
+# {"friendly": "models/llama-chat-7b-lora-friendly-dialogue"}. The adapter
+# of ADAPTER_WEIGHTS_PATH is "default", the plain base model is "base".
+ADAPTERS = {}
+# Adapter answering a user: a pinned one from "users", then an "ab_test"
+# share of users (adapter -> share), then the adapter of the conversation
+# stage ("init", "close", "flirty") from "stages", then "default" (None
+# for ADAPTER_WEIGHTS_PATH or the base model)
+ADAPTER_ROUTING_PARAMS = {
+    "default": None,
+    "users": {},
+    "stages": {},
+    "ab_test": {},
+    "ab_test_name": "ab"
+}
+# Merged model prepared by prepare_model.py, used if present
+SERVING_ARTIFACT_PATH = "models/llama-chat-7b-serving"
+# "cuda" (8-bit weights on GPU) or "cpu"
+INFERENCE_DEVICE = os.environ.get("INFERENCE_DEVICE", "cuda")
+if INFERENCE_DEVICE == "cpu":
+    MODEL_LOAD_PARAMS = {
+        "torch_dtype": torch.float32,
+        "low_cpu_mem_usage": True
+    }
+else:
+    MODEL_LOAD_PARAMS = {
+        "device_map": "auto",
+        "load_in_8bit": True,
+        "torch_dtype": torch.float16
+    }
+# CPU backend options, dynamic int8 takes precedence over bfloat16
+CPU_BACKEND_PARAMS = {
+    "dynamic_int8": True,
+    "bfloat16": False,
+    "num_threads": None,
+    "num_interop_threads": None,
+    "compile": False
+}
+# Greedy speculative decoding, sampling params are ignored when enabled.
+# "ngram" drafts from the conversation itself, "model" runs a small draft
+# model with the same tokenizer. Not used by the batching worker.
+SPECULATIVE_PARAMS = {
+    "enabled": False,
+    "drafter": "ngram",
+    "draft_model_path": None,
+    "num_draft_tokens": 8,
+    "max_ngram": 3
 }
 MODEL_INFERENCE_PARAMS = {
     "top_k": 50,
@@ -19,3 +64,97 @@ MODEL_INFERENCE_PARAMS = {
     "repetition_penalty": 1.15,
     "use_cache": True
 }
+# Generation stops once the model starts a fake next user turn
+STOP_SEQUENCES = ["</s>", "[INST]"]
+# How the bot receives updates: "polling" or "webhook". The webhook
+# server speaks plain HTTP, TLS is terminated upstream (e.g. nginx).
+BOT_SERVING_PARAMS = {
+    "mode": os.environ.get("BOT_MODE", "polling"),
+    "concurrent_updates": 64,
+    "dedup_size": 10000,
+    "listen": "0.0.0.0",
+    "port": int(os.environ.get("WEBHOOK_PORT", 8080)),
+    "url_path": "telegram",
+    "webhook_url": os.environ.get("WEBHOOK_URL"),
+    "secret_token": os.environ.get("WEBHOOK_SECRET_TOKEN")
+}
+# Admission control: per-user token bucket (messages per second and burst),
+# global cap of running generations and merging of messages sent while
+# the user's previous message is being answered. A coalesce window above
+# 0 delays every first message to wait for more, messages sent while one
+# is answered are merged either way.
+ADMISSION_PARAMS = {
+    "rate": 0.2,
+    "burst": 5,
+    "max_concurrent": 16,
+    "max_wait": 10.0,
+    "coalesce_window": 0.0,
+    "max_users": 100000
+}
+# Model worker processes behind the bot, 0 runs the model in the bot
+# process. Every worker loads its own model replica, users stick to a
+# worker by consistent hashing. Batching and streaming are per-process
+# features and not used with workers.
+WORKER_POOL_PARAMS = {
+    "num_workers": 0,
+    "virtual_nodes": 64,
+    "restart_dead": True,
+    "max_restarts": 5,
+    "restart_backoff": 1.0,
+    "start_timeout": 1800
+}
+# Maximum number of generation requests waiting for the inference worker
+WORKER_MAX_QUEUE_SIZE = 16
+# Batch concurrent chats together (see batching.py)
+BATCHING_PARAMS = {
+    "enabled": False,
+    "continuous": True,
+    "max_batch_size": 8,
+    "batch_window_ms": 20
+}
+# Reuse keys/values of the previous turns per user (single-request path only)
+KV_CACHE_PARAMS = {
+    "enabled": False,
+    "max_bytes": 4 * 1024 ** 3,
+    "max_users": 256
+}
+# Precompute keys/values of the system prompts once at startup
+PREFIX_CACHE_ENABLED = True
+# Token budget of the model input (LLaMa2 context minus the response)
+MAX_PROMPT_TOKENS = 4096 - MODEL_INFERENCE_PARAMS["max_new_tokens"]
+# Reuse responses to common openers ("hi", "how are you") of new
+# conversations, a key is served once `num_variants` responses exist
+RESPONSE_CACHE_PARAMS = {
+    "enabled": False,
+    "max_entries": 10000,
+    "ttl": 3600.0,
+    "num_variants": 3,
+    "max_turns": 1
+}
+# Send the response while it is generated and edit the message as it grows
+STREAMING_PARAMS = {
+    "enabled": False,
+    "min_first_chars": 20,
+    "edit_interval": 1.0
+}
+# Conversation history storage: "sqlite" survives restarts, "memory" does not
+HISTORY_STORE_PARAMS = {
+    "backend": "sqlite",
+    "path": "logs/history.sqlite3",
+    "max_hot_users": 10000,
+    "max_loaded_turns": 200
+}
+# Append-only transcript logs written by a background task
+TRANSCRIPT_LOG_PARAMS = {
+    "log_dir": "logs/transcripts",
+    "flush_interval": 5.0,
+    "max_buffer": 10000,
+    "max_segment_bytes": 64 * 1024 ** 2,
+    "compress": True
+}
+# Prometheus-style metrics served on http://host:port/metrics
+METRICS_PARAMS = {
+    "enabled": True,
+    "host": os.environ.get("METRICS_HOST", "127.0.0.1"),
+    "port": int(os.environ.get("METRICS_PORT", 9100))
+}
@@ -0,0 +1,178 @@
+"""
+Inference worker running model generation off the bot event loop
+"""
+import asyncio
+import logging
+import queue
+import threading
+from typing import Callable, Hashable, List, NoReturn, Set, Union
+
+from errors import UserBusyError, WorkerBusyError
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# Sentinel put into the queue to stop the worker thread
+_STOP = object()
+
+
+class InferenceJob:
+    """
+    Single generation request travelling from the event loop to the worker
+    """
+    __slots__ = ("user_id", "prompt", "future", "loop", "generate_kwargs")
+
+    def __init__(self,
+                 user_id: Hashable,
+                 prompt: Union[str, List[int]],
+                 future: asyncio.Future,
+                 loop: asyncio.AbstractEventLoop,
+                 generate_kwargs: dict = None):
+        self.user_id = user_id
+        self.prompt = prompt
+        self.future = future
+        self.loop = loop
+        self.generate_kwargs = generate_kwargs or {}
+
+    def set_result(self, result: str) -> NoReturn:
+        """
+        Resolve the job future from the worker thread
+        """
+        self.loop.call_soon_threadsafe(_resolve, self.future, result, None)
+
+    def set_exception(self, exc: BaseException) -> NoReturn:
+        """
+        Fail the job future from the worker thread
+        """
+        self.loop.call_soon_threadsafe(_resolve, self.future, None, exc)
+
+
+def _resolve(future: asyncio.Future,
+             result: str,
+             exc: BaseException) -> NoReturn:
+    # The awaiting handler might have been cancelled in the meantime
+    if future.done():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+class InferenceWorker:
+    """
+    Dedicated thread that runs generation requests one by one
+
+    Handlers submit prompts with `await worker.submit(user_id, prompt)`.
+    The request queue is bounded: when it is full, `WorkerBusyError` is
+    raised immediately instead of piling up work. Each user can have
+    only one generation in flight, otherwise `UserBusyError` is raised.
+    """
+
+    def __init__(self,
+                 generate_fn: Callable[..., str],
+                 max_queue_size: int = 16):
+        """
+        Args:
+            generate_fn (Callable[..., str]): blocking function that takes
+                user id, prompt and optional generation kwargs and returns
+                the model response
+            max_queue_size (int, optional): Maximum number of pending requests.
+                                            Defaults to 16.
+        """
+        self.generate_fn = generate_fn
+        self.max_queue_size = max_queue_size
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._in_flight: Set[Hashable] = set()
+        self._thread = None
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of requests waiting for the worker
+        """
+        return self._queue.qsize()
+
+    def start(self) -> NoReturn:
+        """
+        Start the worker thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name=type(self).__name__,
+                                        daemon=True)
+        self._thread.start()
+        logging.info("Inference worker started")
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        """
+        Stop the worker thread after the already queued requests are processed
+
+        Args:
+            timeout (float, optional): Seconds to wait for the thread.
+                                       Defaults to None (wait forever).
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        logging.info("Inference worker stopped")
+
+    async def submit(self,
+                     user_id: Hashable,
+                     prompt: Union[str, List[int]],
+                     **generate_kwargs) -> str:
+        """
+        Submit a prompt and wait for the model response
+
+        Args:
+            user_id (Hashable): user the request belongs to
+            prompt (Union[str, List[int]]): model input, text or token ids
+            **generate_kwargs: passed to `generate_fn`, e.g. streamer
+
+        Raises:
+            UserBusyError: the user already waits for a response
+            WorkerBusyError: the request queue is full
+
+        Returns:
+            str: model response
+        """
+        if user_id in self._in_flight:
+            raise UserBusyError(user_id)
+
+        loop = asyncio.get_running_loop()
+        job = InferenceJob(user_id, prompt, loop.create_future(), loop,
+                           generate_kwargs)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise WorkerBusyError(user_id) from None
+
+        self._in_flight.add(user_id)
+        try:
+            return await job.future
+        finally:
+            self._in_flight.discard(user_id)
+
+    def _run(self) -> NoReturn:
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            self._process(job)
+
+    def _process(self, job: InferenceJob) -> NoReturn:
+        if job.future.cancelled():
+            return
+        try:
+            result = self.generate_fn(job.user_id, job.prompt,
+                                      **job.generate_kwargs)
+        except Exception as exc:
+            logging.exception("Generation failed for user %s", job.user_id)
+            job.set_exception(exc)
+        else:
+            job.set_result(result)
@@ -0,0 +1,209 @@
+"""
+KV-caches reused across requests: per-user turns and shared prompt prefixes
+"""
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, NoReturn, Sequence, Tuple, Union
+
+import torch
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def past_nbytes(past_key_values: PastKeyValues) -> int:
+    """
+    Memory used by cached keys and values in bytes
+    """
+    return sum(t.numel() * t.element_size()
+               for layer in past_key_values for t in layer)
+
+
+def past_length(past_key_values: PastKeyValues) -> int:
+    """
+    Number of tokens covered by cached keys and values
+    """
+    return past_key_values[0][0].shape[2]
+
+
+def truncate_past(past_key_values: PastKeyValues,
+                  length: int) -> PastKeyValues:
+    """
+    Keep cached keys and values of the first `length` tokens only
+    """
+    if length == past_length(past_key_values):
+        return past_key_values
+    return tuple(
+        tuple(t[:, :, :length] for t in layer)
+        for layer in past_key_values
+    )
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    """
+    Length of the longest common prefix of two token id sequences
+    """
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class KVCacheEntry:
+    """
+    Token ids and keys/values computed for them
+    """
+    __slots__ = ("token_ids", "past_key_values", "nbytes")
+
+    def __init__(self, token_ids: List[int], past_key_values: PastKeyValues):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = past_nbytes(past_key_values)
+
+
+class UserKVCache:
+    """
+    LRU cache of `past_key_values` per user bounded by memory budget
+
+    Entries are reused only up to the longest common token prefix with
+    the new prompt, so a stale entry can never produce a wrong result.
+    Invalidation on system prompt swap or /clear just frees the memory
+    early instead of keeping keys/values that will not match anymore.
+    """
+
+    def __init__(self, max_bytes: int, max_users: Union[int, None] = None):
+        """
+        Args:
+            max_bytes (int): memory budget for all cached keys and values
+            max_users (Union[int, None], optional): Maximum number of cached
+                                                    users. Defaults to None.
+        """
+        self.max_bytes = max_bytes
+        self.max_users = max_users
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: Hashable) -> Union[KVCacheEntry, None]:
+        """
+        Get user entry and mark it as recently used
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+    def put(self,
+            user_id: Hashable,
+            token_ids: List[int],
+            past_key_values: PastKeyValues) -> NoReturn:
+        """
+        Store user entry evicting the least recently used ones if needed
+        """
+        entry = KVCacheEntry(token_ids, past_key_values)
+        with self._lock:
+            self._pop(user_id)
+            if entry.nbytes > self.max_bytes:
+                return
+            self._entries[user_id] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes or \
+                    (self.max_users and len(self._entries) > self.max_users):
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, user_id: Hashable) -> NoReturn:
+        """
+        Drop user entry, e.g. after /clear or system prompt swap
+        """
+        with self._lock:
+            self._pop(user_id)
+
+    def _pop(self, user_id: Hashable) -> NoReturn:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+
+class PrefixCache:
+    """
+    Keys/values of fixed prompt prefixes shared by all users
+
+    Every registered prefix (e.g. a system prompt) is computed once and
+    reused up to the longest common token prefix with the model input.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Share of lookups served from a registered prefix
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def register(self,
+                 name: str,
+                 token_ids: List[int],
+                 past_key_values: PastKeyValues) -> NoReturn:
+        """
+        Register keys/values computed for the prefix token ids
+        """
+        with self._lock:
+            self._entries[name] = KVCacheEntry(token_ids, past_key_values)
+
+    def lookup(self,
+               token_ids: Sequence[int]
+               ) -> Tuple[Union[PastKeyValues, None], int]:
+        """
+        Find the registered prefix sharing the most tokens with the input
+
+        Args:
+            token_ids (Sequence[int]): token ids that need keys/values
+
+        Returns:
+            Tuple[Union[PastKeyValues, None], int]: truncated keys/values
+                and number of tokens they cover
+        """
+        best_entry, best_length = None, 0
+        with self._lock:
+            for entry in self._entries.values():
+                length = common_prefix_length(entry.token_ids, token_ids)
+                if length > best_length:
+                    best_entry, best_length = entry, length
+            if best_entry is None:
+                self.misses += 1
+                return None, 0
+            self.hits += 1
+            self.tokens_saved += best_length
+        return truncate_past(best_entry.past_key_values, best_length), \
+            best_length
+
+    def stats(self) -> dict:
+        """
+        Hit rate and prefill tokens saved
+        """
+        return {
+            "prefixes": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "prefill_tokens_saved": self.tokens_saved
+        }
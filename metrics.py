@@ -0,0 +1,357 @@
+"""
+Prometheus text format metrics with a local HTTP endpoint
+"""
+import bisect
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NoReturn,
+    Sequence,
+    Tuple,
+    Union
+)
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# Latency buckets in seconds, from a cache hit to a long generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"") \
+        .replace("\n", "\\n")
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"'
+                          for name, value in labels) + "}"
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> NoReturn:
+        self.value += amount
+
+    def samples(self, name: str, labels: list) -> List[str]:
+        return [f"{name}{_format_labels(labels)} {self.value}"]
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float) -> NoReturn:
+        self.value = value
+
+    def dec(self, amount: float = 1.0) -> NoReturn:
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # Last one counts observations above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> NoReturn:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name: str, labels: list) -> List[str]:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{name}_bucket"
+                         f"{_format_labels(labels + [('le', le)])} "
+                         f"{cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class _FunctionChild:
+    __slots__ = ("fn",)
+
+    def __init__(self, fn: Callable[[], float]):
+        self.fn = fn
+
+    def samples(self, name: str, labels: list) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            logging.exception("Failed to collect metric %s", name)
+            return []
+        if value is None:
+            return []
+        return [f"{name}{_format_labels(labels)} {float(value)}"]
+
+
+class Metric:
+    """
+    Metric family, optionally split by labels
+
+    Without labels the metric methods (`inc`, `set`, `observe`, `time`)
+    are called on the metric itself, with labels on `labels(...)` of it.
+    """
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 kind: str,
+                 new_child: Callable[[], object],
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._new_child = new_child
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels "
+                                 f"{self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def __getattr__(self, attr: str):
+        # inc/set/observe/time of a metric without labels
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self._default, attr)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(child.samples(self.name,
+                                       list(zip(self.labelnames, values))))
+        return lines
+
+
+class _NoopMetric:
+    """
+    Accepts every metric call and does nothing
+    """
+
+    def labels(self, *values: str) -> "_NoopMetric":
+        return self
+
+    def inc(self, amount: float = 1.0) -> NoReturn:
+        pass
+
+    def dec(self, amount: float = 1.0) -> NoReturn:
+        pass
+
+    def set(self, value: float) -> NoReturn:
+        pass
+
+    def observe(self, value: float) -> NoReturn:
+        pass
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        yield
+
+
+_NOOP = _NoopMetric()
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered in the Prometheus text format
+
+    Metrics are get-or-create by name, so different modules can share
+    one. With `enabled=False` every metric is a shared no-op object and
+    the registry renders nothing.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self,
+                name: str,
+                documentation: str,
+                labelnames: Sequence[str] = (),
+                fn: Union[Callable[[], float], None] = None):
+        """
+        Monotonic counter, or a collector of the value returned by `fn`
+        """
+        new_child = _CounterChild if fn is None else lambda: _FunctionChild(fn)
+        return self._register(name, documentation, "counter",
+                              new_child, labelnames)
+
+    def gauge(self,
+              name: str,
+              documentation: str,
+              labelnames: Sequence[str] = (),
+              fn: Union[Callable[[], float], None] = None):
+        """
+        Value that goes up and down, or is read from `fn` on every scrape
+        """
+        new_child = _GaugeChild if fn is None else lambda: _FunctionChild(fn)
+        return self._register(name, documentation, "gauge",
+                              new_child, labelnames)
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        Distribution of observed values over cumulative buckets
+        """
+        bounds = tuple(sorted(buckets))
+        return self._register(name, documentation, "histogram",
+                              lambda: _HistogramChild(bounds), labelnames)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self,
+                  name: str,
+                  documentation: str,
+                  kind: str,
+                  new_child: Callable[[], object],
+                  labelnames: Sequence[str]):
+        if not self.enabled:
+            return _NOOP
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = Metric(name, documentation, kind,
+                                new_child, labelnames)
+                self._metrics[name] = metric
+            elif metric.kind != kind:
+                raise ValueError(f"Metric {name} is already a {metric.kind}")
+        return metric
+
+
+def resident_memory_bytes() -> int:
+    """
+    Current resident memory of the process, peak one if not on Linux
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def gpu_memory_allocated_bytes() -> Union[int, None]:
+    """
+    Memory allocated by torch on all GPUs, None without CUDA. torch is
+    not imported here: a process without a model doesn't need it.
+    """
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return sum(torch.cuda.memory_allocated(device)
+               for device in range(torch.cuda.device_count()))
+
+
+def register_process_metrics(registry: MetricsRegistry) -> NoReturn:
+    """
+    CPU and GPU memory of the process
+    """
+    registry.gauge("process_resident_memory_bytes",
+                   "Resident memory size in bytes",
+                   fn=resident_memory_bytes)
+    registry.gauge("gpu_memory_allocated_bytes",
+                   "Memory allocated by torch tensors on GPUs in bytes",
+                   fn=gpu_memory_allocated_bytes)
+
+
+def start_http_server(registry: MetricsRegistry,
+                      host: str = "127.0.0.1",
+                      port: int = 9100) -> ThreadingHTTPServer:
+    """
+    Serve `GET /metrics` from a daemon thread
+
+    Args:
+        registry (MetricsRegistry): metrics to expose
+        host (str, optional): Interface to listen on.
+                              Defaults to "127.0.0.1".
+        port (int, optional): Port to listen on. Defaults to 9100.
+
+    Returns:
+        ThreadingHTTPServer: running server, call `shutdown` to stop it
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args) -> NoReturn:
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,
+                     name="MetricsServer",
+                     daemon=True).start()
+    logging.info("Serving metrics on http://%s:%d/metrics",
+                 host, server.server_address[1])
+    return server
@@ -0,0 +1,109 @@
+"""
+Prepare a ready-to-serve model: merge LoRA adapter into the base weights
+
+Usage:
+    python3 prepare_model.py --output-dir models/llama-chat-7b-serving
+"""
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+from typing import NoReturn, Union
+
+import torch
+from transformers import AutoTokenizer, LlamaForCausalLM
+from peft import PeftModel
+
+from utils import (
+    HF_AUTH_TOKEN,
+    SERVING_ARTIFACT_FILE,
+    log_time,
+    normalize_model_path
+)
+from inference_config import (
+    MODEL_PATH,
+    ADAPTER_WEIGHTS_PATH,
+    SERVING_ARTIFACT_PATH
+)
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+
+def prepare_model(
+        model_path: str,
+        output_dir: Union[str, Path],
+        adapter_weights_path: Union[str, None] = None,
+        torch_dtype: torch.dtype = torch.float16,
+        max_shard_size: str = "2GB"
+        ) -> NoReturn:
+    """
+    Merge adapter weights into the base model and save it as safetensors
+
+    Args:
+        model_path (str): LLM model path
+        output_dir (Union[str, Path]): where to save the artifact
+        adapter_weights_path (Union[str, None], optional): Adapter to merge.
+                                                          Defaults to None.
+        torch_dtype (torch.dtype, optional): Weights dtype.
+                                             Defaults to torch.float16.
+        max_shard_size (str, optional): Maximum size of a weights shard.
+                                        Defaults to "2GB".
+    """
+    # 8-bit weights can't be merged, so the base model is loaded unquantized
+    with log_time("Loading base model"):
+        model = LlamaForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch_dtype,
+            low_cpu_mem_usage=True,
+            use_auth_token=HF_AUTH_TOKEN
+        )
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_path,
+            use_auth_token=HF_AUTH_TOKEN
+        )
+
+    if adapter_weights_path:
+        with log_time("Merging adapter weights"):
+            model = PeftModel.from_pretrained(model, adapter_weights_path)
+            model = model.merge_and_unload()
+
+    with log_time("Saving serving artifact"):
+        model.save_pretrained(output_dir,
+                              safe_serialization=True,
+                              max_shard_size=max_shard_size)
+        tokenizer.save_pretrained(output_dir)
+        with open(Path(output_dir).joinpath(SERVING_ARTIFACT_FILE), "w") as fp:
+            json.dump({
+                "model_path": normalize_model_path(model_path),
+                "adapter_weights_path":
+                    normalize_model_path(adapter_weights_path),
+                "torch_dtype": str(torch_dtype),
+                "created_at": time.time()
+            }, fp, indent=2)
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--adapter-weights-path", default=ADAPTER_WEIGHTS_PATH)
+    parser.add_argument("--output-dir", default=SERVING_ARTIFACT_PATH)
+    parser.add_argument("--torch-dtype", default="float16",
+                        choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--max-shard-size", default="2GB")
+    args = parser.parse_args()
+
+    prepare_model(
+        model_path=args.model_path,
+        output_dir=args.output_dir,
+        adapter_weights_path=args.adapter_weights_path,
+        torch_dtype=getattr(torch, args.torch_dtype),
+        max_shard_size=args.max_shard_size
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Model inputs assembled from token ids tokenized once
+"""
+from typing import Dict, Iterable, List, Union
+
+from transformers import PreTrainedTokenizerBase
+
+from src.prompt_templates import USER_PROMPT, MODEL_OUTPUT
+
+# Model input as text or as token ids built by `PromptBuilder`
+Prompt = Union[str, List[int]]
+
+
+class Segment:
+    """
+    Piece of the model input tokenized once when it is created
+    """
+    __slots__ = ("text", "token_ids")
+
+    def __init__(self, text: str, token_ids: List[int]):
+        self.text = text
+        self.token_ids = token_ids
+
+    @property
+    def num_tokens(self) -> int:
+        """
+        Number of tokens in the segment
+        """
+        return len(self.token_ids)
+
+
+def prompt_ids(tokenizer: PreTrainedTokenizerBase,
+               prompt: Prompt) -> List[int]:
+    """
+    Token ids of a model input, text is tokenized with special tokens
+    """
+    if isinstance(prompt, str):
+        return tokenizer(prompt).input_ids
+    return list(prompt)
+
+
+class PromptBuilder:
+    """
+    Pre-tokenized system prompts and prompt template fragments
+
+    System prompts are tokenized once when registered and the text around
+    the message in `USER_PROMPT` and `MODEL_OUTPUT` once when the builder
+    is created, so a turn only tokenizes the new message and a model
+    input is a concatenation of id lists. Swapping the system prompt of
+    a conversation swaps its id block. LLaMa's SentencePiece tokenizer
+    starts every piece of text at a word boundary, so the ids are the
+    ones of the joined prompt text up to spaces around special tokens.
+    Shared by all conversations, read-only after the registration.
+    """
+
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizerBase,
+                 system_prompts: Union[Dict[str, str], None] = None):
+        """
+        Args:
+            tokenizer (PreTrainedTokenizerBase): model tokenizer, the fast
+                                                 one is much quicker
+            system_prompts (Union[Dict[str, str], None], optional): System
+                prompts by name, e.g. conversation stage. Defaults to None.
+        """
+        self.tokenizer = tokenizer
+        self.system_prompts: Dict[str, Segment] = {}
+        for name, system_prompt in (system_prompts or {}).items():
+            self.register(name, system_prompt)
+        self._user_fragments = self._fragments(USER_PROMPT, "user_message")
+        self._model_fragments = self._fragments(MODEL_OUTPUT, "model_output")
+
+    def register(self, name: str, system_prompt: str) -> Segment:
+        """
+        Tokenize a system prompt once, with the BOS token
+        """
+        segment = self.segment(system_prompt, add_special_tokens=True)
+        self.system_prompts[name] = segment
+        return segment
+
+    def system_prompt(self, name: str) -> Segment:
+        """
+        Registered system prompt
+        """
+        return self.system_prompts[name]
+
+    def segment(self, text: str, add_special_tokens: bool = False) -> Segment:
+        """
+        Tokenize arbitrary text
+        """
+        return Segment(text, self.tokenizer(
+            text,
+            add_special_tokens=add_special_tokens
+        ).input_ids)
+
+    def user_segment(self, user_message: str) -> Segment:
+        """
+        User message in the prompt format
+        """
+        return self._format(USER_PROMPT.format(user_message=user_message),
+                            user_message, self._user_fragments)
+
+    def model_segment(self, model_output: str) -> Segment:
+        """
+        Model output in the prompt format
+        """
+        return self._format(MODEL_OUTPUT.format(model_output=model_output),
+                            model_output, self._model_fragments)
+
+    @staticmethod
+    def build(segments: Iterable[Segment]) -> List[int]:
+        """
+        Model input ids of consecutive segments
+        """
+        input_ids = []
+        for segment in segments:
+            input_ids.extend(segment.token_ids)
+        return input_ids
+
+    def _format(self,
+                text: str,
+                value: str,
+                fragments: List[List[int]]) -> Segment:
+        prefix_ids, suffix_ids = fragments
+        return Segment(text, prefix_ids + self._encode(value) + suffix_ids)
+
+    def _fragments(self, template: str, field: str) -> List[List[int]]:
+        prefix, suffix = template.split("{" + field + "}")
+        return [self._encode(prefix), self._encode(suffix)]
+
+    def _encode(self, text: str) -> List[int]:
+        text = text.strip()
+        if not text:
+            return []
+        return self.tokenizer(text, add_special_tokens=False).input_ids
@@ -0,0 +1,168 @@
+"""
+Cache of model responses to common conversation openers
+"""
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, NoReturn, Union
+
+from conversation import Conversation
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase text without punctuation and repeated spaces, so "Hi!!" and
+    "hi" share a cache entry
+    """
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text.lower())).strip()
+
+
+class _Entry:
+    __slots__ = ("variants", "generations", "generation_time", "expires_at")
+
+    def __init__(self, expires_at: float):
+        self.variants: List[str] = []
+        # Generations seen for the key, duplicates of variants included
+        self.generations = 0
+        self.generation_time = 0.0
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """
+    LRU cache of responses with a TTL, keyed on the system prompt and
+    the normalized turns of a short conversation
+
+    A key is served from the cache only after `num_variants` responses
+    were generated for it, then a random distinct one is picked, so
+    replies don't feel canned. Keys are built by `key`, a subclass can
+    override it (e.g. with a nearest neighbour of a message embedding).
+    Must be used from one thread only.
+    """
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 ttl: float = 3600.0,
+                 num_variants: int = 3,
+                 max_turns: int = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            max_entries (int, optional): Keys kept, the least recently used
+                                         are dropped. Defaults to 10000.
+            ttl (float, optional): Seconds an entry lives after its first
+                                   response. Defaults to 3600.0.
+            num_variants (int, optional): Responses generated for a key
+                                          before it is served from the
+                                          cache. Defaults to 3.
+            max_turns (int, optional): Only the first `max_turns` user
+                                       messages of a conversation are
+                                       cached. Defaults to 1.
+            clock (Callable[[], float], optional): Monotonic time source.
+                                                   Defaults to
+                                                   time.monotonic.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.num_variants = num_variants
+        self.max_turns = max_turns
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def key(self,
+            conversation: Conversation,
+            user_message: str,
+            adapter: Union[str, None] = None) -> Union[Hashable, None]:
+        """
+        Cache key of the next turn, None if it is not cacheable
+
+        Args:
+            conversation (Conversation): conversation before the turn
+            user_message (str): new user message
+            adapter (Union[str, None], optional): LoRA adapter answering.
+                                                  Defaults to None.
+
+        Returns:
+            Union[Hashable, None]: cache key
+        """
+        if conversation.msg_count >= 2 * self.max_turns or \
+                len(conversation.turns) != conversation.msg_count:
+            return None
+        turns = tuple(normalize(segment.text)
+                      for segment in conversation.turns)
+        return (adapter, conversation.system_prompt.text, turns,
+                normalize(user_message))
+
+    def get(self, key: Hashable) -> Union[str, None]:
+        """
+        Cached response for the key, None if it still has to be generated
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= self.clock():
+            del self._entries[key]
+            entry = None
+        if entry is None or entry.generations < self.num_variants or \
+                not entry.variants:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.seconds_saved += entry.generation_time
+        return random.choice(entry.variants)
+
+    def put(self,
+            key: Hashable,
+            response: str,
+            generation_time: float = 0.0) -> NoReturn:
+        """
+        Store a generated response
+
+        Args:
+            key (Hashable): key from `key`
+            response (str): model response
+            generation_time (float, optional): Seconds the response took,
+                                               counted as saved on hits.
+                                               Defaults to 0.0.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            entry = _Entry(self.clock() + self.ttl)
+            self._entries[key] = entry
+        else:
+            self._entries.move_to_end(key)
+        # Running mean of the generation time of the key
+        entry.generations += 1
+        entry.generation_time += \
+            (generation_time - entry.generation_time) / entry.generations
+        if response and response not in entry.variants and \
+                len(entry.variants) < self.num_variants:
+            entry.variants.append(response)
+
+    def stats(self) -> dict:
+        """
+        Hit rate and generation time saved
+        """
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "seconds_saved": self.seconds_saved
+        }
@@ -0,0 +1,118 @@
+"""
+Building the configured reply generator, shared by the bot and model workers
+"""
+import logging
+from typing import NoReturn, Union
+
+from utils import get_model
+from adapters import AdapterSet, BASE_ADAPTER
+from generation import ReplyGenerator
+from kv_cache import UserKVCache, PrefixCache
+from speculative import build_drafter
+from metrics import MetricsRegistry
+from inference_config import (
+    MODEL_PATH,
+    ADAPTER_WEIGHTS_PATH,
+    ADAPTERS,
+    SERVING_ARTIFACT_PATH,
+    INFERENCE_DEVICE,
+    MODEL_LOAD_PARAMS,
+    CPU_BACKEND_PARAMS,
+    SPECULATIVE_PARAMS,
+    MODEL_INFERENCE_PARAMS,
+    STOP_SEQUENCES,
+    KV_CACHE_PARAMS,
+    PREFIX_CACHE_ENABLED
+)
+from src.prompt_templates import (
+    INIT_SYSTEM_PROMPT,
+    CLOSE_SYSTEM_PROMPT,
+    FLIRTY_SYSTEM_PROMPT
+)
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+
+def build_reply_generator(
+        metrics: Union[MetricsRegistry, None] = None
+        ) -> ReplyGenerator:
+    """
+    Load the model and create the reply generator configured in
+    inference_config.py
+
+    Args:
+        metrics (Union[MetricsRegistry, None], optional): registry for
+            generation metrics. Defaults to None.
+
+    Returns:
+        ReplyGenerator: reply generator
+    """
+    cpu_backend_params = CPU_BACKEND_PARAMS \
+        if INFERENCE_DEVICE == "cpu" else None
+    model_pipeline = get_model(
+        MODEL_PATH,
+        MODEL_LOAD_PARAMS,
+        ADAPTER_WEIGHTS_PATH,
+        artifact_path=SERVING_ARTIFACT_PATH,
+        cpu_backend_params=cpu_backend_params,
+        extra_adapters=ADAPTERS
+    )
+
+    # Requests choose one of the adapters sharing the base model
+    adapters = None
+    if ADAPTERS:
+        adapters = AdapterSet(
+            model_pipeline.model,
+            default=None if ADAPTER_WEIGHTS_PATH else BASE_ADAPTER
+        )
+
+    # Optional draft proposals for speculative decoding
+    drafter = None
+    if SPECULATIVE_PARAMS["enabled"]:
+        draft_model = get_model(
+            SPECULATIVE_PARAMS["draft_model_path"],
+            MODEL_LOAD_PARAMS,
+            cpu_backend_params=cpu_backend_params
+        ).model if SPECULATIVE_PARAMS["drafter"] == "model" else None
+        drafter = build_drafter(SPECULATIVE_PARAMS, draft_model)
+
+    # Reuse keys/values of the previous turns and system prompts if enabled
+    reply_generator = ReplyGenerator(
+        model_pipeline,
+        MODEL_INFERENCE_PARAMS,
+        user_cache=UserKVCache(
+            max_bytes=KV_CACHE_PARAMS["max_bytes"],
+            max_users=KV_CACHE_PARAMS["max_users"]
+        ) if KV_CACHE_PARAMS["enabled"] else None,
+        prefix_cache=PrefixCache() if PREFIX_CACHE_ENABLED else None,
+        drafter=drafter,
+        stop_sequences=STOP_SEQUENCES,
+        metrics=metrics,
+        adapters=adapters
+    )
+    if PREFIX_CACHE_ENABLED:
+        logging.info("Precomputing system prompts")
+        reply_generator.register_prefix("init", INIT_SYSTEM_PROMPT)
+        reply_generator.register_prefix("close", CLOSE_SYSTEM_PROMPT)
+        reply_generator.register_prefix("flirty", FLIRTY_SYSTEM_PROMPT)
+    return reply_generator
+
+
+def log_generator_stats(reply_generator: ReplyGenerator) -> NoReturn:
+    """
+    Log cache and speculative decoding stats, e.g. on shutdown
+    """
+    if reply_generator.prefix_cache is not None:
+        logging.info("Prefix cache stats: %s",
+                     reply_generator.prefix_cache.stats())
+    if reply_generator.adapters is not None:
+        logging.info("Adapter switches: %d",
+                     reply_generator.adapters.switches)
+    if reply_generator.drafter is not None:
+        stats = reply_generator.speculative_stats
+        logging.info("Speculative decoding acceptance rate %.2f, "
+                     "%.2f tokens per forward pass",
+                     stats.acceptance_rate, stats.tokens_per_pass)
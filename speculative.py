@@ -0,0 +1,245 @@
+"""
+Greedy speculative decoding with n-gram or draft model proposals
+"""
+from dataclasses import dataclass
+from typing import List, NoReturn, Union
+
+import torch
+from transformers import LogitsProcessorList, PreTrainedModel
+from transformers.generation.streamers import BaseStreamer
+
+from kv_cache import PastKeyValues, common_prefix_length, truncate_past
+from stopping import StopSequenceChecker
+
+
+@dataclass
+class SpeculativeStats:
+    """
+    Counters accumulated over speculative generation calls
+    """
+    drafted: int = 0
+    accepted: int = 0
+    generated: int = 0
+    forward_passes: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_pass(self) -> float:
+        return self.generated / self.forward_passes \
+            if self.forward_passes else 0.0
+
+
+class NgramDrafter:
+    """
+    Prompt lookup drafting: finds the latest earlier occurrence of the
+    trailing n-gram in the context and proposes the tokens that followed
+    it. Chat replies often repeat names and phrases of the conversation,
+    and this costs no extra model.
+    """
+
+    def __init__(self, num_draft_tokens: int = 8, max_ngram: int = 3):
+        """
+        Args:
+            num_draft_tokens (int, optional): Maximum tokens to propose.
+                                              Defaults to 8.
+            max_ngram (int, optional): Longest n-gram to match, shorter
+                                       ones are tried next. Defaults to 3.
+        """
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram = max_ngram
+
+    def propose(self, token_ids: List[int]) -> List[int]:
+        for n in range(min(self.max_ngram, len(token_ids) - 1), 0, -1):
+            ngram = token_ids[-n:]
+            for start in range(len(token_ids) - n - 1, -1, -1):
+                if token_ids[start:start + n] == ngram:
+                    end = start + n
+                    return token_ids[end:end + self.num_draft_tokens]
+        return []
+
+
+class ModelDrafter:
+    """
+    Greedy proposals of a small draft model sharing the tokenizer of the
+    main model. Keys/values of the draft model are kept between calls,
+    so every round only feeds the tokens accepted since the last one.
+    """
+
+    def __init__(self,
+                 draft_model: PreTrainedModel,
+                 num_draft_tokens: int = 5):
+        """
+        Args:
+            draft_model (PreTrainedModel): small causal LM
+            num_draft_tokens (int, optional): Tokens to propose per round.
+                                              Defaults to 5.
+        """
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self._token_ids = []
+        self._past_key_values = None
+
+    @torch.no_grad()
+    def propose(self, token_ids: List[int]) -> List[int]:
+        prefix_length = min(common_prefix_length(self._token_ids, token_ids),
+                            len(token_ids) - 1)
+        past_key_values = truncate_past(self._past_key_values, prefix_length) \
+            if prefix_length else None
+        feed = token_ids[prefix_length:]
+        draft = []
+        for _ in range(self.num_draft_tokens):
+            output = self.draft_model(
+                input_ids=torch.tensor([feed], device=self.draft_model.device),
+                attention_mask=torch.ones(
+                    (1, prefix_length + len(feed)),
+                    dtype=torch.long,
+                    device=self.draft_model.device
+                ),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+            past_key_values = output.past_key_values
+            prefix_length += len(feed)
+            feed = [output.logits[0, -1].argmax().item()]
+            draft.append(feed[0])
+        # The last proposed token was never fed to the draft model
+        self._token_ids = token_ids + draft[:-1]
+        self._past_key_values = past_key_values
+        return draft
+
+    def reset(self) -> NoReturn:
+        self._token_ids = []
+        self._past_key_values = None
+
+
+@torch.no_grad()
+def speculative_generate(
+        model: PreTrainedModel,
+        input_ids: List[int],
+        drafter: Union[NgramDrafter, ModelDrafter],
+        max_new_tokens: int,
+        eos_token_id: int,
+        logits_processor: Union[LogitsProcessorList, None] = None,
+        past_key_values: Union[PastKeyValues, None] = None,
+        streamer: Union[BaseStreamer, None] = None,
+        stats: Union[SpeculativeStats, None] = None,
+        stop_checker: Union[StopSequenceChecker, None] = None
+        ) -> List[int]:
+    """
+    Greedy decoding where the model verifies drafted tokens in a single
+    forward pass. Every pass accepts the longest draft prefix matching
+    the model's own greedy choices plus one token of the model, so the
+    output is the same as with `generate(do_sample=False)`.
+
+    Args:
+        model (PreTrainedModel): main causal LM
+        input_ids (List[int]): prompt token ids
+        drafter (Union[NgramDrafter, ModelDrafter]): proposes next tokens
+        max_new_tokens (int): maximum number of generated tokens
+        eos_token_id (int): stops generation
+        logits_processor (Union[LogitsProcessorList, None], optional):
+            Applied to every position, e.g. repetition penalty.
+            Defaults to None.
+        past_key_values (Union[PastKeyValues, None], optional): Keys/values
+            of `input_ids[:-1]`, computed if not given. Defaults to None.
+        streamer (Union[BaseStreamer, None], optional): receives accepted
+            tokens. Defaults to None.
+        stats (Union[SpeculativeStats, None], optional): counters to
+            update. Defaults to None.
+        stop_checker (Union[StopSequenceChecker, None], optional): stops
+            generation on stop sequences. Defaults to None.
+
+    Returns:
+        List[int]: generated token ids
+    """
+    device = model.device
+    token_ids = list(input_ids)
+    if streamer is not None:
+        streamer.put(torch.tensor([token_ids]))
+    if past_key_values is None and len(token_ids) > 1:
+        past_key_values = model(
+            input_ids=torch.tensor([token_ids[:-1]], device=device),
+            use_cache=True
+        ).past_key_values
+    if stats is None:
+        stats = SpeculativeStats()
+
+    new_tokens = []
+    while len(new_tokens) < max_new_tokens:
+        # Leave room for the token the model adds after the draft
+        draft = drafter.propose(token_ids)
+        draft = draft[:max_new_tokens - len(new_tokens) - 1]
+        candidate = [token_ids[-1]] + draft
+        output = model(
+            input_ids=torch.tensor([candidate], device=device),
+            attention_mask=torch.ones((1, len(token_ids) + len(draft)),
+                                      dtype=torch.long,
+                                      device=device),
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+
+        accepted = []
+        context = torch.tensor([token_ids], device=device)
+        for position in range(len(candidate)):
+            scores = output.logits[:, position]
+            if logits_processor:
+                scores = logits_processor(context, scores)
+            next_token = scores[0].argmax().item()
+            accepted.append(next_token)
+            if position == len(draft) or draft[position] != next_token \
+                    or next_token == eos_token_id:
+                break
+            context = torch.cat(
+                [context, torch.tensor([[next_token]], device=device)],
+                dim=-1
+            )
+
+        num_accepted = len(accepted) - 1
+        stats.drafted += len(draft)
+        stats.accepted += num_accepted
+        stats.forward_passes += 1
+        # Keys/values of the rejected draft tokens are dropped
+        past_key_values = truncate_past(output.past_key_values,
+                                        len(token_ids) + num_accepted)
+        token_ids.extend(accepted)
+        new_tokens.extend(accepted)
+        if streamer is not None:
+            streamer.put(torch.tensor(accepted))
+        if accepted[-1] == eos_token_id or \
+                (stop_checker is not None and stop_checker(new_tokens)):
+            break
+
+    stats.generated += len(new_tokens)
+    if streamer is not None:
+        streamer.end()
+    return new_tokens
+
+
+def build_drafter(
+        speculative_params: dict,
+        draft_model: Union[PreTrainedModel, None] = None
+        ) -> Union[NgramDrafter, ModelDrafter]:
+    """
+    Create the drafter configured in SPECULATIVE_PARAMS
+
+    Args:
+        speculative_params (dict): speculative decoding params
+        draft_model (Union[PreTrainedModel, None], optional): Required for
+            the "model" drafter. Defaults to None.
+
+    Returns:
+        Union[NgramDrafter, ModelDrafter]: drafter
+    """
+    if speculative_params["drafter"] == "ngram":
+        return NgramDrafter(speculative_params["num_draft_tokens"],
+                            speculative_params["max_ngram"])
+    if speculative_params["drafter"] == "model":
+        if draft_model is None:
+            raise ValueError("Draft model is required for the model drafter")
+        return ModelDrafter(draft_model,
+                            speculative_params["num_draft_tokens"])
+    raise ValueError(f"Unknown drafter: {speculative_params['drafter']}")
@@ -3,17 +3,36 @@ LLaMa2 QLoRA fine-tuning script
 """
 import logging
 from dataclasses import dataclass
-from typing import Tuple, NoReturn
+from typing import Tuple, Union
 
 import torch
 import peft
 import transformers
-import wandb
 from transformers import LlamaForCausalLM, LlamaTokenizer
 from peft import LoraConfig, get_peft_model
 from datasets import load_from_disk, Dataset
 
 from fine_tuning_config import FineTuningConfig
+from packing import (
+    DEFAULT_BLOCK_SIZE,
+    PackedDataCollator,
+    PaddingStatsCollator,
+    ThroughputCallback,
+    enable_packed_attention,
+    pack_sequences
+)
+from token_cache import (
+    PackedTokenCacheDataset,
+    TokenCache,
+    TokenCacheDataset,
+    TokenCacheTrainer,
+    build_token_cache
+)
+
+try:
+    import wandb
+except ImportError:
+    wandb = None
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -27,7 +46,8 @@ def build_lora_model(
         load_in_8bit: bool = True,
         torch_dtype: torch.dtype = torch.float16,
         lora_rank: int = 8,
-        lora_alpha: int = 32
+        lora_alpha: int = 32,
+        gradient_checkpointing: bool = False
         ) -> Tuple[peft.peft_model.PeftModelForCausalLM,
                    transformers.PreTrainedTokenizer]:
     """
@@ -38,6 +58,9 @@ def build_lora_model(
         model_load_params (dict): Loading parameters
         lora_rank (int, optional): Lora rank value. Defaults to 8.
         lora_alpha (int, optional): Lora alpha value. Defaults to 32.
+        gradient_checkpointing (bool, optional): Recompute activations in
+                                                 the backward pass.
+                                                 Defaults to False.
 
     Returns:
         Tuple[peft.peft_model.PeftModelForCausalLM, transformers.Tokenizer]: model and tokenizer
@@ -52,6 +75,12 @@ def build_lora_model(
     tokenizer = LlamaTokenizer.from_pretrained(model_name)
     tokenizer.pad_token = tokenizer.eos_token
 
+    # Checkpointed blocks need inputs requiring grad, the embeddings are
+    # frozen
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+        model.enable_input_require_grads()
+
     # Create PEFT model
     config = LoraConfig(
         r=lora_rank,
@@ -70,10 +99,14 @@ def build_lora_model(
 def load_and_tokenize_data(
         tokenizer: transformers.PreTrainedTokenizer,
         train_data_path: str = "../data/train.hf/",
-        eval_data_path: str = "../data/validation.hf/"
-        ) -> Tuple[Dataset, Dataset]:
+        eval_data_path: str = "../data/validation.hf/",
+        max_seq_length: Union[int, None] = None,
+        packing: bool = False,
+        token_cache_dir: Union[str, None] = None
+        ) -> Tuple[Union[Dataset, TokenCacheDataset],
+                   Union[Dataset, TokenCacheDataset]]:
     """
-    Load and tokenize datasets
+    Load and tokenize datasets, optionally packed into blocks
 
     Args:
         tokenizer (transformers.Tokenizer): Model tokenizer
@@ -81,19 +114,85 @@ def load_and_tokenize_data(
                                          Defaults to "../data/train.hf/".
         eval_data_path (str, optional): Path to validation data. 
                                        Defaults to "../data/validation.hf/".
+        max_seq_length (Union[int, None], optional): Truncation length and
+                                                     block size of packing,
+                                                     None keeps samples
+                                                     whole.
+                                                     Defaults to None.
+        packing (bool, optional): Pack samples into blocks of
+                                  `max_seq_length` tokens, or
+                                  `DEFAULT_BLOCK_SIZE` if it is None.
+                                  Defaults to False.
+        token_cache_dir (Union[str, None], optional): If given, tokenize
+                                                      once into memory-mapped
+                                                      caches there and read
+                                                      samples from them.
+                                                      Defaults to None.
 
     Returns:
-        Tuple[Dataset, Dataset]: Tokenized train and validation datasets
+        Tuple[Union[Dataset, TokenCacheDataset],
+              Union[Dataset, TokenCacheDataset]]: Tokenized train and
+                                                  validation datasets
     """
+    # Blocks need a size, unpacked samples are only truncated on request
+    if packing and max_seq_length is None:
+        max_seq_length = DEFAULT_BLOCK_SIZE
+
+    # Samples are read from the caches on access, the Trainer shuffles
+    if token_cache_dir is not None:
+        cached = []
+        for data_path in (train_data_path, eval_data_path):
+            cache = TokenCache(build_token_cache(tokenizer, data_path,
+                                                 token_cache_dir,
+                                                 max_seq_length))
+            cached.append(
+                PackedTokenCacheDataset(cache, max_seq_length) if packing
+                else TokenCacheDataset(cache)
+            )
+        return tuple(cached)
+
     # Load
     train_data = load_from_disk(train_data_path)
     eval_data = load_from_disk(eval_data_path)
 
-    # Tokenize sequences
-    train_data = train_data.map(lambda samples: tokenizer(samples["sample"]),
-                                batched=True)
-    eval_data = eval_data.map(lambda samples: tokenizer(samples["sample"]),
-                              batched=True)
+    # Tokenize sequences, lengths are used by the length-grouped sampler.
+    # Samples are truncated after tokenizing to count the truncated ones.
+    def tokenize(samples: dict) -> dict:
+        tokenized = dict(tokenizer(samples["sample"]))
+        tokenized["truncated"] = [
+            max_seq_length is not None and len(ids) > max_seq_length
+            for ids in tokenized["input_ids"]
+        ]
+        if max_seq_length is not None:
+            for key in ("input_ids", "attention_mask"):
+                tokenized[key] = [ids[:max_seq_length]
+                                  for ids in tokenized[key]]
+        tokenized["length"] = [len(ids) for ids in tokenized["input_ids"]]
+        return tokenized
+
+    train_data = train_data.map(tokenize, batched=True)
+    eval_data = eval_data.map(tokenize, batched=True)
+    for data_path, data in ((train_data_path, train_data),
+                            (eval_data_path, eval_data)):
+        logging.info(f"{sum(data['truncated'])} of {len(data)} samples "
+                     f"of {data_path} truncated to {max_seq_length} tokens")
+    train_data = train_data.remove_columns("truncated")
+    eval_data = eval_data.remove_columns("truncated")
+
+    # Fill fixed-size blocks with several samples instead of padding
+    if packing:
+        train_data = train_data.map(
+            pack_sequences,
+            batched=True,
+            fn_kwargs={"block_size": max_seq_length},
+            remove_columns=train_data.column_names
+        )
+        eval_data = eval_data.map(
+            pack_sequences,
+            batched=True,
+            fn_kwargs={"block_size": max_seq_length},
+            remove_columns=eval_data.column_names
+        )
 
     # Shuffle data
     train_data = train_data.shuffle(seed=42)
@@ -102,7 +201,7 @@ def load_and_tokenize_data(
     return train_data, eval_data
 
 
-def train(config: dataclass) -> NoReturn:
+def train(config: dataclass) -> transformers.Trainer:
     """
     Train LLM with LoRA
 
@@ -110,7 +209,7 @@ def train(config: dataclass) -> NoReturn:
         config (dataclass): Config dataclass for fine-tuning
 
     Returns:
-        NoReturn
+        transformers.Trainer: trainer after training
     """
     # Load model and tokenizer
     model, tokenizer = build_lora_model(
@@ -119,46 +218,73 @@ def train(config: dataclass) -> NoReturn:
         load_in_8bit=config.load_in_8bit,
         torch_dtype=config.torch_dtype,
         lora_rank=config.lora_rank,
-        lora_alpha=config.lora_alpha
+        lora_alpha=config.lora_alpha,
+        gradient_checkpointing=config.gradient_checkpointing
     )
 
     # Load data
     train_data, eval_data = load_and_tokenize_data(
         tokenizer=tokenizer,
         train_data_path=config.train_data_path,
-        eval_data_path=config.eval_data_path
+        eval_data_path=config.eval_data_path,
+        max_seq_length=config.max_seq_length,
+        packing=config.packing,
+        token_cache_dir=config.token_cache_dir
     )
 
+    # Packed blocks carry segment ids in the attention mask
+    if config.packing:
+        enable_packed_attention()
+        data_collator = PackedDataCollator(tokenizer.pad_token_id)
+    else:
+        data_collator = PaddingStatsCollator(
+            transformers.DataCollatorForLanguageModeling(tokenizer, mlm=False)
+        )
+
     # Prepare training args
     training_args = transformers.TrainingArguments(
-        per_device_train_batch_size=config.per_device_train_batch_size,
+        # The search only halves the batch size, so it starts high
+        per_device_train_batch_size=config.auto_find_batch_start
+        if config.auto_find_batch_size
+        else config.per_device_train_batch_size,
+        auto_find_batch_size=config.auto_find_batch_size,
         gradient_accumulation_steps=config.gradient_accumulation_steps,
+        gradient_checkpointing=config.gradient_checkpointing,
+        dataloader_num_workers=config.dataloader_num_workers,
+        dataloader_pin_memory=config.dataloader_pin_memory,
         warmup_steps=config.warmup_steps,
         max_steps=config.max_steps,
         num_train_epochs=config.num_train_epochs,
         learning_rate=config.learning_rate,
         weight_decay=config.weight_decay,
         optim=config.optimizer,
-        report_to="wandb" if config.use_wandb else None,
-        fp16=True,
-        logging_steps=1,
-        output_dir=config.output_dir
+        report_to="wandb" if config.use_wandb else "none",
+        fp16=config.fp16,
+        torch_compile=config.torch_compile,
+        logging_steps=config.logging_steps,
+        output_dir=config.output_dir,
+        group_by_length=config.group_by_length and not config.packing,
+        # Position ids of packed blocks are not in the PEFT model signature
+        remove_unused_columns=not config.packing
     )
 
     # Set up WANDB
-    wandb.init(project=config.project_name,
-               name=config.run_name,
-               tags=["llm", "lora", "instructions fine-tuning"],
-               group="LLaMa")
+    if config.use_wandb:
+        if wandb is None:
+            raise ImportError("use_wandb needs wandb: pip install wandb")
+        wandb.init(project=config.project_name,
+                   name=config.run_name,
+                   tags=["llm", "lora", "instructions fine-tuning"],
+                   group="LLaMa")
 
-    # Train
-    trainer = transformers.Trainer(
+    # Train, lengths of cached samples come from the cache index
+    trainer = TokenCacheTrainer(
         model=model,
         train_dataset=train_data,
         eval_dataset=eval_data,
         args=training_args,
-        data_collator=transformers.DataCollatorForLanguageModeling(tokenizer,
-                                                                   mlm=False)
+        data_collator=data_collator,
+        callbacks=[ThroughputCallback(data_collator)]
     )
     model.config.use_cache = False  # Re-enable during inference for speed
     trainer.train()
@@ -170,6 +296,8 @@ def train(config: dataclass) -> NoReturn:
     if config.evaluate:
         trainer.evaluate()
 
+    return trainer
+
 
 if __name__ == "__main__":
     train(FineTuningConfig)
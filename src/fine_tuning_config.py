@@ -2,6 +2,7 @@
 QLoRA fine-tuning config dataclass
 """
 from dataclasses import dataclass
+from typing import Union
 
 import torch
 
@@ -16,14 +17,38 @@ class FineTuningConfig:
     lora_alpha: int = 32
     train_data_path: str = "../data/train.hf/"
     eval_data_path: str = "../data/validation.hf/"
+    # Token ids are cached here once per tokenizer and data, e.g.
+    # "../data/token_cache/", None to tokenize the data on every run
+    token_cache_dir: Union[str, None] = None
     per_device_train_batch_size: int = 2
+    # Start from auto_find_batch_start instead of per_device_train_batch_size
+    # and halve the batch size on every out-of-memory error until it fits.
+    # It is never increased, so the start should be above what fits.
+    auto_find_batch_size: bool = False
+    auto_find_batch_start: int = 32
+    # Recompute activations in the backward pass to fit larger batches
+    gradient_checkpointing: bool = False
+    dataloader_num_workers: int = 0
+    dataloader_pin_memory: bool = True
+    # Samples longer than this are truncated, None keeps them whole. Packed
+    # blocks are this long, DEFAULT_BLOCK_SIZE of packing.py if None.
+    max_seq_length: Union[int, None] = None
+    # Pack several samples into every block instead of padding them
+    packing: bool = False
+    # Batch unpacked samples of similar length to reduce padding
+    group_by_length: bool = False
     gradient_accumulation_steps: int = 2
     warmup_steps: int = 30
     max_steps: int = 200
     num_train_epochs: int = 1
     learning_rate: int = 5e-5
     weight_decay: int = 0.03
+    # E.g. "adamw_torch_fused" for the fused PyTorch kernel
     optimizer: str = "adamw_bnb_8bit"
+    fp16: bool = True
+    torch_compile: bool = False
+    # Throughput and peak memory are logged to the console every time
+    logging_steps: int = 1
     evaluate: bool = False
     output_dir: str = "../models/"
     out_model_name: str = "llama-chat-7b-lora-friendly-dialogue"
@@ -0,0 +1,266 @@
+"""
+Sequence packing, padding-aware collators and throughput logging for
+fine-tuning
+"""
+import logging
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Dict, List, NoReturn, Union
+
+import torch
+import transformers
+from transformers.models.llama import modeling_llama
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# Tokens in a packed block when no maximum sequence length is set
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def plan_blocks(lengths: List[int], block_size: int) -> List[List[int]]:
+    """
+    Assign samples to blocks of up to `block_size` tokens with first-fit
+    decreasing, longer samples count as truncated
+
+    Args:
+        lengths (List[int]): number of tokens of every sample
+        block_size (int): maximum tokens in a block
+
+    Returns:
+        List[List[int]]: sample indices of every block, longest first
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i],
+                   reverse=True)
+    blocks: List[List[int]] = []
+    free: List[int] = []
+    for i in order:
+        length = min(lengths[i], block_size)
+        for j, space in enumerate(free):
+            if length <= space:
+                blocks[j].append(i)
+                free[j] -= length
+                break
+        else:
+            blocks.append([i])
+            free.append(block_size - length)
+    return blocks
+
+
+def pack_sequences(batch: Dict[str, List[List[int]]],
+                   block_size: int) -> Dict[str, List[List[int]]]:
+    """
+    Pack tokenized samples of a batch into blocks of up to `block_size`
+    tokens, for `Dataset.map(batched=True)`
+
+    Samples are placed whole with first-fit decreasing (see
+    `plan_blocks`), longer ones are truncated. `attention_mask` holds the
+    1-based index of the sample of every token so attention never crosses
+    samples (see `enable_packed_attention`), positions restart with every
+    sample and the first token of a sample is not a label of the
+    previous one.
+
+    Args:
+        batch (Dict[str, List[List[int]]]): batch with `input_ids`
+        block_size (int): maximum tokens in a block
+
+    Returns:
+        Dict[str, List[List[int]]]: packed `input_ids`, `attention_mask`,
+                                    `position_ids` and `labels`
+    """
+    samples = batch["input_ids"]
+    blocks = plan_blocks([len(ids) for ids in samples], block_size)
+
+    packed = {"input_ids": [], "attention_mask": [],
+              "position_ids": [], "labels": []}
+    for block in blocks:
+        input_ids, segments, positions, labels = [], [], [], []
+        for segment, i in enumerate(block, start=1):
+            ids = samples[i][:block_size]
+            input_ids.extend(ids)
+            segments.extend([segment] * len(ids))
+            positions.extend(range(len(ids)))
+            labels.append(-100)
+            labels.extend(ids[1:])
+        packed["input_ids"].append(input_ids)
+        packed["attention_mask"].append(segments)
+        packed["position_ids"].append(positions)
+        packed["labels"].append(labels)
+    return packed
+
+
+_original_decoder_attention_mask = \
+    modeling_llama.LlamaModel._prepare_decoder_attention_mask
+
+
+def _packed_decoder_attention_mask(self,
+                                   attention_mask: torch.Tensor,
+                                   input_shape: torch.Size,
+                                   inputs_embeds: torch.Tensor,
+                                   past_key_values_length: int
+                                   ) -> torch.Tensor:
+    # Causal mask inside each sample of a packed block: a token attends to
+    # earlier tokens with the same segment id, padding (0) to nothing
+    if past_key_values_length or attention_mask is None:
+        return _original_decoder_attention_mask(
+            self, attention_mask, input_shape, inputs_embeds,
+            past_key_values_length
+        )
+    seq_length = input_shape[-1]
+    causal = torch.ones((seq_length, seq_length), dtype=torch.bool,
+                        device=attention_mask.device).tril()
+    allowed = (attention_mask[:, :, None] == attention_mask[:, None, :]) \
+        & (attention_mask[:, None, :] > 0) & causal
+    mask = torch.zeros(allowed.shape, dtype=inputs_embeds.dtype,
+                       device=inputs_embeds.device)
+    mask.masked_fill_(~allowed, torch.finfo(inputs_embeds.dtype).min)
+    return mask[:, None]
+
+
+def enable_packed_attention() -> NoReturn:
+    """
+    Make LLaMa read `attention_mask` as segment ids of packed samples.
+    Plain 0/1 masks of right-padded batches keep working.
+    """
+    modeling_llama.LlamaModel._prepare_decoder_attention_mask = \
+        _packed_decoder_attention_mask
+
+
+def peak_memory_bytes() -> int:
+    """
+    Peak memory allocated on the GPU, peak resident memory of the process
+    on CPU
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated()
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class _TokenCounter:
+    """
+    Real and padded tokens of collated batches, shared with dataloader
+    worker processes that run the collator
+    """
+
+    def __init__(self):
+        self._real_tokens = multiprocessing.Value("q", 0)
+        self._total_tokens = multiprocessing.Value("q", 0)
+
+    @property
+    def real_tokens(self) -> int:
+        return self._real_tokens.value
+
+    @property
+    def total_tokens(self) -> int:
+        return self._total_tokens.value
+
+    def _count(self, real_tokens: int, total_tokens: int) -> NoReturn:
+        with self._real_tokens.get_lock():
+            self._real_tokens.value += real_tokens
+        with self._total_tokens.get_lock():
+            self._total_tokens.value += total_tokens
+
+
+class PackedDataCollator(_TokenCounter):
+    """
+    Pads packed blocks to the longest one in the batch and counts real
+    and padded tokens
+    """
+
+    def __init__(self, pad_token_id: int):
+        super().__init__()
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features: List[dict]) -> Dict[str, torch.Tensor]:
+        max_length = max(len(feature["input_ids"]) for feature in features)
+        pad_values = {"input_ids": self.pad_token_id, "attention_mask": 0,
+                      "position_ids": 0, "labels": -100}
+        batch = {
+            key: torch.tensor([
+                list(feature[key]) +
+                [value] * (max_length - len(feature[key]))
+                for feature in features
+            ])
+            for key, value in pad_values.items()
+        }
+        self._count(sum(len(feature["input_ids"]) for feature in features),
+                    batch["input_ids"].numel())
+        return batch
+
+
+class PaddingStatsCollator(_TokenCounter):
+    """
+    Wraps a collator and counts real and padded tokens of its batches
+    """
+
+    def __init__(self, collator: transformers.DataCollator):
+        super().__init__()
+        self.collator = collator
+
+    def __call__(self, features: List[dict]) -> Dict[str, torch.Tensor]:
+        batch = self.collator(features)
+        self._count(int(batch["attention_mask"].sum()),
+                    batch["attention_mask"].numel())
+        return batch
+
+
+class ThroughputCallback(transformers.TrainerCallback):
+    """
+    Logs padding efficiency, real tokens per second and peak memory of
+    training, to the console so it works without any experiment tracker.
+    Tokens are counted when batches are collated, so with dataloader
+    workers the count runs ahead by the prefetched batches.
+    """
+
+    def __init__(self,
+                 collator: Union[PackedDataCollator, PaddingStatsCollator]):
+        self.collator = collator
+        self.start = None
+        # Time and real tokens of the previous log
+        self._last = (None, 0)
+
+    def stats(self) -> dict:
+        now = time.perf_counter()
+        last_time, last_tokens = self._last
+        real_tokens = self.collator.real_tokens
+        return {
+            "padding_efficiency":
+                real_tokens / max(self.collator.total_tokens, 1),
+            "tokens_per_second": real_tokens / (now - self.start),
+            "interval_tokens_per_second":
+                (real_tokens - last_tokens) / max(now - last_time, 1e-9),
+            "peak_memory_bytes": peak_memory_bytes()
+        }
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start = time.perf_counter()
+        self._last = (self.start, self.collator.real_tokens)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if self.start is None:
+            return
+        stats = self.stats()
+        self._last = (time.perf_counter(), self.collator.real_tokens)
+        logging.info("Step %d: padding efficiency %.1f%%, %.0f tokens/s "
+                     "(%.0f since the last log), peak memory %.0f MiB",
+                     state.global_step,
+                     stats["padding_efficiency"] * 100,
+                     stats["tokens_per_second"],
+                     stats["interval_tokens_per_second"],
+                     stats["peak_memory_bytes"] / 2 ** 20)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        stats = self.stats()
+        logging.info("Training padding efficiency %.1f%%, %.0f tokens/s, "
+                     "peak memory %.0f MiB",
+                     stats["padding_efficiency"] * 100,
+                     stats["tokens_per_second"],
+                     stats["peak_memory_bytes"] / 2 ** 20)
@@ -1,12 +1,24 @@
 """
 Data preparation scripts for fine-tuning
+
+Usage (from src/):
+    python3 prepare_data.py --num-proc 8
 """
+import argparse
+import json
 import logging
-from typing import Union, List, NoReturn
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union, List, NoReturn, Sequence
 from pathlib import Path
 
 import pandas as pd
-from datasets import load_dataset, Dataset, concatenate_datasets
+from datasets import (
+    load_dataset,
+    load_from_disk,
+    Dataset,
+    concatenate_datasets
+)
+from datasets.fingerprint import Hasher
 
 from prompt_templates import (
     USER_PROMPT,
@@ -20,6 +32,12 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# Contexts of the most negative sentiments left out of the data
+NEGATIVE_CONTEXTS = ["angry", "jealous", "disgusted", "annoyed",
+                     "anxious", "devastated", "terrified", "furious"]
+# Written next to every prepared split to skip unchanged ones
+FINGERPRINT_FILE = "preparation.json"
+
 
 def concat_dialogue(messages: Union[List[str], pd.Series],
                     system_prompt: str) -> str:
@@ -46,6 +64,24 @@ def concat_dialogue(messages: Union[List[str], pd.Series],
     return system_prompt + " ".join(messages)
 
 
+def format_messages(messages: pd.Series, is_user: pd.Series) -> pd.Series:
+    """
+    Vectorized `concat_dialogue` formatting of single messages
+
+    Args:
+        messages (pd.Series): message texts
+        is_user (pd.Series): whether a message is a user one
+
+    Returns:
+        pd.Series: messages in the prompt format
+    """
+    user_prefix, user_suffix = USER_PROMPT.split("{user_message}")
+    model_prefix, model_suffix = MODEL_OUTPUT.split("{model_output}")
+    messages = messages.str.strip()
+    return (user_prefix + messages + user_suffix) \
+        .where(is_user, model_prefix + messages + model_suffix)
+
+
 def prepare_empathetic_dataset(dataset: Dataset) -> Dataset:
     """
     Prepare the given empathetic dataset into suitable LLM format
@@ -56,77 +92,198 @@ def prepare_empathetic_dataset(dataset: Dataset) -> Dataset:
     Returns:
         Dataset: prepared dataset
     """
-    dataset.set_format("pandas")
-    df = dataset[:]
+    df = dataset.to_pandas()[["conv_id", "context", "utterance"]]
     # Filter out the most negative sentiments
-    negative_contexts = ["angry", "jealous", "disgusted", "annoyed",
-                         "anxious", "devastated", "terrified", "furious"]
-    df = df[~df.context.isin(negative_contexts)]
+    df = df[~df.context.isin(NEGATIVE_CONTEXTS)]
     # Filter out conversations with less than 1 sentence (they are buggy and useless)
-    conv_sizes = df.groupby(["conv_id"]).size()
-    convs2keep = conv_sizes[conv_sizes > 1].index
-    df = df[df.conv_id.isin(convs2keep)]
-    # Concat dialogues
-    df_grouped = df.groupby(["conv_id"]).utterance \
-                   .apply(
-        lambda x: concat_dialogue(x, EMPATHETIC_SYSTEM_PROMPT)
-        ).reset_index()
-    df_grouped = df_grouped.rename(columns={"utterance": "sample"})
-    df_grouped["sample"] = df_grouped["sample"].str.replace("_comma_", ", ")
-    df_grouped = df_grouped[["sample"]]
-    dataset_prepared = Dataset.from_pandas(df_grouped)
+    conv_sizes = df.groupby("conv_id").conv_id.transform("size")
+    df = df[conv_sizes > 1]
+    # Concat dialogues: messages alternate starting from the user
+    is_user = df.groupby("conv_id").cumcount() % 2 == 0
+    messages = format_messages(df.utterance, is_user)
+    samples = messages.groupby(df.conv_id).agg(" ".join)
+    samples = (EMPATHETIC_SYSTEM_PROMPT + samples) \
+        .str.replace("_comma_", ", ", regex=False)
+    dataset_prepared = Dataset.from_pandas(samples.to_frame("sample"),
+                                           preserve_index=False)
 
     return dataset_prepared
 
 
-def prepare_daily_dataset(dataset: Dataset) -> Dataset:
+def concat_daily_batch(batch: dict) -> dict:
     """
-    Prepare the given empathetic dataset into suitable LLM format
+    Concatenate a batch of daily dialogues, see `concat_dialogue`
+    """
+    return {"sample": [concat_dialogue(list(dialog), DAILY_SYSTEM_PROMPT)
+                       for dialog in batch["dialog"]]}
+
+
+def prepare_daily_dataset(dataset: Dataset,
+                          num_proc: Union[int, None] = None) -> Dataset:
+    """
+    Prepare the given daily dialog dataset into suitable LLM format
 
     Args:
         dataset (Dataset): dataset
+        num_proc (Union[int, None], optional): Processes for the map.
+                                               Defaults to None.
 
     Returns:
         Dataset: prepared dataset
     """
-    dataset.set_format("pandas")
-    df = dataset[:]
-    df_grouped = df.dialog.apply(
-        lambda x: concat_dialogue(x, DAILY_SYSTEM_PROMPT)
-        )
-    df_grouped = df_grouped.reset_index() \
-                           .drop(["index"], axis=1) \
-                           .rename(columns={"dialog": "sample"})
-    dataset_prepared = Dataset.from_pandas(df_grouped)
+    dataset_prepared = dataset.map(concat_daily_batch,
+                                   batched=True,
+                                   num_proc=num_proc,
+                                   remove_columns=dataset.column_names,
+                                   desc="Concatenating daily dialogues")
 
     return dataset_prepared
 
 
-def prepare_data() -> NoReturn:
+def load_source(source: str, split: str) -> Dataset:
+    """
+    Load a split from a `save_to_disk` directory, local data files or
+    the hub (served from the local cache with HF_DATASETS_OFFLINE=1)
+
+    Args:
+        source (str): dataset name or local path
+        split (str): split name
+
+    Returns:
+        Dataset: dataset split
+    """
+    if Path(source).joinpath("dataset_dict.json").exists():
+        return load_from_disk(source)[split]
+    return load_dataset(source, split=split)
+
+
+def prepare_split(split: str,
+                  output_dir: Union[str, Path],
+                  empathetic_source: str,
+                  daily_source: str,
+                  num_proc: Union[int, None] = None,
+                  force: bool = False) -> str:
     """
-    Loads datasets, concatenates them and saves separate splits
+    Prepare one split unless it is already prepared from the same inputs
+
+    Args:
+        split (str): split name
+        output_dir (Union[str, Path]): where to save the split
+        empathetic_source (str): empathetic dialogues name or path
+        daily_source (str): daily dialog name or path
+        num_proc (Union[int, None], optional): Processes for the maps.
+                                               Defaults to None.
+        force (bool, optional): Prepare even if unchanged.
+                                Defaults to False.
+
+    Returns:
+        str: split name
+    """
+    emp_dataset = load_source(empathetic_source, split)
+    daily_dataset = load_source(daily_source, split)
+
+    # Datasets fingerprint their content, the code and templates are
+    # hashed too so any change of the preparation invalidates the split
+    fingerprint = Hasher.hash([
+        emp_dataset._fingerprint,
+        daily_dataset._fingerprint,
+        prepare_empathetic_dataset,
+        concat_daily_batch,
+        NEGATIVE_CONTEXTS,
+        EMPATHETIC_SYSTEM_PROMPT,
+        DAILY_SYSTEM_PROMPT,
+        USER_PROMPT,
+        MODEL_OUTPUT
+    ])
+    split_dir = Path(output_dir).joinpath(f"{split}.hf")
+    fingerprint_path = split_dir.joinpath(FINGERPRINT_FILE)
+    if not force and fingerprint_path.exists():
+        with open(fingerprint_path) as fp:
+            if json.load(fp).get("fingerprint") == fingerprint:
+                logging.info(f"'{split}' split is up to date")
+                return split
+
+    logging.info(f"Preparing '{split}' split")
+    emp_dataset_prep = prepare_empathetic_dataset(emp_dataset)
+    daily_dataset_prep = prepare_daily_dataset(daily_dataset, num_proc)
+    split_concat = concatenate_datasets([emp_dataset_prep,
+                                         daily_dataset_prep])
+    split_concat.save_to_disk(str(split_dir))
+    with open(fingerprint_path, "w") as fp:
+        json.dump({"fingerprint": fingerprint,
+                   "num_samples": len(split_concat)}, fp)
+    logging.info(f"'{split}' split saved: {len(split_concat)} samples")
+    return split
+
+
+def prepare_data(output_dir: Union[str, Path] = "../data/",
+                 empathetic_source: str = "empathetic_dialogues",
+                 daily_source: str = "daily_dialog",
+                 splits: Sequence[str] = ("train", "validation", "test"),
+                 num_proc: Union[int, None] = None,
+                 split_workers: int = 3,
+                 force: bool = False) -> NoReturn:
+    """
+    Loads datasets, concatenates them and saves separate splits,
+    several splits at once
+
+    Args:
+        output_dir (Union[str, Path], optional): Where to save splits.
+                                                 Defaults to "../data/".
+        empathetic_source (str, optional): Empathetic dialogues name or
+                                           local path. Defaults to
+                                           "empathetic_dialogues".
+        daily_source (str, optional): Daily dialog name or local path.
+                                      Defaults to "daily_dialog".
+        splits (Sequence[str], optional): Splits to prepare.
+                                          Defaults to all three.
+        num_proc (Union[int, None], optional): Processes for every map.
+                                               Defaults to None.
+        split_workers (int, optional): Splits prepared at once.
+                                       Defaults to 3.
+        force (bool, optional): Prepare unchanged splits too.
+                                Defaults to False.
 
     Returns:
         NoReturn
     """
-    data_dir = Path("../data/")
-    dataset_name1 = "empathetic_dialogues"
-    dataset_name2 = "daily_dialog"
-
-    splits = ["train", "validation", "test"]
-    for split in splits:
-        logging.info("Preparing '{split}' split")
-        logging.info("Preparing empathetic dialogues")
-        emp_dataset = load_dataset(dataset_name1, split=split)
-        emp_dataset_prep = prepare_empathetic_dataset(emp_dataset)
-        logging.info("Preparing daily dialogues")
-        daily_dataset = load_dataset(dataset_name2, split=split)
-        daily_dataset_prep = prepare_daily_dataset(daily_dataset)
-        logging.info("Concatenating datasets and saving current split to disk")
-        split_concat = concatenate_datasets([emp_dataset_prep,
-                                             daily_dataset_prep])
-        split_concat.save_to_disk(data_dir.joinpath(f"{split}.hf"))
+    if split_workers <= 1:
+        for split in splits:
+            prepare_split(split, output_dir, empathetic_source, daily_source,
+                          num_proc, force)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(split_workers,
+                                             len(splits))) as executor:
+        futures = [executor.submit(prepare_split, split, output_dir,
+                                   empathetic_source, daily_source,
+                                   num_proc, force)
+                   for split in splits]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
-    prepare_data()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output-dir", default="../data/")
+    parser.add_argument("--empathetic", default="empathetic_dialogues",
+                        help="dataset name or local path")
+    parser.add_argument("--daily", default="daily_dialog",
+                        help="dataset name or local path")
+    parser.add_argument("--splits", nargs="+",
+                        default=["train", "validation", "test"])
+    parser.add_argument("--num-proc", type=int, default=None,
+                        help="processes for every map, per split")
+    parser.add_argument("--split-workers", type=int, default=3,
+                        help="splits prepared at once")
+    parser.add_argument("--force", action="store_true",
+                        help="prepare splits even if inputs are unchanged")
+    args = parser.parse_args()
+
+    prepare_data(output_dir=args.output_dir,
+                 empathetic_source=args.empathetic,
+                 daily_source=args.daily,
+                 splits=args.splits,
+                 num_proc=args.num_proc,
+                 split_workers=args.split_workers,
+                 force=args.force)
@@ -0,0 +1,451 @@
+"""
+Batched offline evaluation of the base model or the fine-tuned adapter
+on the test split: perplexity and generated replies
+
+Samples are processed in length-sorted batches, split into shards run by
+worker processes. Results are appended to JSON lines files after every
+batch, so a re-run with the same output directory resumes where it
+stopped. The report has the quality metrics and the throughput of the
+run and is comparable between models evaluated with the same arguments.
+
+Usage (from src/):
+    python3 run_evaluation.py --output-dir ../evaluation/base
+    python3 run_evaluation.py \
+        --adapter ../models/llama-chat-7b-lora-friendly-dialogue \
+        --output-dir ../evaluation/adapter --num-workers 2
+"""
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, NoReturn, Tuple, Union
+
+import torch
+import torch.nn.functional as F
+import transformers
+from datasets import load_from_disk
+from transformers import AutoTokenizer, LlamaForCausalLM
+from peft import PeftModel
+
+from token_cache import TokenCache, build_token_cache
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+RUN_FILE = "run.json"
+REPORT_FILE = "report.json"
+# Arguments that change the results, a resumed run must match them
+RESULT_ARGS = ("model", "adapter", "data", "max_samples", "max_seq_length",
+               "max_prompt_tokens", "max_new_tokens", "torch_dtype")
+
+
+def split_dialogue(sample: str) -> Tuple[str, str]:
+    """
+    Split a prepared dialogue into the prompt up to the last user message
+    and the model reply to it
+
+    Args:
+        sample (str): dialogue in the fine-tuning format
+
+    Returns:
+        Tuple[str, str]: prompt and reference reply
+    """
+    prompt, _, reference = sample.rpartition("[/INST]")
+    reference = reference.split("</s>")[0].strip()
+    return prompt + "[/INST]", reference
+
+
+def token_f1(reply: str, reference: str) -> float:
+    """
+    F1 of the lowercased words of the reply and the reference
+    """
+    reply_words = Counter(reply.lower().split())
+    reference_words = Counter(reference.lower().split())
+    common = sum((reply_words & reference_words).values())
+    if not common:
+        return 0.0
+    precision = common / sum(reply_words.values())
+    recall = common / sum(reference_words.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def distinct_n(replies: List[str], n: int) -> float:
+    """
+    Share of distinct word n-grams among all n-grams of the replies
+    """
+    ngrams = Counter()
+    for reply in replies:
+        words = reply.lower().split()
+        ngrams.update(zip(*[words[i:] for i in range(n)]))
+    return len(ngrams) / max(sum(ngrams.values()), 1)
+
+
+def load_model(model_path: str,
+               adapter_path: Union[str, None] = None,
+               torch_dtype: torch.dtype = torch.float32,
+               device: str = "cpu"
+               ) -> Tuple[LlamaForCausalLM, transformers.PreTrainedTokenizer]:
+    """
+    Load the base model with the adapter merged into it
+
+    Args:
+        model_path (str): base model name or path
+        adapter_path (Union[str, None], optional): LoRA adapter weights.
+                                                   Defaults to None.
+        torch_dtype (torch.dtype, optional): Weights type.
+                                             Defaults to torch.float32.
+        device (str, optional): Device. Defaults to "cpu".
+
+    Returns:
+        Tuple[LlamaForCausalLM, transformers.PreTrainedTokenizer]: model
+                                                                   and
+                                                                   tokenizer
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = LlamaForCausalLM.from_pretrained(model_path,
+                                             torch_dtype=torch_dtype)
+    if adapter_path:
+        model = PeftModel.from_pretrained(model, adapter_path)
+        model = model.merge_and_unload()
+    return model.to(device).eval(), tokenizer
+
+
+def length_sorted_batches(lengths: List[int],
+                          indices: List[int],
+                          batch_size: int) -> Iterator[List[int]]:
+    """
+    Batches of sample indices of similar lengths, longest first so that
+    running out of memory happens at the start
+    """
+    indices = sorted(indices, key=lambda i: lengths[i], reverse=True)
+    for start in range(0, len(indices), batch_size):
+        yield indices[start:start + batch_size]
+
+
+def pad(sequences: List[List[int]],
+        pad_value: int,
+        left: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Pad sequences to the longest one
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: padded ids and attention mask
+    """
+    max_length = max(len(sequence) for sequence in sequences)
+    ids, mask = [], []
+    for sequence in sequences:
+        padding = [pad_value] * (max_length - len(sequence))
+        ones, zeros = [1] * len(sequence), [0] * len(padding)
+        ids.append(padding + sequence if left else sequence + padding)
+        mask.append(zeros + ones if left else ones + zeros)
+    return torch.tensor(ids), torch.tensor(mask)
+
+
+def load_done(path: Path) -> Dict[int, dict]:
+    """
+    Rows of a results file by sample index, a row cut by an interruption
+    is dropped
+    """
+    done = {}
+    if path.exists():
+        with open(path) as fp:
+            for line in fp:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[row["index"]] = row
+    return done
+
+
+def append_rows(path: Path, rows: List[dict]) -> NoReturn:
+    with open(path, "a") as fp:
+        for row in rows:
+            fp.write(json.dumps(row) + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+@torch.no_grad()
+def evaluate_perplexity(model: LlamaForCausalLM,
+                        cache: TokenCache,
+                        indices: List[int],
+                        batch_size: int,
+                        results_path: Path) -> Tuple[int, float]:
+    """
+    Negative log-likelihood of every sample in batched forward passes
+
+    Returns:
+        Tuple[int, float]: tokens scored and seconds spent in this run
+    """
+    done = load_done(results_path)
+    todo = [i for i in indices if i not in done]
+    lengths = cache.lengths
+    num_tokens, start = 0, time.perf_counter()
+    for batch in length_sorted_batches(lengths, todo, batch_size):
+        input_ids, attention_mask = pad([cache[i].tolist() for i in batch], 0)
+        input_ids = input_ids.to(model.device)
+        attention_mask = attention_mask.to(model.device)
+        logits = model(input_ids=input_ids,
+                       attention_mask=attention_mask).logits[:, :-1]
+        nll = F.cross_entropy(logits.transpose(1, 2).float(),
+                              input_ids[:, 1:], reduction="none")
+        mask = attention_mask[:, 1:]
+        nll = (nll * mask).sum(-1)
+        append_rows(results_path, [
+            {"index": i,
+             "nll": float(nll[row]),
+             "tokens": int(mask[row].sum())}
+            for row, i in enumerate(batch)
+        ])
+        num_tokens += int(mask.sum())
+    return num_tokens, time.perf_counter() - start
+
+
+@torch.no_grad()
+def evaluate_generation(model: LlamaForCausalLM,
+                        tokenizer: transformers.PreTrainedTokenizer,
+                        samples: List[str],
+                        indices: List[int],
+                        batch_size: int,
+                        max_prompt_tokens: int,
+                        max_new_tokens: int,
+                        results_path: Path) -> Tuple[int, float]:
+    """
+    Greedy replies to the last user message of every sample, generated
+    in left-padded batches
+
+    Returns:
+        Tuple[int, float]: tokens generated and seconds spent in this run
+    """
+    done = load_done(results_path)
+    todo = [i for i in indices if i not in done]
+    dialogues = {i: split_dialogue(samples[i]) for i in todo}
+    prompt_ids = {}
+    for i in todo:
+        ids = tokenizer(dialogues[i][0]).input_ids
+        # The end of long dialogues is kept, after the BOS token
+        if len(ids) > max_prompt_tokens:
+            ids = ids[:1] + ids[len(ids) - max_prompt_tokens + 1:]
+        prompt_ids[i] = ids
+    lengths = {i: len(ids) for i, ids in prompt_ids.items()}
+    pad_token_id = tokenizer.eos_token_id
+    num_tokens, start = 0, time.perf_counter()
+    for batch in length_sorted_batches(lengths, todo, batch_size):
+        input_ids, attention_mask = pad([prompt_ids[i] for i in batch],
+                                        pad_token_id, left=True)
+        output = model.generate(input_ids=input_ids.to(model.device),
+                                attention_mask=attention_mask.to(model.device),
+                                max_new_tokens=max_new_tokens,
+                                do_sample=False,
+                                pad_token_id=pad_token_id)
+        rows = []
+        for row, i in enumerate(batch):
+            new_tokens = output[row, input_ids.shape[1]:]
+            new_tokens = new_tokens[new_tokens != pad_token_id]
+            reply = tokenizer.decode(new_tokens, skip_special_tokens=True)
+            reply = reply.split("[INST]")[0].strip()
+            reference = dialogues[i][1]
+            rows.append({"index": i,
+                         "prompt_tokens": lengths[i],
+                         "reply_tokens": len(new_tokens),
+                         "reply": reply,
+                         "reference": reference,
+                         "token_f1": token_f1(reply, reference)})
+            num_tokens += len(new_tokens)
+        append_rows(results_path, rows)
+    return num_tokens, time.perf_counter() - start
+
+
+def evaluate_shard(shard: int,
+                   num_shards: int,
+                   args: dict,
+                   cache_path: str) -> dict:
+    """
+    Evaluate every `num_shards`-th sample of the length-sorted split,
+    starting from `shard`
+
+    Returns:
+        dict: tokens and seconds of this run
+    """
+    torch_dtype = args["torch_dtype"]
+    if torch.cuda.is_available():
+        device = f"cuda:{shard % torch.cuda.device_count()}"
+        if torch_dtype == "auto":
+            torch_dtype = "float16"
+    else:
+        device = "cpu"
+        torch.set_num_threads(max(os.cpu_count() // num_shards, 1))
+        # Half precision matmuls are not implemented on CPU
+        if torch_dtype in ("auto", "float16"):
+            torch_dtype = "float32"
+    model, tokenizer = load_model(args["model"], args["adapter"],
+                                  getattr(torch, torch_dtype), device)
+    output_dir = Path(args["output_dir"])
+
+    cache = TokenCache(cache_path)
+    num_samples = min(len(cache), args["max_samples"] or len(cache))
+    # Interleaved over the length order, so shards get similar work
+    lengths = cache.lengths
+    order = sorted(range(num_samples), key=lambda i: lengths[i])
+    indices = order[shard::num_shards]
+
+    stats = {}
+    if not args["skip_perplexity"]:
+        results_path = output_dir.joinpath(f"perplexity-{shard}.jsonl")
+        stats["perplexity_tokens"], stats["perplexity_seconds"] = \
+            evaluate_perplexity(model, cache, indices,
+                                args["perplexity_batch_size"], results_path)
+        logging.info(f"Shard {shard}: perplexity done")
+    if not args["skip_generation"]:
+        samples = load_from_disk(args["data"])["sample"]
+        results_path = output_dir.joinpath(f"generations-{shard}.jsonl")
+        stats["generated_tokens"], stats["generation_seconds"] = \
+            evaluate_generation(model, tokenizer, samples, indices,
+                                args["generation_batch_size"],
+                                args["max_prompt_tokens"],
+                                args["max_new_tokens"],
+                                results_path)
+        logging.info(f"Shard {shard}: generation done")
+    return stats
+
+
+def build_report(output_dir: Path, args: dict, runs: List[dict]) -> dict:
+    """
+    Quality metrics of all results and throughput of this run
+    """
+    perplexity_rows, generation_rows = {}, {}
+    for shard in range(args["num_workers"]):
+        perplexity_rows.update(
+            load_done(output_dir.joinpath(f"perplexity-{shard}.jsonl"))
+        )
+        generation_rows.update(
+            load_done(output_dir.joinpath(f"generations-{shard}.jsonl"))
+        )
+
+    report = {"args": {key: args[key] for key in RESULT_ARGS},
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    if perplexity_rows:
+        nll = sum(row["nll"] for row in perplexity_rows.values())
+        tokens = sum(row["tokens"] for row in perplexity_rows.values())
+        report["perplexity"] = {"samples": len(perplexity_rows),
+                                "tokens": tokens,
+                                "perplexity": math.exp(nll / max(tokens, 1))}
+    if generation_rows:
+        replies = [row["reply"] for row in generation_rows.values()]
+        report["generation"] = {
+            "samples": len(generation_rows),
+            "token_f1": sum(row["token_f1"]
+                            for row in generation_rows.values()) /
+            len(generation_rows),
+            "distinct_1": distinct_n(replies, 1),
+            "distinct_2": distinct_n(replies, 2),
+            "mean_reply_tokens": sum(row["reply_tokens"]
+                                     for row in generation_rows.values()) /
+            len(generation_rows)
+        }
+
+    # Shards run at once, so a phase takes as long as its slowest shard
+    throughput = {}
+    for phase, tokens_key, seconds_key in (
+            ("perplexity", "perplexity_tokens", "perplexity_seconds"),
+            ("generation", "generated_tokens", "generation_seconds")):
+        seconds = max((run.get(seconds_key, 0.0) for run in runs), default=0)
+        tokens = sum(run.get(tokens_key, 0) for run in runs)
+        if tokens:
+            throughput[phase] = {"tokens": tokens,
+                                 "seconds": seconds,
+                                 "tokens_per_second": tokens / seconds}
+    report["throughput"] = throughput
+    return report
+
+
+def run_evaluation(args: dict) -> dict:
+    """
+    Evaluate in `num_workers` processes, resuming results of a previous
+    run with the same arguments in `output_dir`, and save the report
+
+    Args:
+        args (dict): command line arguments
+
+    Returns:
+        dict: report
+    """
+    output_dir = Path(args["output_dir"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    run_path = output_dir.joinpath(RUN_FILE)
+    run = {key: args[key] for key in RESULT_ARGS + ("num_workers",)}
+    if run_path.exists() and not args["overwrite"]:
+        with open(run_path) as fp:
+            previous = json.load(fp)
+        if previous != run:
+            raise ValueError(f"{output_dir} has results of other arguments "
+                             f"{previous}, pass --overwrite to start over")
+        logging.info(f"Resuming the evaluation in {output_dir}")
+    elif args["overwrite"]:
+        for path in output_dir.glob("*.jsonl"):
+            path.unlink()
+    with open(run_path, "w") as fp:
+        json.dump(run, fp)
+
+    # Built once here, shards only read it
+    tokenizer = AutoTokenizer.from_pretrained(args["model"])
+    cache_path = str(build_token_cache(tokenizer, args["data"],
+                                       args["token_cache_dir"],
+                                       args["max_seq_length"]))
+
+    num_workers = args["num_workers"]
+    if num_workers <= 1:
+        runs = [evaluate_shard(0, 1, args, cache_path)]
+    else:
+        # CUDA can't be used in forked processes
+        with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(evaluate_shard, shard, num_workers,
+                                       args, cache_path)
+                       for shard in range(num_workers)]
+            runs = [future.result() for future in futures]
+
+    report = build_report(output_dir, args, runs)
+    with open(output_dir.joinpath(REPORT_FILE), "w") as fp:
+        json.dump(report, fp, indent=2)
+    logging.info(f"Report saved to {output_dir.joinpath(REPORT_FILE)}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="meta-llama/Llama-2-7b-chat-hf")
+    parser.add_argument("--adapter", default=None,
+                        help="LoRA adapter weights, the base model if not set")
+    parser.add_argument("--data", default="../data/test.hf/")
+    parser.add_argument("--output-dir", default="../evaluation/")
+    parser.add_argument("--token-cache-dir", default="../data/token_cache/")
+    parser.add_argument("--max-samples", type=int, default=None)
+    parser.add_argument("--max-seq-length", type=int, default=1024)
+    parser.add_argument("--max-prompt-tokens", type=int, default=1024)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--perplexity-batch-size", type=int, default=8)
+    parser.add_argument("--generation-batch-size", type=int, default=8)
+    parser.add_argument("--torch-dtype", default="auto",
+                        choices=["auto", "float16", "bfloat16", "float32"],
+                        help="auto is float16 on GPU and float32 on CPU")
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="processes, each on its own GPU if there are")
+    parser.add_argument("--skip-perplexity", action="store_true")
+    parser.add_argument("--skip-generation", action="store_true")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="drop results of a previous run")
+    args = parser.parse_args()
+
+    report = run_evaluation(vars(args))
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,290 @@
+"""
+Memory-mapped cache of tokenized data splits
+
+A split is tokenized once into a flat array of token ids and an index of
+sample offsets, in a directory named after the split, the tokenizer and
+the data fingerprints. Training opens it without loading anything into
+memory. Any tokenizer or data change builds a new cache.
+
+Usage (from src/):
+    python3 token_cache.py ../data/train.hf ../data/validation.hf
+"""
+import argparse
+import json
+import logging
+import shutil
+from pathlib import Path
+from typing import Dict, Iterator, List, Union
+
+import numpy as np
+import torch
+import transformers
+from datasets import load_from_disk
+from datasets.fingerprint import Hasher
+from transformers.trainer_pt_utils import (
+    DistributedLengthGroupedSampler,
+    LengthGroupedSampler
+)
+
+from packing import pack_sequences, plan_blocks
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+TOKENS_FILE = "tokens.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+# Samples tokenized at once while building a cache
+TOKENIZE_BATCH_SIZE = 1000
+
+
+def cache_path(tokenizer: transformers.PreTrainedTokenizer,
+               data_path: str,
+               cache_dir: str,
+               max_seq_length: Union[int, None] = None) -> Path:
+    """
+    Cache directory of a split tokenized by the tokenizer
+
+    Args:
+        tokenizer (transformers.PreTrainedTokenizer): model tokenizer
+        data_path (str): `save_to_disk` directory of the split
+        cache_dir (str): directory of all caches
+        max_seq_length (Union[int, None], optional): Truncation length.
+                                                     Defaults to None.
+
+    Returns:
+        Path: cache directory
+    """
+    dataset = load_from_disk(data_path)
+    fingerprint = Hasher.hash([dataset._fingerprint, tokenizer,
+                               max_seq_length])
+    name = Path(data_path.rstrip("/")).stem
+    return Path(cache_dir).joinpath(f"{name}-{fingerprint}")
+
+
+def build_token_cache(tokenizer: transformers.PreTrainedTokenizer,
+                      data_path: str,
+                      cache_dir: str,
+                      max_seq_length: Union[int, None] = None,
+                      force: bool = False) -> Path:
+    """
+    Tokenize the "sample" column of a split into a cache, unless it is
+    already there
+
+    Args:
+        tokenizer (transformers.PreTrainedTokenizer): model tokenizer
+        data_path (str): `save_to_disk` directory of the split
+        cache_dir (str): directory of all caches
+        max_seq_length (Union[int, None], optional): Truncation length.
+                                                     Defaults to None.
+        force (bool, optional): Rebuild an existing cache.
+                                Defaults to False.
+
+    Returns:
+        Path: cache directory
+    """
+    path = cache_path(tokenizer, data_path, cache_dir, max_seq_length)
+    if not force and path.joinpath(META_FILE).exists():
+        logging.info(f"Token cache {path} is up to date")
+        return path
+
+    # Written next to the cache and renamed, so a broken run leaves no cache
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    dtype = np.uint16 if len(tokenizer) <= 2 ** 16 else np.int32
+    samples = load_from_disk(data_path)["sample"]
+    offsets = [0]
+    num_truncated = 0
+    with open(tmp_path.joinpath(TOKENS_FILE), "wb") as fp:
+        for start in range(0, len(samples), TOKENIZE_BATCH_SIZE):
+            input_ids = tokenizer(
+                samples[start:start + TOKENIZE_BATCH_SIZE]
+            ).input_ids
+            # Truncated after tokenizing to count the truncated samples
+            if max_seq_length is not None:
+                num_truncated += sum(len(ids) > max_seq_length
+                                     for ids in input_ids)
+                input_ids = [ids[:max_seq_length] for ids in input_ids]
+            for ids in input_ids:
+                offsets.append(offsets[-1] + len(ids))
+            fp.write(np.concatenate(input_ids).astype(dtype).tobytes())
+    np.save(tmp_path.joinpath(OFFSETS_FILE), np.array(offsets, np.int64))
+    with open(tmp_path.joinpath(META_FILE), "w") as fp:
+        json.dump({"data_path": data_path,
+                   "tokenizer": tokenizer.name_or_path,
+                   "max_seq_length": max_seq_length,
+                   "dtype": np.dtype(dtype).name,
+                   "num_samples": len(samples),
+                   "num_truncated": num_truncated,
+                   "num_tokens": offsets[-1]}, fp)
+
+    shutil.rmtree(path, ignore_errors=True)
+    tmp_path.rename(path)
+    logging.info(f"Token cache {path}: {len(samples)} samples, "
+                 f"{num_truncated} truncated to {max_seq_length} tokens, "
+                 f"{offsets[-1]} tokens")
+    return path
+
+
+class TokenCache:
+    """
+    Read-only view of a token cache, samples are read from the
+    memory-mapped file on access
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        with open(path.joinpath(META_FILE)) as fp:
+            self.meta = json.load(fp)
+        self.offsets = np.load(path.joinpath(OFFSETS_FILE), mmap_mode="r")
+        # An empty file can't be memory-mapped
+        self.tokens = np.memmap(path.joinpath(TOKENS_FILE),
+                                dtype=self.meta["dtype"],
+                                mode="r") \
+            if self.meta["num_tokens"] else np.zeros(0, self.meta["dtype"])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Number of tokens of every sample
+        """
+        return np.diff(self.offsets)
+
+    def iter_batches(self, batch_size: int) -> Iterator[List[List[int]]]:
+        """
+        Token ids of consecutive samples in batches
+        """
+        for start in range(0, len(self), batch_size):
+            yield [self[i].tolist()
+                   for i in range(start, min(start + batch_size, len(self)))]
+
+
+class TokenCacheDataset(torch.utils.data.Dataset):
+    """
+    Tokenized samples of a cache for the Trainer, which shuffles them
+    with its sampler
+    """
+
+    def __init__(self, cache: TokenCache):
+        self.cache = cache
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __getitem__(self, index: int) -> Dict[str, List[int]]:
+        input_ids = self.cache[index].tolist()
+        return {"input_ids": input_ids, "attention_mask": [1] * len(input_ids)}
+
+    @property
+    def lengths(self) -> List[int]:
+        """
+        Number of tokens of every sample, from the cache index
+        """
+        return self.cache.lengths.tolist()
+
+
+class PackedTokenCacheDataset(torch.utils.data.Dataset):
+    """
+    Samples of a cache packed into blocks as by `pack_sequences`
+
+    Only the plan of which samples go into a block is kept in memory,
+    blocks are put together from the cache on access.
+    """
+
+    def __init__(self,
+                 cache: TokenCache,
+                 block_size: int,
+                 group_size: int = 1000):
+        """
+        Args:
+            cache (TokenCache): tokenized samples
+            block_size (int): maximum tokens in a block
+            group_size (int, optional): Consecutive samples packed
+                                        together, as a map batch.
+                                        Defaults to 1000.
+        """
+        self.cache = cache
+        self.block_size = block_size
+        lengths = cache.lengths
+        self.blocks: List[List[int]] = []
+        for start in range(0, len(cache), group_size):
+            group = lengths[start:start + group_size]
+            self.blocks.extend([start + i for i in block]
+                               for block in plan_blocks(group.tolist(),
+                                                        block_size))
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __getitem__(self, index: int) -> Dict[str, List[int]]:
+        packed = pack_sequences(
+            {"input_ids": [self.cache[i].tolist()
+                           for i in self.blocks[index]]},
+            self.block_size
+        )
+        return {key: values[0] for key, values in packed.items()}
+
+
+class TokenCacheTrainer(transformers.Trainer):
+    """
+    Trainer whose length-grouped sampler takes the sample lengths of a
+    `TokenCacheDataset` from the cache index
+
+    `Trainer` only reads lengths from a `datasets.Dataset` column, for
+    other datasets the sampler reads every sample once to measure it.
+    """
+
+    def _get_train_sampler(self) -> torch.utils.data.Sampler:
+        lengths = getattr(self.train_dataset, "lengths", None)
+        if not self.args.group_by_length or lengths is None:
+            return super()._get_train_sampler()
+
+        batch_size = self.args.train_batch_size \
+            * self.args.gradient_accumulation_steps
+        seed = self.args.data_seed if self.args.data_seed is not None \
+            else self.args.seed
+        if self.args.world_size <= 1:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            return LengthGroupedSampler(batch_size,
+                                        dataset=self.train_dataset,
+                                        lengths=lengths,
+                                        generator=generator)
+        return DistributedLengthGroupedSampler(
+            batch_size,
+            dataset=self.train_dataset,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            seed=seed,
+            lengths=lengths
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("data_paths", nargs="+",
+                        help="save_to_disk directories of the splits")
+    parser.add_argument("--model", default="meta-llama/Llama-2-7b-chat-hf",
+                        help="model of the tokenizer")
+    parser.add_argument("--cache-dir", default="../data/token_cache/")
+    parser.add_argument("--max-seq-length", type=int, default=None,
+                        help="truncation length, none by default")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild existing caches")
+    args = parser.parse_args()
+
+    # The tokenizer of fine_tune.py, caches are found by its fingerprint
+    tokenizer = transformers.LlamaTokenizer.from_pretrained(args.model)
+    for data_path in args.data_paths:
+        build_token_cache(tokenizer, data_path, args.cache_dir,
+                          args.max_seq_length, args.force)
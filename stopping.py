@@ -0,0 +1,100 @@
+"""
+Stop sequences for generation, e.g. a fake next user turn
+"""
+from typing import List, Sequence, Union
+
+import torch
+from transformers import PreTrainedTokenizer, StoppingCriteria
+
+
+def truncate_at_stop(text: str, stop_sequences: Sequence[str]) -> str:
+    """
+    Cut the text at the first stop sequence
+    """
+    for stop in stop_sequences:
+        index = text.find(stop)
+        if index != -1:
+            text = text[:index]
+    return text
+
+
+def partial_stop_length(text: str, stop_sequences: Sequence[str]) -> int:
+    """
+    Length of the longest end of the text a stop sequence may start with
+    """
+    longest = max((len(stop) for stop in stop_sequences), default=0)
+    for length in range(min(len(text), longest - 1), 0, -1):
+        if any(stop.startswith(text[-length:]) for stop in stop_sequences):
+            return length
+    return 0
+
+
+class StopSequenceChecker:
+    """
+    Detects stop sequences at the end of generated tokens by decoding
+    only a short tail, so every check costs the same for any length
+    """
+
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizer,
+                 stop_sequences: Sequence[str]):
+        """
+        Args:
+            tokenizer (PreTrainedTokenizer): model tokenizer
+            stop_sequences (Sequence[str]): texts ending the response
+        """
+        self.tokenizer = tokenizer
+        self.stop_sequences = list(stop_sequences)
+        # Tokenization of a stop sequence depends on the preceding text,
+        # a couple of extra tokens covers the difference
+        self.window = max(
+            (len(tokenizer(stop, add_special_tokens=False).input_ids)
+             for stop in self.stop_sequences),
+            default=0
+        ) + 2
+
+    def __call__(self, new_token_ids: List[int]) -> bool:
+        if not self.stop_sequences:
+            return False
+        tail = self.tokenizer.decode(new_token_ids[-self.window:])
+        return any(stop in tail for stop in self.stop_sequences)
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    Stops `generate` once every sequence has a stop sequence (or EOS)
+    among the tokens generated after the prompt
+
+    A sequence stays stopped while the rest of the batch goes on, its
+    later tokens are cut off with `truncate_at_stop`.
+    """
+
+    def __init__(self,
+                 checker: StopSequenceChecker,
+                 prompt_length: int,
+                 eos_token_id: Union[int, None] = None):
+        """
+        Args:
+            checker (StopSequenceChecker): stop sequence checker
+            prompt_length (int): number of prompt tokens, with padding
+            eos_token_id (Union[int, None], optional): EOS token id, needed
+                                                       for batches.
+                                                       Defaults to None.
+        """
+        self.checker = checker
+        self.prompt_length = prompt_length
+        self.eos_token_id = eos_token_id
+        self.stopped: List[bool] = []
+
+    def __call__(self,
+                 input_ids: torch.LongTensor,
+                 scores: torch.FloatTensor,
+                 **kwargs) -> bool:
+        if not self.stopped:
+            self.stopped = [False] * input_ids.shape[0]
+        for i, new_token_ids in enumerate(
+                input_ids[:, self.prompt_length:].tolist()):
+            if not self.stopped[i]:
+                self.stopped[i] = new_token_ids[-1] == self.eos_token_id \
+                    or self.checker(new_token_ids)
+        return all(self.stopped)
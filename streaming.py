@@ -0,0 +1,174 @@
+"""
+Streaming model responses to Telegram with progressive message edits
+"""
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, NoReturn, Sequence, Union
+
+from transformers import PreTrainedTokenizer, TextStreamer
+
+from stopping import partial_stop_length, truncate_at_stop
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# Sentinel marking the end of the stream
+_END = None
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    Text streamer filled by the generation thread and read by the event loop
+
+    Decoded text chunks are handed over to the event loop with
+    `call_soon_threadsafe`, so the generation thread never blocks on it.
+    """
+
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizer,
+                 loop: Union[asyncio.AbstractEventLoop, None] = None):
+        """
+        Args:
+            tokenizer (PreTrainedTokenizer): model tokenizer
+            loop (Union[asyncio.AbstractEventLoop, None], optional): event
+                loop reading the stream. Defaults to the running one.
+        """
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop or asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._closed = False
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.close)
+
+    def close(self) -> NoReturn:
+        """
+        End the stream (must be called from the event loop), idempotent
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put_nowait(_END)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        while True:
+            text = await self._queue.get()
+            if text is _END:
+                return
+            yield text
+
+
+class ProgressiveMessage:
+    """
+    Telegram message that grows while the response is being generated
+
+    The first message is sent as soon as `min_first_chars` characters
+    are generated, then it is edited at most once per `edit_interval`
+    seconds to stay under Telegram edit rate limits. Streamed text is
+    shown up to the first of `stop_sequences`, and an end that may be
+    the start of one is held back until more text comes.
+    """
+
+    def __init__(self,
+                 bot: Any,
+                 chat_id: int,
+                 reply_markup: Any = None,
+                 min_first_chars: int = 20,
+                 edit_interval: float = 1.0,
+                 stop_sequences: Sequence[str] = (),
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            bot (Any): telegram bot (anything with send_message and
+                       edit_message_text coroutines)
+            chat_id (int): chat to send the message to
+            reply_markup (Any, optional): markup of the first message.
+                                          Defaults to None.
+            min_first_chars (int, optional): characters to wait for before
+                                             sending the first message.
+                                             Defaults to 20.
+            edit_interval (float, optional): minimal seconds between edits.
+                                             Defaults to 1.0.
+            stop_sequences (Sequence[str], optional): texts ending the
+                                                      response.
+                                                      Defaults to ().
+            clock (Callable[[], float], optional): time source.
+                                                   Defaults to time.monotonic.
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_markup = reply_markup
+        self.min_first_chars = min_first_chars
+        self.edit_interval = edit_interval
+        self.stop_sequences = list(stop_sequences)
+        self.clock = clock
+        self.message = None
+        self.sent_text = ""
+        self.num_edits = 0
+        self._last_update = 0.0
+
+    async def consume(self, streamer: AsyncTextStreamer) -> str:
+        """
+        Show streamed text until the stream is closed
+
+        Returns:
+            str: streamed text
+        """
+        text = ""
+        async for chunk in streamer:
+            text += chunk
+            visible = self._visible(text)
+            if self.message is None:
+                if len(visible.strip()) >= self.min_first_chars:
+                    await self._send(visible)
+            elif self.clock() - self._last_update >= self.edit_interval:
+                await self._edit(visible)
+        return text
+
+    async def finish(self, text: str) -> NoReturn:
+        """
+        Make the message show the final response
+        """
+        if self.message is None:
+            await self._send(text)
+        elif text.strip() != self.sent_text:
+            await self._edit(text)
+
+    def _visible(self, text: str) -> str:
+        """
+        Streamed text without stop sequences and their possible starts
+        """
+        text = truncate_at_stop(text, self.stop_sequences)
+        return text[:len(text) - partial_stop_length(text,
+                                                     self.stop_sequences)]
+
+    async def _send(self, text: str) -> NoReturn:
+        self.sent_text = text.strip()
+        self.message = await self.bot.send_message(
+            chat_id=self.chat_id,
+            text=self.sent_text,
+            reply_markup=self.reply_markup
+        )
+        self._last_update = self.clock()
+
+    async def _edit(self, text: str) -> NoReturn:
+        text = text.strip()
+        # Telegram rejects edits that do not change the text
+        if not text or text == self.sent_text:
+            return
+        self.sent_text = text
+        try:
+            await self.bot.edit_message_text(
+                text=text,
+                chat_id=self.chat_id,
+                message_id=self.message.message_id
+            )
+        except Exception:
+            logging.exception("Failed to edit streamed message")
+        self.num_edits += 1
+        self._last_update = self.clock()
@@ -0,0 +1,123 @@
+"""
+Admission control with a fake clock
+
+Run from the repo root:
+    python -m pytest tests/test_admission.py
+"""
+import asyncio
+
+import pytest
+
+from admission import Admission, AdmissionController, TokenBucket
+from errors import WorkerBusyError
+
+
+class FakeClock:
+    """
+    Time that only moves when the test advances it
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def finish_turn(admission: AdmissionController, user_id: int):
+    while admission.take(user_id) is not None:
+        pass
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=0.5, burst=2, now=0.0)
+    assert bucket.try_acquire(0.0)
+    assert bucket.try_acquire(0.0)
+    assert not bucket.try_acquire(0.0)
+    assert not bucket.try_acquire(1.0)
+    assert bucket.try_acquire(2.0)
+    assert not bucket.is_full(2.0)
+    assert bucket.is_full(6.0)
+
+
+def test_burst_then_rate_limited(clock):
+    admission = AdmissionController(rate=1.0, burst=3, max_concurrent=1,
+                                    clock=clock)
+    for _ in range(3):
+        assert admission.offer(1, "hi") is not Admission.RATE_LIMITED
+        finish_turn(admission, 1)
+    assert admission.offer(1, "hi") is Admission.RATE_LIMITED
+    # Other users have their own buckets
+    assert admission.offer(2, "hi") is Admission.ACCEPTED
+
+    clock.advance(1.0)
+    assert admission.offer(1, "hi") is Admission.ACCEPTED
+    assert admission.stats()["rate_limited"] == 1
+
+
+def test_messages_during_a_turn_are_coalesced(clock):
+    admission = AdmissionController(rate=1.0, burst=10, max_concurrent=1,
+                                    clock=clock)
+    assert admission.offer(1, "first") is Admission.ACCEPTED
+    assert admission.take(1) == "first"
+
+    # Sent while "first" is being answered
+    assert admission.offer(1, "second") is Admission.COALESCED
+    assert admission.offer(1, "third") is Admission.COALESCED
+    assert admission.take(1) == "second\nthird"
+    assert admission.take(1) is None
+
+    # The turn is over, the next message starts a new one
+    assert admission.offer(1, "fourth") is Admission.ACCEPTED
+    stats = admission.stats()
+    assert stats["admitted"] == 2 and stats["coalesced"] == 2
+
+
+def test_discard_ends_the_turn(clock):
+    admission = AdmissionController(rate=1.0, burst=10, max_concurrent=1,
+                                    clock=clock)
+    admission.offer(1, "first")
+    admission.offer(1, "second")
+    admission.discard(1)
+    assert admission.take(1) is None
+    assert admission.offer(1, "third") is Admission.ACCEPTED
+
+
+def test_inactive_users_with_full_buckets_are_evicted(clock):
+    admission = AdmissionController(rate=1.0, burst=2, max_concurrent=1,
+                                    max_users=2, clock=clock)
+    admission.offer(1, "hi")
+    admission.offer(2, "hi")
+    finish_turn(admission, 2)
+    clock.advance(10.0)
+
+    # User 1 is in the middle of a turn and is kept
+    admission.offer(3, "hi")
+    assert list(admission._users) == [1, 3]
+    assert admission.offer(1, "more") is Admission.COALESCED
+
+
+def test_slot_caps_concurrent_generations(clock):
+    admission = AdmissionController(rate=1.0, burst=10, max_concurrent=1,
+                                    max_wait=0.01, clock=clock)
+
+    async def main():
+        async with admission.slot():
+            assert admission.running == 1
+            with pytest.raises(WorkerBusyError):
+                async with admission.slot():
+                    pass
+        assert admission.running == 0
+        async with admission.slot():
+            pass
+
+    asyncio.run(main())
+    assert admission.stats()["overloaded"] == 1
@@ -0,0 +1,155 @@
+"""
+Batched generation on a tiny random LLaMa model on CPU
+
+Greedy responses of a batch must be the ones of every prompt generated
+alone, padding and joining the running batch must not change them.
+
+Run from the repo root:
+    python -m pytest tests/test_batching.py
+"""
+import asyncio
+from typing import List
+
+import pytest
+
+pytest.importorskip("transformers")
+
+import torch
+
+from batching import (
+    BatchingInferenceWorker,
+    ContinuousBatcher,
+    generate_batch,
+    left_pad,
+    mask_padding
+)
+from inference_worker import InferenceJob
+from stopping import StopSequenceChecker, StopSequenceCriteria
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+INFERENCE_PARAMS = {"do_sample": False, "max_new_tokens": 16}
+PENALTY_PARAMS = dict(INFERENCE_PARAMS, repetition_penalty=1.3)
+
+
+@pytest.fixture(scope="module")
+def model_and_tokenizer():
+    return build_tiny_llama()
+
+
+@pytest.fixture(scope="module")
+def prompts() -> List[str]:
+    # Different numbers of turns give different prompt lengths
+    return [prompt for num_turns in (1, 3)
+            for prompt in sample_prompts(3, num_turns)]
+
+
+@pytest.fixture(scope="module")
+def expected(model_and_tokenizer, prompts) -> List[str]:
+    model, tokenizer = model_and_tokenizer
+    return [generate_batch(model, tokenizer, [prompt], INFERENCE_PARAMS)[0]
+            for prompt in prompts]
+
+
+def test_left_pad():
+    input_ids, attention_mask = left_pad([[1, 2, 3], [4], []], 0)
+    assert input_ids.tolist() == [[1, 2, 3], [0, 0, 4], [0, 0, 0]]
+    assert attention_mask.tolist() == [[1, 1, 1], [0, 0, 1], [0, 0, 0]]
+
+
+def test_mask_padding():
+    input_ids, attention_mask = left_pad([[1, 2, 3], [4]], 0)
+    input_ids = torch.cat([input_ids, torch.tensor([[5], [6]])], dim=-1)
+    assert mask_padding(input_ids, attention_mask).tolist() == \
+        [[1, 2, 3, 5], [6, 6, 4, 6]]
+
+
+def test_stop_criteria_waits_for_every_row(model_and_tokenizer):
+    _, tokenizer = model_and_tokenizer
+    stop_ids = tokenizer("[INST]", add_special_tokens=False).input_ids
+    criteria = StopSequenceCriteria(
+        StopSequenceChecker(tokenizer, ["[INST]"]), 1, tokenizer.eos_token_id
+    )
+    hi = tokenizer("Hi", add_special_tokens=False).input_ids[0]
+    eos = tokenizer.eos_token_id
+    assert not criteria(torch.tensor([[0, hi], [0, hi]]), None)
+    assert not criteria(torch.tensor([[0, hi, eos], [0, hi, hi]]), None)
+    # Stopped rows go on with padding until the last one stops
+    assert criteria(torch.tensor([[0, hi, eos] + [eos] * len(stop_ids),
+                                  [0, hi, hi] + stop_ids]), None)
+
+
+def test_generate_batch_matches_one_at_a_time(model_and_tokenizer,
+                                              prompts,
+                                              expected):
+    model, tokenizer = model_and_tokenizer
+    assert generate_batch(model, tokenizer, prompts,
+                          INFERENCE_PARAMS) == expected
+
+
+def test_continuous_batcher_joins_running_batch(model_and_tokenizer,
+                                                prompts,
+                                                expected):
+    model, tokenizer = model_and_tokenizer
+    loop = asyncio.new_event_loop()
+    try:
+        jobs = [InferenceJob(i, prompt, loop.create_future(), loop)
+                for i, prompt in enumerate(prompts)]
+        batcher = ContinuousBatcher(model, tokenizer, INFERENCE_PARAMS)
+        responses = {}
+        batcher.add(jobs[:2])
+        for _ in range(3):
+            responses.update(batcher.step())
+        # Later requests join between decoding steps
+        batcher.add(jobs[2:])
+        while len(batcher):
+            responses.update(batcher.step())
+    finally:
+        loop.close()
+    assert [responses[job] for job in jobs] == expected
+
+
+def test_repetition_penalty_skips_padding(model_and_tokenizer, prompts):
+    model, tokenizer = model_and_tokenizer
+    expected = [generate_batch(model, tokenizer, [prompt], PENALTY_PARAMS)[0]
+                for prompt in prompts]
+    assert generate_batch(model, tokenizer, prompts,
+                          PENALTY_PARAMS) == expected
+
+    loop = asyncio.new_event_loop()
+    try:
+        jobs = [InferenceJob(i, prompt, loop.create_future(), loop)
+                for i, prompt in enumerate(prompts)]
+        batcher = ContinuousBatcher(model, tokenizer, PENALTY_PARAMS)
+        responses = {}
+        batcher.add(jobs[:2])
+        responses.update(batcher.step())
+        batcher.add(jobs[2:])
+        while len(batcher):
+            responses.update(batcher.step())
+    finally:
+        loop.close()
+    assert [responses[job] for job in jobs] == expected
+
+
+@pytest.mark.parametrize("continuous", [True, False])
+def test_worker_batches_concurrent_users(model_and_tokenizer,
+                                         prompts,
+                                         expected,
+                                         continuous):
+    model, tokenizer = model_and_tokenizer
+    worker = BatchingInferenceWorker(model, tokenizer, INFERENCE_PARAMS,
+                                     max_queue_size=len(prompts),
+                                     max_batch_size=4,
+                                     continuous=continuous)
+
+    async def submit_all() -> List[str]:
+        return await asyncio.gather(*[
+            worker.submit(user_id, prompt)
+            for user_id, prompt in enumerate(prompts)
+        ])
+
+    worker.start()
+    try:
+        assert asyncio.run(submit_all()) == expected
+    finally:
+        worker.stop()
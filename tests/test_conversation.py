@@ -0,0 +1,153 @@
+"""
+Token-budgeted conversation window on the tiny tokenizer
+
+Run from the repo root:
+    python -m pytest tests/test_conversation.py
+"""
+from typing import List, Tuple
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from conversation import Conversation
+from prompt_builder import PromptBuilder
+from benchmarks.tiny_llama import build_tiny_tokenizer, SAMPLE_MESSAGES
+from src.prompt_templates import CLOSE_SYSTEM_PROMPT, INIT_SYSTEM_PROMPT
+
+
+# Tokens left for the turns by the budgets of the tests
+TURNS_BUDGET = 200
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return build_tiny_tokenizer()
+
+
+@pytest.fixture(scope="module")
+def max_tokens(tokenizer) -> int:
+    return len(tokenizer(INIT_SYSTEM_PROMPT).input_ids) + TURNS_BUDGET
+
+
+def chat(conversation: Conversation,
+         num_turns: int) -> List[Tuple[str, str]]:
+    """
+    Play numbered turns, every prompt is built before its turn is added
+    """
+    turns = []
+    for turn in range(num_turns):
+        message = f"{SAMPLE_MESSAGES[turn % len(SAMPLE_MESSAGES)]} " \
+            f"(turn {turn})"
+        response = f"Sounds great! (reply {turn})"
+        user_segment = conversation.user_segment(message)
+        conversation.build_input_ids(pending=user_segment)
+        conversation.append(user_segment,
+                            conversation.model_segment(response))
+        turns.append((message, response))
+    return turns
+
+
+def retokenized_count(tokenizer,
+                      system_prompt: str,
+                      turns: List[Tuple[str, str]]) -> int:
+    """
+    Tokens of the prompt tokenized from scratch with a new builder
+    """
+    builder = PromptBuilder(tokenizer)
+    segments = [builder.segment(system_prompt, add_special_tokens=True)]
+    for message, response in turns:
+        segments.append(builder.user_segment(message))
+        segments.append(builder.model_segment(response))
+    return len(builder.build(segments))
+
+
+def test_window_stays_within_max_tokens(tokenizer, max_tokens):
+    conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT,
+                                max_tokens=max_tokens)
+    for turn in range(50):
+        user_segment = conversation.user_segment(f"Message {turn}")
+        input_ids = conversation.build_input_ids(pending=user_segment)
+        assert len(input_ids) <= conversation.max_tokens
+        assert conversation.num_tokens + user_segment.num_tokens == \
+            len(input_ids)
+        conversation.append(user_segment,
+                            conversation.model_segment(f"Reply {turn}"))
+    assert conversation.window_start > 0
+
+
+def test_oldest_turns_are_dropped_first(tokenizer, max_tokens):
+    conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT,
+                                max_tokens=max_tokens)
+    turns = chat(conversation, 30)
+    conversation.build_input_ids()
+
+    # The window is a suffix of whole turns
+    assert conversation.window_start % 2 == 0
+    first_kept = conversation.window_start // 2
+    assert 0 < first_kept < len(turns)
+    prompt = conversation.build_prompt()
+    for message, response in turns[:first_kept]:
+        assert message not in prompt
+    for message, response in turns[first_kept:]:
+        assert message in prompt and response in prompt
+    assert prompt.startswith(INIT_SYSTEM_PROMPT)
+
+
+def test_trim_leaves_room_for_several_turns(tokenizer, max_tokens):
+    conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT,
+                                max_tokens=max_tokens, trim_ratio=0.5)
+    num_turns, num_trims = 60, 0
+    for turn in range(num_turns):
+        window_start = conversation.window_start
+        user_segment = conversation.user_segment(f"Message {turn}")
+        conversation.build_input_ids(pending=user_segment)
+        if conversation.window_start != window_start:
+            num_trims += 1
+            assert conversation.num_tokens + user_segment.num_tokens <= \
+                max_tokens * 0.5
+        conversation.append(user_segment,
+                            conversation.model_segment(f"Reply {turn}"))
+    # The prompt prefix stays the same between trims
+    assert 0 < num_trims < num_turns // 2
+
+
+def test_system_prompt_swap_recounts_tokens(tokenizer):
+    conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT)
+    turns = chat(conversation, 5)
+    num_tokens = conversation.num_tokens
+
+    conversation.set_system_prompt(CLOSE_SYSTEM_PROMPT)
+    assert conversation.system_prompt.token_ids == \
+        tokenizer(CLOSE_SYSTEM_PROMPT).input_ids
+    assert conversation.num_tokens == len(conversation.build_input_ids())
+    assert conversation.num_tokens - num_tokens == \
+        len(tokenizer(CLOSE_SYSTEM_PROMPT).input_ids) - \
+        len(tokenizer(INIT_SYSTEM_PROMPT).input_ids)
+    assert conversation.num_tokens == \
+        retokenized_count(tokenizer, CLOSE_SYSTEM_PROMPT, turns)
+
+
+def test_system_prompt_swap_keeps_budget(tokenizer, max_tokens):
+    conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT,
+                                max_tokens=max_tokens)
+    chat(conversation, 30)
+    # A longer system prompt leaves less room for the turns
+    conversation.set_system_prompt(INIT_SYSTEM_PROMPT + " " +
+                                   CLOSE_SYSTEM_PROMPT[:100])
+    user_segment = conversation.user_segment("One more message")
+    input_ids = conversation.build_input_ids(pending=user_segment)
+    assert len(input_ids) <= max_tokens
+
+
+def test_incremental_counts_match_retokenizing(tokenizer, max_tokens):
+    conversation = Conversation(tokenizer, INIT_SYSTEM_PROMPT,
+                                max_tokens=max_tokens)
+    turns = []
+    for _ in range(40):
+        turns.extend(chat(conversation, 1))
+        conversation.build_input_ids()
+        kept = turns[conversation.window_start // 2:]
+        assert conversation.num_tokens == \
+            retokenized_count(tokenizer, INIT_SYSTEM_PROMPT, kept)
+        assert conversation.msg_count == 2 * len(turns)
@@ -0,0 +1,61 @@
+"""
+Dynamic int8 quantization of a model serving several LoRA adapters
+
+Run from the repo root:
+    python -m pytest tests/test_cpu_backend.py
+"""
+import os
+
+import pytest
+
+pytest.importorskip("transformers")
+peft = pytest.importorskip("peft")
+
+import torch
+
+os.environ.setdefault("HF_AUTH_TOKEN", "")
+
+from utils import configure_cpu_backend, quantizable_linear_names
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+
+ADAPTERS = ("default", "second")
+
+
+@pytest.fixture
+def model_and_tokenizer():
+    model, tokenizer = build_tiny_llama()
+    lora_config = peft.LoraConfig(r=4, target_modules=["q_proj", "v_proj"],
+                                  task_type="CAUSAL_LM")
+    model = peft.get_peft_model(model, lora_config)
+    model.add_adapter(ADAPTERS[1], lora_config)
+    return model.eval(), tokenizer
+
+
+def test_lora_layers_are_not_quantized(model_and_tokenizer):
+    model, _ = model_and_tokenizer
+    names = quantizable_linear_names(model)
+    assert names and not any("lora_" in name for name in names)
+    assert not any(name.endswith(("q_proj", "v_proj")) for name in names)
+
+    model = configure_cpu_backend(model, {"dynamic_int8": True})
+    modules = dict(model.named_modules())
+    for name in names:
+        assert isinstance(modules[name],
+                          torch.nn.quantized.dynamic.Linear)
+    for name, module in modules.items():
+        if "lora_" in name and isinstance(module, torch.nn.Linear):
+            assert type(module) is torch.nn.Linear
+            assert module.weight.dtype == torch.float32
+
+
+def test_quantized_model_switches_adapters(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    model = configure_cpu_backend(model, {"dynamic_int8": True})
+    input_ids = tokenizer(sample_prompts(1)[0],
+                          return_tensors="pt").input_ids
+    for adapter in ADAPTERS:
+        model.set_adapter(adapter)
+        with torch.no_grad():
+            output = model.generate(input_ids=input_ids, max_new_tokens=4,
+                                    do_sample=False)
+        assert output.shape[1] == input_ids.shape[1] + 4
@@ -0,0 +1,60 @@
+"""
+Per-user KV-cache of prompt and response on a tiny random LLaMa model
+
+Run from the repo root:
+    python -m pytest tests/test_generation.py
+"""
+import pytest
+
+pytest.importorskip("transformers")
+
+from transformers import pipeline
+
+from generation import ReplyGenerator
+from kv_cache import UserKVCache, past_length
+from benchmarks.tiny_llama import build_tiny_llama, sample_prompts
+from src.prompt_templates import USER_PROMPT
+
+INFERENCE_PARAMS = {"do_sample": False, "max_new_tokens": 8,
+                    "use_cache": True}
+
+
+@pytest.fixture(scope="module")
+def model_pipeline():
+    model, tokenizer = build_tiny_llama()
+    return pipeline("text-generation", model=model, tokenizer=tokenizer)
+
+
+def test_response_keys_values_are_reused_next_turn(model_pipeline):
+    tokenizer = model_pipeline.tokenizer
+    user_cache = UserKVCache(max_bytes=1024 ** 3)
+    generator = ReplyGenerator(model_pipeline, INFERENCE_PARAMS, user_cache)
+    prompt = tokenizer(sample_prompts(1)[0]).input_ids
+    generator(0, prompt)
+
+    entry = user_cache.get(0)
+    assert entry.token_ids[:len(prompt)] == prompt
+    assert len(entry.token_ids) > len(prompt)
+    assert past_length(entry.past_key_values) == len(entry.token_ids)
+
+    # The next prompt continues the generated response
+    next_prompt = entry.token_ids + tokenizer(
+        " " + USER_PROMPT.format(user_message="Tell me more"),
+        add_special_tokens=False
+    ).input_ids
+    fed = []
+    handle = model_pipeline.model.register_forward_pre_hook(
+        lambda module, args, kwargs: fed.append(kwargs["input_ids"].shape[1]),
+        with_kwargs=True
+    )
+    try:
+        response = generator(0, next_prompt)
+    finally:
+        handle.remove()
+    # Only the new user turn is prefilled, generate feeds its last token
+    assert fed[0] == len(next_prompt) - len(entry.token_ids) - 1
+
+    expected = ReplyGenerator(model_pipeline, INFERENCE_PARAMS)(
+        0, next_prompt
+    )
+    assert response == expected
@@ -0,0 +1,102 @@
+"""
+Turns finished after the user was paged out or cleared mid-generation
+
+Run from the repo root:
+    python -m pytest tests/test_history_store.py
+"""
+import pytest
+
+pytest.importorskip("transformers")
+
+from conversation import Conversation
+from history_store import (
+    InMemoryHistoryStore,
+    SQLiteHistoryStore,
+    UserHistory
+)
+from benchmarks.tiny_llama import build_tiny_tokenizer
+from src.prompt_templates import INIT_SYSTEM_PROMPT
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return build_tiny_tokenizer()
+
+
+@pytest.fixture
+def user_history(tokenizer) -> UserHistory:
+    return UserHistory(
+        InMemoryHistoryStore(),
+        lambda msg_count: Conversation(tokenizer, INIT_SYSTEM_PROMPT),
+        max_hot_users=1
+    )
+
+
+def start_turn(user_history: UserHistory, user_id: int, text: str):
+    """
+    What the bot reads before it awaits the generation
+    """
+    conversation = user_history.get(user_id)
+    return conversation, user_history.epoch(user_id), \
+        conversation.user_segment(text)
+
+
+def test_sqlite_store_counts_users_on_writes(tmp_path):
+    store = SQLiteHistoryStore(tmp_path / "history.sqlite3")
+    store.reset(1)
+    store.append_turn(1, "hi", "hello", 2)
+    store.append_turn(2, "hi", "hello", 2)
+    store.reset(2)
+    assert len(store) == 2
+    store.close()
+
+    store = SQLiteHistoryStore(tmp_path / "history.sqlite3")
+    assert len(store) == 2
+    store.append_turn(3, "hi", "hello", 2)
+    assert len(store) == 3
+    assert store.load(2) == (0, [])
+    assert store.load(3) == (2, [("hi", "hello")])
+    store.close()
+
+
+def test_turn_of_user_evicted_mid_generation_is_kept(user_history):
+    user_history.reset(1)
+    user_history.append(1, user_history.epoch(1), "hi",
+                        user_history.get(1).user_segment("hi"), "hello")
+    conversation, epoch, user_segment = start_turn(user_history, 1,
+                                                   "how are you?")
+
+    # Another user pages user 1 out while the reply is generated
+    user_history.reset(2)
+    assert 1 not in dict(user_history.items())
+
+    updated = user_history.append(1, epoch, "how are you?", user_segment,
+                                  "fine")
+    assert updated is not None and updated is not conversation
+    assert updated.msg_count == 4
+    assert user_history.get(1) is updated
+    assert user_history.store.load(1) == (4, [("hi", "hello"),
+                                              ("how are you?", "fine")])
+
+
+def test_turn_of_user_cleared_mid_generation_is_dropped(user_history):
+    user_history.reset(1)
+    _, epoch, user_segment = start_turn(user_history, 1, "hi")
+
+    # /clear while the reply is generated
+    user_history.reset(1)
+    assert user_history.append(1, epoch, "hi", user_segment,
+                               "hello") is None
+    assert user_history.get(1).msg_count == 0
+    assert user_history.store.load(1) == (0, [])
+
+
+def test_clear_is_seen_after_eviction(user_history):
+    user_history.reset(1)
+    _, epoch, user_segment = start_turn(user_history, 1, "hi")
+
+    user_history.reset(1)
+    user_history.reset(2)
+    assert user_history.append(1, epoch, "hi", user_segment,
+                               "hello") is None
+    assert user_history.store.load(1) == (0, [])
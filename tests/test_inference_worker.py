@@ -0,0 +1,87 @@
+"""
+Inference worker serving overlapping handlers of several users
+
+Run from the repo root:
+    python -m pytest tests/test_inference_worker.py
+"""
+import asyncio
+import threading
+
+import pytest
+
+from inference_worker import InferenceWorker, UserBusyError, WorkerBusyError
+
+
+class BlockingModel:
+    """
+    Generation that waits until the test releases it
+    """
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.prompts = []
+
+    def __call__(self, user_id: int, prompt: str) -> str:
+        self.prompts.append(prompt)
+        self.started.set()
+        self.release.wait(10)
+        return f"reply to {prompt}"
+
+
+async def wait_for(event: threading.Event):
+    await asyncio.get_running_loop().run_in_executor(None, event.wait, 10)
+
+
+def test_handlers_of_two_users_overlap():
+    model = BlockingModel()
+    worker = InferenceWorker(model, max_queue_size=4)
+    events = []
+
+    async def handler(user_id: int, prompt: str) -> str:
+        events.append(("start", user_id))
+        response = await worker.submit(user_id, prompt)
+        events.append(("end", user_id))
+        return response
+
+    async def main():
+        first = asyncio.create_task(handler(1, "hi"))
+        await wait_for(model.started)
+        # The first generation is running, the loop still serves others
+        second = asyncio.create_task(handler(2, "hello"))
+        await asyncio.sleep(0)
+        assert events == [("start", 1), ("start", 2)]
+        model.release.set()
+        return await asyncio.gather(first, second)
+
+    worker.start()
+    try:
+        assert asyncio.run(main()) == ["reply to hi", "reply to hello"]
+    finally:
+        worker.stop()
+    assert model.prompts == ["hi", "hello"]
+
+
+def test_busy_errors_reach_overlapping_handlers():
+    model = BlockingModel()
+    worker = InferenceWorker(model, max_queue_size=1)
+
+    async def main():
+        first = asyncio.create_task(worker.submit(1, "hi"))
+        await wait_for(model.started)
+        # Same user again while the first reply is generated
+        with pytest.raises(UserBusyError):
+            await worker.submit(1, "are you there?")
+        # User 2 takes the only queue place, user 3 finds it full
+        second = asyncio.create_task(worker.submit(2, "hello"))
+        await asyncio.sleep(0)
+        with pytest.raises(WorkerBusyError):
+            await worker.submit(3, "hey")
+        model.release.set()
+        await asyncio.gather(first, second)
+
+    worker.start()
+    try:
+        asyncio.run(main())
+    finally:
+        worker.stop()
@@ -0,0 +1,55 @@
+"""
+Serving artifact used only if built from the configured model and adapter
+
+Run from the repo root:
+    python -m pytest tests/test_serving_artifact.py
+"""
+import json
+import logging
+import os
+
+import pytest
+
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+
+os.environ.setdefault("HF_AUTH_TOKEN", "")
+
+from utils import SERVING_ARTIFACT_FILE, load_serving_artifact
+
+
+@pytest.fixture
+def artifact_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ("base", "adapter", "artifact"):
+        (tmp_path / name).mkdir()
+    # Recorded by prepare_model.py as absolute paths
+    with open(tmp_path / "artifact" / SERVING_ARTIFACT_FILE, "w") as fp:
+        json.dump({"model_path": str(tmp_path / "base"),
+                   "adapter_weights_path": str(tmp_path / "adapter")}, fp)
+    return "artifact"
+
+
+def test_artifact_of_configured_model_is_used(artifact_path):
+    artifact = load_serving_artifact(artifact_path, "base", "./adapter/")
+    assert artifact is not None
+
+
+@pytest.mark.parametrize("model_path, adapter_weights_path", [
+    ("base", None),
+    ("base", "other_adapter"),
+    ("meta-llama/Llama-2-7b-chat-hf", "adapter")
+])
+def test_artifact_of_another_model_is_ignored(artifact_path,
+                                              caplog,
+                                              model_path,
+                                              adapter_weights_path):
+    with caplog.at_level(logging.WARNING):
+        assert load_serving_artifact(artifact_path, model_path,
+                                     adapter_weights_path) is None
+    assert "loading the configured model instead" in caplog.text
+
+
+def test_missing_artifact_is_ignored(tmp_path):
+    assert load_serving_artifact(str(tmp_path), "base", None) is None
+    assert load_serving_artifact(None, "base", None) is None
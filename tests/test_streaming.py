@@ -0,0 +1,187 @@
+"""
+Streaming to a fake Telegram bot, with a fake clock and a tiny model
+
+Run from the repo root:
+    python -m pytest tests/test_streaming.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from transformers import pipeline
+
+from generation import ReplyGenerator
+from inference_worker import InferenceWorker
+from streaming import AsyncTextStreamer, ProgressiveMessage
+from benchmarks.tiny_llama import (
+    build_tiny_llama,
+    build_tiny_tokenizer,
+    sample_prompts
+)
+
+
+class FakeBot:
+    """
+    Records sent and edited messages instead of calling Telegram
+    """
+
+    def __init__(self):
+        self.events = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.events.append(("send", text))
+        return SimpleNamespace(message_id=len(self.events), chat_id=chat_id)
+
+    async def edit_message_text(self, text: str, chat_id: int,
+                                message_id: int, **kwargs):
+        self.events.append(("edit", text))
+
+
+class FakeClock:
+    """
+    Time that only moves when the test advances it
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return build_tiny_tokenizer()
+
+
+async def stream(message: ProgressiveMessage,
+                 streamer: AsyncTextStreamer,
+                 clock: FakeClock,
+                 chunks: list) -> str:
+    """
+    Feed (seconds, text) chunks as the generation thread would
+    """
+    consumer = asyncio.create_task(message.consume(streamer))
+    for seconds, text in chunks:
+        clock.now += seconds
+        streamer.on_finalized_text(text)
+        # Let the consumer take the chunk
+        for _ in range(3):
+            await asyncio.sleep(0)
+    streamer.on_finalized_text("", stream_end=True)
+    return await consumer
+
+
+def test_first_message_then_rate_limited_edits(tokenizer):
+    bot, clock = FakeBot(), FakeClock()
+
+    async def main():
+        message = ProgressiveMessage(bot, chat_id=0, min_first_chars=10,
+                                     edit_interval=1.0, clock=clock)
+        streamer = AsyncTextStreamer(tokenizer)
+        text = await stream(message, streamer, clock, [
+            (0.1, "Hello"),
+            (0.1, " there, friend"),
+            # Within the edit interval of the first message
+            (0.5, " How"),
+            (0.6, " are you"),
+            (0.1, " doing?")
+        ])
+        await message.finish(text)
+        return text
+
+    text = asyncio.run(main())
+    assert bot.events == [("send", "Hello there, friend"),
+                          ("edit", "Hello there, friend How are you"),
+                          ("edit", text.strip())]
+
+
+def test_short_response_is_sent_once(tokenizer):
+    bot, clock = FakeBot(), FakeClock()
+
+    async def main():
+        message = ProgressiveMessage(bot, chat_id=0, min_first_chars=20,
+                                     clock=clock)
+        streamer = AsyncTextStreamer(tokenizer)
+        text = await stream(message, streamer, clock, [(0.1, "Hi!")])
+        await message.finish(text)
+
+    asyncio.run(main())
+    assert bot.events == [("send", "Hi!")]
+
+
+def test_finish_skips_unchanged_text(tokenizer):
+    bot, clock = FakeBot(), FakeClock()
+
+    async def main():
+        message = ProgressiveMessage(bot, chat_id=0, min_first_chars=5,
+                                     edit_interval=0.0, clock=clock)
+        streamer = AsyncTextStreamer(tokenizer)
+        text = await stream(message, streamer, clock, [
+            (0.1, "Hello"), (0.1, " there")
+        ])
+        await message.finish(text)
+
+    asyncio.run(main())
+    # Telegram rejects edits that do not change the text
+    assert bot.events == [("send", "Hello"), ("edit", "Hello there")]
+
+
+def test_edits_never_show_stop_sequences(tokenizer):
+    bot, clock = FakeBot(), FakeClock()
+
+    async def main():
+        message = ProgressiveMessage(bot, chat_id=0, min_first_chars=5,
+                                     edit_interval=0.0,
+                                     stop_sequences=["</s>", "[INST]"],
+                                     clock=clock)
+        streamer = AsyncTextStreamer(tokenizer)
+        await stream(message, streamer, clock, [
+            (0.1, "Hello there"),
+            # Held back until it is clear whether a stop sequence starts
+            (0.1, " friend <"),
+            (0.1, "3 [IN"),
+            (0.1, "ST] And you?")
+        ])
+
+    asyncio.run(main())
+    assert bot.events == [("send", "Hello there"),
+                          ("edit", "Hello there friend"),
+                          ("edit", "Hello there friend <3")]
+
+
+def test_streamed_message_matches_tiny_model_response():
+    model, tokenizer = build_tiny_llama()
+    model_pipeline = pipeline("text-generation", model=model,
+                              tokenizer=tokenizer)
+    inference_params = {"do_sample": False,
+                        "max_new_tokens": 32,
+                        "use_cache": True}
+    worker = InferenceWorker(ReplyGenerator(model_pipeline, inference_params))
+    prompt = sample_prompts(1, num_turns=2)[0]
+    bot = FakeBot()
+
+    async def main() -> str:
+        message = ProgressiveMessage(bot, chat_id=0, min_first_chars=1,
+                                     edit_interval=0.0)
+        streamer = AsyncTextStreamer(tokenizer)
+        consumer = asyncio.create_task(message.consume(streamer))
+        try:
+            response = await worker.submit(0, prompt, streamer=streamer)
+        finally:
+            streamer.close()
+            await consumer
+        await message.finish(response)
+        return response
+
+    worker.start()
+    try:
+        response = asyncio.run(main())
+    finally:
+        worker.stop()
+    assert bot.events
+    assert bot.events[0][0] == "send"
+    assert bot.events[-1][1] == response.strip()
@@ -0,0 +1,41 @@
+"""
+Restarts of model worker processes that keep crashing
+
+Run from the repo root:
+    python -m pytest tests/test_worker_pool.py
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from worker_pool import ProcessWorkerPool
+
+
+def crash_on_load():
+    """
+    Generator factory of a worker that dies while loading its model
+    """
+    os._exit(1)
+
+
+def test_crashing_worker_is_restarted_with_backoff_then_given_up():
+    pool = ProcessWorkerPool(crash_on_load, num_workers=1, max_restarts=2,
+                             restart_backoff=0.2, start_timeout=0,
+                             monitor_interval=0.05)
+    started = time.monotonic()
+    pool.start()
+    try:
+        while (pool.restarts < 2 or pool._processes) and \
+                time.monotonic() - started < 60:
+            time.sleep(0.05)
+        # Restarts wait 0.2 and 0.4 seconds
+        assert time.monotonic() - started >= 0.6
+        time.sleep(1.0)
+        assert pool.restarts == 2
+        assert not pool._processes and not pool._restart_at
+        assert pool.worker_of(1) is None
+    finally:
+        pool.stop(timeout=5)
@@ -0,0 +1,164 @@
+"""
+Asynchronous append-only transcript logging
+"""
+import asyncio
+import gzip
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Hashable, Iterator, List, NoReturn, Union
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+SEGMENT_PREFIX = "transcripts-"
+
+
+def _segment_paths(log_dir: Path) -> List[Path]:
+    return sorted(log_dir.glob(f"{SEGMENT_PREFIX}*.jsonl*"))
+
+
+class TranscriptLogger:
+    """
+    Buffers transcript records and appends them to rotating JSONL segments
+
+    `log` never blocks the event loop: records go to a bounded buffer
+    that a background task flushes every `flush_interval` seconds (or
+    when half of the buffer is filled) in a separate thread. When the
+    buffer is full new records are dropped and counted in `dropped`.
+    """
+
+    def __init__(self,
+                 log_dir: Union[str, Path],
+                 flush_interval: float = 5.0,
+                 max_buffer: int = 10000,
+                 max_segment_bytes: int = 64 * 1024 ** 2,
+                 compress: bool = True):
+        """
+        Args:
+            log_dir (Union[str, Path]): directory for segment files
+            flush_interval (float, optional): Seconds between flushes.
+                                              Defaults to 5.0.
+            max_buffer (int, optional): Maximum number of buffered records.
+                                        Defaults to 10000.
+            max_segment_bytes (int, optional): Segment size to rotate at.
+                                               Defaults to 64 MiB.
+            compress (bool, optional): Write gzip segments. Defaults to True.
+        """
+        self.log_dir = Path(log_dir)
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_segment_bytes = max_segment_bytes
+        self.compress = compress
+        self.dropped = 0
+        self._buffer = []
+        self._wakeup = None
+        self._stopping = False
+        self._task = None
+        self._segment_path = None
+
+    async def start(self) -> NoReturn:
+        """
+        Start the background writer task
+        """
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        segments = _segment_paths(self.log_dir)
+        self._segment_path = segments[-1] if segments else self._new_segment(0)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._writer())
+
+    async def stop(self) -> NoReturn:
+        """
+        Flush the buffered records and stop the writer task
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def log(self, user_id: Hashable, **record) -> bool:
+        """
+        Buffer a transcript record of the user
+
+        Returns:
+            bool: False if the record was dropped because the buffer is full
+        """
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logging.warning("Transcript buffer is full, %d records "
+                                "dropped", self.dropped)
+            return False
+        self._buffer.append({"user_id": user_id, "time": time.time(),
+                             **record})
+        if self._wakeup is not None and \
+                len(self._buffer) >= self.max_buffer // 2:
+            self._wakeup.set()
+        return True
+
+    async def _writer(self) -> NoReturn:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush()
+        await self._flush()
+
+    async def _flush(self) -> NoReturn:
+        if not self._buffer:
+            return
+        records, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, records)
+        except Exception:
+            logging.exception("Failed to write %d transcript records",
+                              len(records))
+
+    def _write(self, records: List[dict]) -> NoReturn:
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n"
+                       for record in records).encode("utf-8")
+        if self._segment_path.exists() and \
+                self._segment_path.stat().st_size >= self.max_segment_bytes:
+            index = int(self._segment_path.name[len(SEGMENT_PREFIX):]
+                        .split(".")[0])
+            self._segment_path = self._new_segment(index + 1)
+        if self._segment_path.suffix == ".gz":
+            # Every batch is a separate gzip member, readers see one stream
+            data = gzip.compress(data)
+        with open(self._segment_path, "ab") as fp:
+            fp.write(data)
+
+    def _new_segment(self, index: int) -> Path:
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        return self.log_dir.joinpath(f"{SEGMENT_PREFIX}{index:06d}{suffix}")
+
+
+def read_transcripts(log_dir: Union[str, Path],
+                     user_id: Union[Hashable, None] = None) -> Iterator[dict]:
+    """
+    Stream transcript records from all segments in chronological order
+
+    Args:
+        log_dir (Union[str, Path]): directory with segment files
+        user_id (Union[Hashable, None], optional): Only records of this user.
+                                                   Defaults to None.
+
+    Yields:
+        Iterator[dict]: transcript records
+    """
+    for path in _segment_paths(Path(log_dir)):
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8") as fp:
+            for line in fp:
+                record = json.loads(line)
+                if user_id is None or record["user_id"] == user_id:
+                    yield record
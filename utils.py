@@ -2,13 +2,19 @@
 Utility functions
 """
 import os
+import json
+import time
 import logging
-from typing import Union
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Set, Union
 
 import torch
 from transformers import (
+    AutoTokenizer,
     LlamaForCausalLM,
     LlamaTokenizer,
+    PreTrainedTokenizerBase,
     pipeline
 )
 from peft import PeftModel
@@ -20,11 +26,180 @@ logging.basicConfig(
 
 HF_AUTH_TOKEN = os.environ["HF_AUTH_TOKEN"]
 
+# Marker file written next to a merged ready-to-serve model
+SERVING_ARTIFACT_FILE = "serving_artifact.json"
+
+
+@contextmanager
+def log_time(phase: str) -> Iterator[None]:
+    """
+    Log how long the phase took
+    """
+    start = time.perf_counter()
+    yield
+    logging.info("%s took %.2fs", phase, time.perf_counter() - start)
+
+
+def normalize_model_path(path: Union[str, None]) -> Union[str, None]:
+    """
+    Absolute path of a local model or adapter directory, hub ids as is
+    """
+    if path and os.path.isdir(path):
+        return os.path.abspath(path)
+    return path
+
+
+def load_serving_artifact(
+        artifact_path: Union[str, None],
+        model_path: str,
+        adapter_weights_path: Union[str, None]
+        ) -> Union[dict, None]:
+    """
+    Read the serving artifact marker if it was built from the same model
+    and adapter
+
+    Args:
+        artifact_path (Union[str, None]): prepared artifact directory
+        model_path (str): LLM model path
+        adapter_weights_path (Union[str, None]): adapter weights path
+
+    Returns:
+        Union[dict, None]: artifact metadata or None if it can't be used
+    """
+    if not artifact_path:
+        return None
+    marker_path = Path(artifact_path).joinpath(SERVING_ARTIFACT_FILE)
+    if not marker_path.exists():
+        return None
+    with open(marker_path) as fp:
+        artifact = json.load(fp)
+    for key, configured in (("model_path", model_path),
+                            ("adapter_weights_path", adapter_weights_path)):
+        recorded = artifact.get(key)
+        if normalize_model_path(recorded) != \
+                normalize_model_path(configured):
+            logging.warning("Serving artifact %s was built with %s %s, "
+                            "not %s, loading the configured model instead",
+                            artifact_path, key, recorded, configured)
+            return None
+    return artifact
+
+
+def get_tokenizer(
+        model_path: str,
+        adapter_weights_path: Union[str, None] = None,
+        artifact_path: Union[str, None] = None,
+        use_fast_tokenizer: bool = True
+        ) -> PreTrainedTokenizerBase:
+    """
+    Load only the tokenizer of the model, e.g. for a process that builds
+    prompts but doesn't run the model
+
+    Args:
+        model_path (str): LLM model path
+        adapter_weights_path (str, optional): Adapter weights path.
+                                              Defaults to None.
+        artifact_path (str, optional): Prepared serving artifact, used if
+                                       built from the same model.
+                                       Defaults to None.
+        use_fast_tokenizer (bool, optional): Load the Rust tokenizer, the
+                                             slow SentencePiece one
+                                             otherwise. Defaults to True.
+
+    Returns:
+        PreTrainedTokenizerBase: tokenizer
+    """
+    if load_serving_artifact(artifact_path, model_path, adapter_weights_path):
+        model_path = artifact_path
+    with log_time("Loading tokenizer"):
+        tokenizer_class = AutoTokenizer if use_fast_tokenizer \
+            else LlamaTokenizer
+        return tokenizer_class.from_pretrained(
+            model_path,
+            use_auth_token=HF_AUTH_TOKEN
+        )
+
+
+def bf16_supported() -> bool:
+    """
+    Whether the CPU has native bfloat16 kernels
+    """
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def quantizable_linear_names(model: torch.nn.Module) -> Set[str]:
+    """
+    Names of the plain Linear layers of the model
+
+    LoRA layers of PEFT subclass Linear and keep their adapter weights in
+    plain Linear children, which PEFT reads as float weights, so both are
+    left out.
+    """
+    return {name for name, module in model.named_modules()
+            if type(module) is torch.nn.Linear and "lora_" not in name}
+
+
+def configure_cpu_backend(
+        model: torch.nn.Module,
+        backend_params: dict
+        ) -> torch.nn.Module:
+    """
+    Apply CPU inference optimizations
+
+    Args:
+        model (torch.nn.Module): loaded model, LoRA layers of unmerged
+                                 adapters are not quantized
+        backend_params (dict): CPU backend params, see CPU_BACKEND_PARAMS
+
+    Returns:
+        torch.nn.Module: optimized model
+    """
+    if backend_params.get("num_threads"):
+        torch.set_num_threads(backend_params["num_threads"])
+    if backend_params.get("num_interop_threads"):
+        try:
+            torch.set_num_interop_threads(
+                backend_params["num_interop_threads"]
+            )
+        except RuntimeError:
+            # Can be set only once, before any inter-op parallel work
+            logging.warning("Inter-op thread count is already fixed")
+    logging.info("Using %d intra-op and %d inter-op CPU threads",
+                 torch.get_num_threads(), torch.get_num_interop_threads())
+
+    model.eval()
+    if backend_params.get("dynamic_int8"):
+        with log_time("Dynamic int8 quantization"):
+            model = torch.quantization.quantize_dynamic(
+                model,
+                {name: torch.quantization.default_dynamic_qconfig
+                 for name in quantizable_linear_names(model)},
+                dtype=torch.qint8
+            )
+    elif backend_params.get("bfloat16"):
+        if bf16_supported():
+            model = model.to(torch.bfloat16)
+        else:
+            logging.warning("bfloat16 is not supported by this CPU, "
+                            "keeping float32 weights")
+
+    if backend_params.get("compile"):
+        # Shapes change every decoding step, so compile with dynamic shapes
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
 
 def get_model(
         model_path: str,
         model_load_params: dict,
-        adapter_weights_path: Union[str, None] = None
+        adapter_weights_path: Union[str, None] = None,
+        artifact_path: Union[str, None] = None,
+        use_fast_tokenizer: bool = True,
+        cpu_backend_params: Union[dict, None] = None,
+        extra_adapters: Union[Dict[str, str], None] = None
         ) -> pipeline:
     """
     Get model pipeline for inference
@@ -34,33 +209,73 @@ def get_model(
         model_load_params (dict): model loading params
         adapter_weights_path (str, optional): If give, load adaptor weights.
                                               Defaults to None.
+        artifact_path (str, optional): If a merged model prepared by
+                                       prepare_model.py is there, load it
+                                       instead. Defaults to None.
+        use_fast_tokenizer (bool, optional): Load the Rust tokenizer.
+                                             Defaults to True.
+        cpu_backend_params (dict, optional): If given, optimize the model for
+                                             CPU inference. Defaults to None.
+        extra_adapters (Dict[str, str], optional): More adapter weights
+                                                   paths by adapter name,
+                                                   loaded next to the first
+                                                   one. Defaults to None.
 
     Returns:
         pipeline: model pipeline
     """
-    logging.info("Loading model and tokenizer")
-    model = LlamaForCausalLM.from_pretrained(
-        model_path,
-        **model_load_params,
-        use_auth_token=HF_AUTH_TOKEN
-    )
-    tokenizer = LlamaTokenizer.from_pretrained(
-        model_path,
-        use_auth_token=HF_AUTH_TOKEN
-    )
+    # The artifact has a single adapter merged into the weights
+    if not extra_adapters and \
+            load_serving_artifact(artifact_path, model_path,
+                                  adapter_weights_path):
+        logging.info("Using serving artifact %s", artifact_path)
+        model_path = artifact_path
+        adapter_weights_path = None
+        # Safetensors weights are memory-mapped and paged in lazily
+        model_load_params = {"low_cpu_mem_usage": True, **model_load_params}
 
-    if adapter_weights_path:
-        logging.info("Loading adapter weights")
-        model = PeftModel.from_pretrained(
-            model,
-            adapter_weights_path,
-            torch_dtype=torch.float16
+    tokenizer = get_tokenizer(model_path,
+                              use_fast_tokenizer=use_fast_tokenizer)
+
+    with log_time("Loading model weights"):
+        model = LlamaForCausalLM.from_pretrained(
+            model_path,
+            **model_load_params,
+            use_auth_token=HF_AUTH_TOKEN
         )
 
-    logging.info("Creating pipeline")
-    model_pipeline = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer
-    )
+    # The first adapter is "default" as in PEFT, the others get their names
+    adapters = dict(extra_adapters or {})
+    if adapter_weights_path:
+        adapters = {"default": adapter_weights_path, **adapters}
+    for i, (name, path) in enumerate(adapters.items()):
+        with log_time(f"Loading adapter weights {name}"):
+            if i == 0:
+                model = PeftModel.from_pretrained(
+                    model,
+                    path,
+                    adapter_name=name,
+                    torch_dtype=torch.float16
+                )
+            else:
+                model.load_adapter(path, adapter_name=name)
+
+    if cpu_backend_params is not None:
+        if len(adapters) > 1:
+            # Merging would bake in one adapter, only the layers without
+            # LoRA are quantized
+            logging.warning("Several adapters are served, adapters are not "
+                            "merged and layers with LoRA are not quantized")
+        elif adapters:
+            # Quantization only replaces plain Linear layers, not LoRA ones
+            with log_time("Merging adapter weights"):
+                model = model.merge_and_unload()
+        model = configure_cpu_backend(model, cpu_backend_params)
+
+    with log_time("Creating pipeline"):
+        model_pipeline = pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer
+        )
     return model_pipeline
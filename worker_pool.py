@@ -0,0 +1,451 @@
+"""
+Model worker processes with sticky routing of users by consistent hashing
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    NoReturn,
+    Set,
+    Tuple,
+    Union
+)
+
+from inference_worker import InferenceJob, UserBusyError, WorkerBusyError
+from prompt_builder import Prompt
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+# Generation kwargs that can be sent to a worker process
+PROCESS_GENERATE_KWARGS = ("adapter",)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+class HashRing:
+    """
+    Consistent hash ring: every node owns many virtual points, a key
+    belongs to the node of the first point clockwise of its hash. When
+    a node is removed only its keys move to other nodes.
+    """
+
+    def __init__(self, nodes: Tuple[Hashable, ...] = (),
+                 virtual_nodes: int = 64):
+        """
+        Args:
+            nodes (Tuple[Hashable, ...], optional): Initial nodes.
+                                                    Defaults to ().
+            virtual_nodes (int, optional): Points per node, more points
+                                           spread keys more evenly.
+                                           Defaults to 64.
+        """
+        self.virtual_nodes = virtual_nodes
+        self._nodes = set()
+        self._points: List[int] = []
+        self._owners: Dict[int, Hashable] = {}
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, node: Hashable) -> bool:
+        return node in self._nodes
+
+    def add(self, node: Hashable) -> NoReturn:
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self.virtual_nodes):
+            point = _hash(f"{node}#{i}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = node
+
+    def remove(self, node: Hashable) -> NoReturn:
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        for i in range(self.virtual_nodes):
+            point = _hash(f"{node}#{i}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                del self._points[bisect.bisect_left(self._points, point)]
+
+    def get(self, key: Hashable) -> Union[Hashable, None]:
+        """
+        Node owning the key, None if the ring is empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(str(key)))
+        return self._owners[self._points[index % len(self._points)]]
+
+
+def _worker_main(index: int,
+                 generator_factory: Callable[[], Callable[..., str]],
+                 requests: multiprocessing.Queue,
+                 responses: multiprocessing.Queue) -> NoReturn:
+    """
+    Model worker process: loads its model replica and serves requests
+    until it gets None
+    """
+    generate_fn = generator_factory()
+    responses.put(("ready", index, None, None))
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        kind, job_id, user_id, prompt, generate_kwargs = message
+        if kind == "invalidate":
+            if hasattr(generate_fn, "invalidate"):
+                generate_fn.invalidate(user_id)
+            continue
+        try:
+            response = generate_fn(user_id, prompt, **generate_kwargs)
+        except Exception as exc:
+            logging.exception("Generation failed for user %s", user_id)
+            responses.put(("error", index, job_id, repr(exc)))
+        else:
+            responses.put(("result", index, job_id, response))
+
+
+class ProcessWorkerPool:
+    """
+    Front-end of N model worker processes with the interface of
+    `InferenceWorker`
+
+    Users are routed to workers by consistent hashing on user id, so
+    per-user KV-caches of a worker stay warm. When a worker dies its
+    users and pending requests move to the remaining workers, and a
+    replacement is started if `restart_dead` is set. The delay before a
+    restart doubles while the worker keeps dying before it is ready, and
+    it is given up after `max_restarts` such crashes in a row.
+    Per-request generation kwargs (e.g. streamer) can't cross processes
+    and are ignored.
+    """
+
+    def __init__(self,
+                 generator_factory: Callable[[], Callable[..., str]],
+                 num_workers: int = 2,
+                 max_queue_size: int = 16,
+                 virtual_nodes: int = 64,
+                 restart_dead: bool = True,
+                 max_restarts: int = 5,
+                 restart_backoff: float = 1.0,
+                 max_restart_backoff: float = 60.0,
+                 start_timeout: Union[float, None] = None,
+                 monitor_interval: float = 1.0):
+        """
+        Args:
+            generator_factory (Callable[[], Callable[..., str]]): picklable
+                function creating the generate function inside a worker,
+                e.g. `serving.build_reply_generator`
+            num_workers (int, optional): Number of worker processes.
+                                         Defaults to 2.
+            max_queue_size (int, optional): Maximum number of pending
+                                            requests. Defaults to 16.
+            virtual_nodes (int, optional): Hash ring points per worker.
+                                           Defaults to 64.
+            restart_dead (bool, optional): Start a replacement for a dead
+                                           worker. Defaults to True.
+            max_restarts (int, optional): Restarts of a worker that keeps
+                dying before it is ready. Defaults to 5.
+            restart_backoff (float, optional): Seconds before the first
+                restart, doubled on every crash in a row. Defaults to 1.0.
+            max_restart_backoff (float, optional): Longest delay before a
+                                                   restart in seconds.
+                                                   Defaults to 60.0.
+            start_timeout (Union[float, None], optional): Seconds to wait
+                for workers to load models. Defaults to None (forever).
+            monitor_interval (float, optional): Seconds between worker
+                                                liveness checks.
+                                                Defaults to 1.0.
+        """
+        self.generator_factory = generator_factory
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.restart_dead = restart_dead
+        self.max_restarts = max_restarts
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.start_timeout = start_timeout
+        self.monitor_interval = monitor_interval
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._ring = HashRing(virtual_nodes=virtual_nodes)
+        self._lock = threading.Lock()
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        # Worker index -> crashes since it was last ready
+        self._crashes: Dict[int, int] = {}
+        # Worker index -> time of its delayed restart
+        self._restart_at: Dict[int, float] = {}
+        self._requests: Dict[int, multiprocessing.Queue] = {}
+        self._responses = None
+        # job id -> (worker index, job)
+        self._jobs: Dict[int, Tuple[int, InferenceJob]] = {}
+        # Ids of jobs already resent once after their worker died
+        self._resent: Set[int] = set()
+        self._job_ids = itertools.count()
+        self._in_flight = set()
+        self._closing = False
+        self._listener = None
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of requests sent to workers and not answered yet
+        """
+        return len(self._jobs)
+
+    def worker_of(self, user_id: Hashable) -> Union[int, None]:
+        """
+        Index of the worker serving the user
+        """
+        with self._lock:
+            return self._ring.get(user_id)
+
+    def start(self) -> NoReturn:
+        """
+        Start worker processes and wait until their models are loaded
+        """
+        if self._listener is not None:
+            return
+        self._closing = False
+        self._responses = self._context.Queue()
+        for index in range(self.num_workers):
+            self._spawn(index)
+
+        deadline = None if self.start_timeout is None \
+            else time.monotonic() + self.start_timeout
+        while len(self._ring) < self.num_workers:
+            timeout = None if deadline is None \
+                else max(deadline - time.monotonic(), 0)
+            try:
+                self._handle(self._responses.get(timeout=timeout))
+            except queue.Empty:
+                logging.warning("Only %d of %d workers are ready",
+                                len(self._ring), self.num_workers)
+                break
+
+        self._listener = threading.Thread(target=self._listen,
+                                          name=type(self).__name__,
+                                          daemon=True)
+        self._listener.start()
+        logging.info("Worker pool of %d processes started", len(self._ring))
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        """
+        Stop workers after the already sent requests are processed
+
+        Args:
+            timeout (float, optional): Seconds to wait for each worker.
+                                       Defaults to None (wait forever).
+        """
+        if self._listener is None:
+            return
+        self._closing = True
+        for requests in self._requests.values():
+            requests.put(None)
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._listener.join()
+        self._listener = None
+        self._processes.clear()
+        self._restart_at.clear()
+        self._crashes.clear()
+        self._requests.clear()
+        with self._lock:
+            for index in range(self.num_workers):
+                self._ring.remove(index)
+        logging.info("Worker pool stopped")
+
+    async def submit(self,
+                     user_id: Hashable,
+                     prompt: Prompt,
+                     **generate_kwargs) -> str:
+        """
+        Send a prompt to the worker of the user and wait for the response
+
+        Args:
+            user_id (Hashable): user the request belongs to
+            prompt (Prompt): model input, text or token ids
+            **generate_kwargs: only `PROCESS_GENERATE_KWARGS` are passed
+                to the worker, others (e.g. streamer) can't be sent to
+                another process
+
+        Raises:
+            UserBusyError: the user already waits for a response
+            WorkerBusyError: too many pending requests or no live workers
+
+        Returns:
+            str: model response
+        """
+        if user_id in self._in_flight:
+            raise UserBusyError(user_id)
+        if len(self._jobs) >= self.max_queue_size:
+            raise WorkerBusyError(user_id)
+
+        loop = asyncio.get_running_loop()
+        job = InferenceJob(user_id, prompt, loop.create_future(), loop,
+                           {key: value
+                            for key, value in generate_kwargs.items()
+                            if key in PROCESS_GENERATE_KWARGS})
+        job_id = next(self._job_ids)
+        with self._lock:
+            index = self._ring.get(user_id)
+            if index is None:
+                raise WorkerBusyError(user_id)
+            self._jobs[job_id] = (index, job)
+            self._requests[index].put(("generate", job_id, user_id, prompt,
+                                       job.generate_kwargs))
+
+        self._in_flight.add(user_id)
+        try:
+            return await job.future
+        finally:
+            self._in_flight.discard(user_id)
+            with self._lock:
+                self._jobs.pop(job_id, None)
+                self._resent.discard(job_id)
+
+    def invalidate(self, user_id: Hashable) -> NoReturn:
+        """
+        Drop cached keys/values of the user in its worker
+        """
+        with self._lock:
+            index = self._ring.get(user_id)
+            if index is not None:
+                self._requests[index].put(("invalidate", None, user_id,
+                                           None, None))
+
+    def _spawn(self, index: int) -> NoReturn:
+        self._requests[index] = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.generator_factory,
+                  self._requests[index], self._responses),
+            name=f"model-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _listen(self) -> NoReturn:
+        # Workers are checked on a deadline, responses of the live ones
+        # keep coming under load and must not postpone the check
+        next_check = time.monotonic() + self.monitor_interval
+        while True:
+            try:
+                self._handle(self._responses.get(
+                    timeout=max(next_check - time.monotonic(), 0)
+                ))
+            except queue.Empty:
+                pass
+            if time.monotonic() < next_check:
+                continue
+            next_check = time.monotonic() + self.monitor_interval
+            if self._closing:
+                if not any(process.is_alive()
+                           for process in self._processes.values()):
+                    break
+            else:
+                self._check_workers()
+
+        # Requests left behind by workers killed on stop
+        with self._lock:
+            jobs, self._jobs = list(self._jobs.values()), {}
+        for _, job in jobs:
+            job.set_exception(WorkerBusyError(job.user_id))
+
+    def _handle(self, message: Tuple[str, int, int, str]) -> NoReturn:
+        kind, index, job_id, payload = message
+        if kind == "ready":
+            self._crashes.pop(index, None)
+            with self._lock:
+                self._ring.add(index)
+            logging.info("Model worker %d is ready", index)
+            return
+        with self._lock:
+            _, job = self._jobs.pop(job_id, (None, None))
+            self._resent.discard(job_id)
+        if job is None:
+            # The handler gave up waiting
+            return
+        if kind == "result":
+            job.set_result(payload)
+        else:
+            job.set_exception(RuntimeError(payload))
+
+    def _check_workers(self) -> NoReturn:
+        now = time.monotonic()
+        for index, restart_at in list(self._restart_at.items()):
+            if now >= restart_at:
+                del self._restart_at[index]
+                self.restarts += 1
+                self._spawn(index)
+
+        for index, process in list(self._processes.items()):
+            if process.is_alive():
+                continue
+            logging.error("Model worker %d died with exit code %s",
+                          index, process.exitcode)
+            with self._lock:
+                self._ring.remove(index)
+                # Requests of the dead worker are resent to the new owners
+                # once, a request that kills workers fails the second time
+                for job_id, (owner, job) in list(self._jobs.items()):
+                    if owner != index:
+                        continue
+                    if job_id in self._resent:
+                        del self._jobs[job_id]
+                        self._resent.discard(job_id)
+                        job.set_exception(RuntimeError(
+                            f"Model worker {index} died generating a "
+                            f"resent request of user {job.user_id}"
+                        ))
+                        continue
+                    new_index = self._ring.get(job.user_id)
+                    if new_index is None:
+                        del self._jobs[job_id]
+                        job.set_exception(WorkerBusyError(job.user_id))
+                        continue
+                    self._resent.add(job_id)
+                    self._jobs[job_id] = (new_index, job)
+                    self._requests[new_index].put(
+                        ("generate", job_id, job.user_id, job.prompt,
+                         job.generate_kwargs)
+                    )
+            del self._processes[index]
+            if not self.restart_dead:
+                continue
+            crashes = self._crashes.get(index, 0) + 1
+            if crashes > self.max_restarts:
+                logging.error("Model worker %d is not restarted after %d "
+                              "crashes in a row", index, crashes)
+                continue
+            self._crashes[index] = crashes
+            delay = min(self.restart_backoff * 2 ** (crashes - 1),
+                        self.max_restart_backoff)
+            logging.info("Restarting model worker %d in %.1f s",
+                         index, delay)
+            self._restart_at[index] = now + delay